@@ -11,8 +11,17 @@ CSC381 Programmers/Researchers: Sam Davis ('22), Luna Jerjees ('23),
 
 '''
 from matplotlib import pyplot as plt
-import copy, math, os, pickle
+import atexit, bisect, copy, hashlib, io, math, os, pickle, shutil, sqlite3, sys, tempfile, threading, time, tracemalloc, zlib
+import multiprocessing
+import multiprocessing.util
+from collections import OrderedDict
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager, redirect_stdout
 from math import sqrt
+from multiprocessing import shared_memory
+from statistics import NormalDist
+from types import MappingProxyType
 import numpy as np
 
 
@@ -62,6 +71,42 @@ def from_file_to_dict(path, datafile, itemfile):
     return prefs
 
 
+def from_file_to_events(path, datafile, itemfile):
+    ''' Load ratings as a timestamp-ordered event stream
+
+        Parameters:
+        -- path: directory path to datafile and itemfile
+        -- datafile: delimited file containing userid, itemid, rating, timestamp
+        -- itemfile: delimited file that maps itemid to item name
+
+        Returns:
+        -- events: a list of (timestamp, user, item name, rating) tuples,
+                   sorted by timestamp (ties keep file order)
+
+    '''
+
+    # Get movie titles, place into movies dictionary indexed by itemID
+    movies = {}
+    try:
+        with open(path + '/' + itemfile, encoding='iso8859') as myfile:
+            for line in myfile:
+                (id, title) = line.split('|')[0:2]
+                movies[id] = title.strip()
+    except Exception as ex:
+        print(ex)
+        return []
+
+    events = []
+    for line in open(path+'/' + datafile):
+        (user, movieid, rating, ts) = line.split('\t')
+        events.append((int(ts), user.strip(), movies[movieid.strip()], float(rating)))
+
+    # sort is stable, so ratings with equal timestamps stay in file order
+    events.sort(key=lambda event: event[0])
+
+    return events
+
+
 def data_stats(prefs, filename):
     ''' Computes/prints descriptive analytics:
         -- Total number of users, items, ratings
@@ -259,6 +304,10 @@ def sim_distance(prefs, p1, p2, sim_weighting=0):
 
     '''
 
+    # rows kept as sorted arrays: one intersection pass, no dict lookups
+    if isinstance(prefs, SortedRows):
+        return _sim_sorted_rows(prefs, p1, p2, sim_weighting, 'distance')
+
     # Get the list of shared_items
     si = {}
     for item in prefs[p1]:
@@ -299,6 +348,10 @@ def sim_pearson(prefs, p1, p2, sim_weighting=0):
 
     '''
 
+    # rows kept as sorted arrays: one intersection pass, no dict lookups
+    if isinstance(prefs, SortedRows):
+        return _sim_sorted_rows(prefs, p1, p2, sim_weighting, 'pearson')
+
     # Get the list of shared_items
     si = {}
     for item in prefs[p1]:
@@ -341,335 +394,1230 @@ def sim_pearson(prefs, p1, p2, sim_weighting=0):
         return 0
 
 
-def getRecommendations(prefs, person, similarity=sim_pearson):
-    ''' Calculates recommendations for a given user
+class SortedRows(Mapping):
+    ''' Read-only U-I matrix (prefs dictionary) that also keeps every row as
+        a sorted array of integer column ids and an array of ratings
 
-        Parameters:
-        -- prefs: dictionary containing user-item matrix
-        -- person: string containing name of user
-        -- similarity: function to calc similarity [sim_pearson is default]
+        It can be passed anywhere a prefs dictionary is read; sim_pearson()
+        and sim_distance() then intersect the two rows in a single pass.
+        It is a read-only Mapping, rows (and the rows' ratings) can't be
+        changed, that would leave the arrays stale; a copy.deepcopy() gives
+        back an ordinary, writable nested dictionary.
 
-        Returns:
-        -- A list of recommended items with 0 or more tuples,
-           each tuple contains (predicted rating, item name).
-           List is sorted, high to low, by predicted rating.
-           An empty list is returned when no recommendations have been calc'd.
+    '''
+
+    def __init__(self, prefs):
+        self.col_index = {}
+        for row in prefs:
+            for col in prefs[row]:
+                self.col_index.setdefault(col, len(self.col_index))
+        self.cols = list(self.col_index)
+
+        self.arrays = {}
+        self._rows = {}
+        for row in prefs:
+            ids = np.array([self.col_index[col] for col in prefs[row]], dtype=np.int64)
+            ratings = np.array(list(prefs[row].values()), dtype=np.float64)
+            order = np.argsort(ids)
+            self.arrays[row] = (ids[order], ratings[order])
+            self._rows[row] = MappingProxyType(dict(prefs[row]))
+
+    @classmethod
+    def from_arrays(cls, rows, cols, indptr, indices, ratings):
+        ''' SortedRows over CSR arrays (e.g. a rating store in shared memory),
+            without copying them; a row's dictionary is only built when the
+            row is read as a dictionary
+
+            Parameters:
+            -- rows, cols: lists mapping integer indexes to names
+            -- indptr, indices, ratings: CSR arrays, column ids sorted within
+                                         each row (as prefs_to_arrays() gives)
+
+            Returns:
+            -- A SortedRows
+        '''
+
+        self = cls.__new__(cls)
+        self.cols = cols
+        self.col_index = {col: i for i, col in enumerate(cols)}
+        self.arrays = {row: (indices[indptr[r]:indptr[r + 1]], ratings[indptr[r]:indptr[r + 1]])
+                       for r, row in enumerate(rows)}
+        self._rows = {}
+
+        return self
+
+    def __getitem__(self, row):
+        if row not in self._rows:
+            ids, ratings = self.arrays[row]
+            self._rows[row] = MappingProxyType(dict(zip([self.cols[i] for i in ids], ratings.tolist())))
+        return self._rows[row]
+
+    def __iter__(self):
+        return iter(self.arrays)
+
+    def __len__(self):
+        return len(self.arrays)
+
+    def __contains__(self, row):
+        return row in self.arrays
+
+    def __deepcopy__(self, memo):
+        return {row: dict(self[row]) for row in self}
+
+    def __reduce__(self):
+        return (SortedRows, ({row: dict(self[row]) for row in self},))
+
+
+class BitsetRows(Mapping):
+    ''' Read-only implicit-feedback U-I matrix: every interaction (watched,
+        clicked, ...) is a 1.0, and every row is also kept as a packed bit
+        array of column ids
+
+        It can be passed anywhere a prefs dictionary is read. The builders
+        calculate sim_jaccard and sim_cosine neighbors from the bit arrays
+        (AND plus popcount, see calculateSimilarBitset()), and the
+        recommenders rank by summed similarity, since every predicted
+        "rating" would be 1. Like SortedRows it is a read-only Mapping, so
+        the bit arrays can't go stale; a copy.deepcopy() gives another
+        BitsetRows.
 
     '''
 
-    totals = {}
-    simSums = {}
-    for other in prefs:
-      # don't compare me to myself
-        if other == person:
-            continue
-        sim = similarity(prefs, person, other)
+    implicit = True
+
+    def __init__(self, prefs, threshold=None):
+        ''' Parameters:
+            -- prefs: dictionary of interactions (or explicit ratings)
+            -- threshold: only ratings >= threshold count as interactions
+                          [default is None, every rating does]
+        '''
+
+        self.threshold = threshold
+        self.rows = []
+        self.col_index = {}
+        self._rows = {}
+        row_ids, col_ids = [], []
+        for row in prefs:
+            cols = [col for col in prefs[row] if threshold is None or prefs[row][col] >= threshold]
+            if len(cols) == 0:
+                continue
+            for col in cols:
+                self.col_index.setdefault(col, len(self.col_index))
+            row_ids += [len(self.rows)] * len(cols)
+            col_ids += [self.col_index[col] for col in cols]
+            self.rows.append(row)
+            self._rows[row] = MappingProxyType(dict.fromkeys(cols, 1.0))
 
-        # ignore scores of zero or lower
-        if sim <= 0:
-            continue
-        for item in prefs[other]:
+        self.row_index = dict([(row, r) for r, row in enumerate(self.rows)])
+        row_ids = np.array(row_ids, dtype=np.int64)
+        col_ids = np.array(col_ids, dtype=np.int64)
+        self.bits = np.zeros((len(self.rows), (len(self.col_index) + 63) // 64), dtype=np.uint64)
+        np.bitwise_or.at(self.bits, (row_ids, col_ids >> 6),
+                         np.left_shift(np.uint64(1), (col_ids & 63).astype(np.uint64)))
+        self.counts = np.bincount(row_ids, minlength=len(self.rows))
+        self._transposed = None
 
-            # only score movies I haven't seen yet
-            if item not in prefs[person] or prefs[person][item] == 0:
-                # Similarity * Score
-                totals.setdefault(item, 0)
-                totals[item] += prefs[other][item]*sim
-                # Sum of similarities
-                simSums.setdefault(item, 0)
-                simSums[item] += sim
+    def transposed(self):
+        ''' The item-user BitsetRows (built once) '''
 
-    # Create the normalized list
-    rankings = [(total/simSums[item], item) for item, total in totals.items()]
+        if self._transposed is None:
+            self._transposed = BitsetRows(transformPrefs(self))
+        return self._transposed
 
-    # Return the sorted list
-    rankings.sort()
-    rankings.reverse()
-    return rankings
+    def __getitem__(self, row):
+        return self._rows[row]
 
+    def __iter__(self):
+        return iter(self._rows)
 
-def getRecommendationSim(prefs, userMatch, user, sim_threshold=0):
-    ''' Returns user-based recommendations
+    def __len__(self):
+        return len(self._rows)
 
-        Parameters:
-        -- prefs: dictionary containing user-item matrix
-        -- userMatch: dictionary containing similarity matrix
-        -- user: string containing name of user
-        -- sim_threshold: minimum similarity to be considered a neighbor
-                          [default is >0]
+    def __contains__(self, row):
+        return row in self._rows
 
-        Returns:
-        -- A list of recommended items with 0 or more tuples,
-           each tuple contains (predicted rating, item name).
-           List is sorted, high to low, by predicted rating.
-           An empty list is returned when no recommendations have been calc'd.
+    def __deepcopy__(self, memo):
+        return BitsetRows({row: dict(self[row]) for row in self})
 
-    '''
+    def __reduce__(self):
+        return (BitsetRows, ({row: dict(self[row]) for row in self},))
 
-    toRec = set()  # set of items to recommend
-    recs = []
 
-    for other in userMatch[user]:  # other is a tuple (sim, user)
-        for item in prefs[other[1]]:
-            if item not in prefs[user] or prefs[user][item] == 0:  # unrated
-                toRec.add(item)
-
-    for item in toRec:
-        numerator, denominator = 0, 0
-        for other in userMatch[user]:
-            if item in prefs[other[1]]:  # Other has rated item
-                numerator += prefs[other[1]][item] * other[0]
-                denominator += other[0]
-        if denominator != 0:
-            recValue = numerator / denominator
-            if recValue > sim_threshold:
-                recs.append((recValue, item))
+class _ImplicitRows(dict):
+    ''' Writable copy of a BitsetRows' rows, for the leave-one-out loops:
+        the recommenders still rank it as implicit feedback (the builders
+        take the float path, it has no bit arrays) '''
 
-        toRec = set()
+    implicit = True
 
-    # Sort the list of tuples by highest to lowest ratings
-    recs = sorted(recs, key=lambda x: x[0], reverse=True)
-    
-    return recs
 
+def _popcount(words):
+    ''' Number of set bits of every uint64 '''
 
-def calc_all_users(prefs, method=sim_distance):
-    ''' Prints selected calculation for all users
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(words)
+    # numpy < 2.0: count the bits of each byte with a lookup table
+    table = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+    return table[words.view(np.uint8)].reshape(words.shape + (8,)).sum(axis=-1, dtype=np.uint8)
+
+
+def bitset_co_counts(bitrows, rows):
+    ''' Co-occurrence counts of the given rows against all rows of a
+        BitsetRows, as a (len(rows) x rows) array '''
+
+    words = np.ascontiguousarray(bitrows.bits.T)
+    mine = words[:, rows]
+    N = np.zeros((len(rows), words.shape[1]), dtype=np.int32)
+    both = np.empty((len(rows), words.shape[1]), dtype=np.uint64)
+    # one 64-bit word of every row at a time: small temporaries
+    for w in range(words.shape[0]):
+        np.bitwise_and(mine[w][:, None], words[w][None, :], out=both)
+        N += _popcount(both)
+
+    return N
+
+
+def _sim_sorted_rows(prefs, p1, p2, sim_weighting=0, kind='pearson'):
+    ''' Pearson or Euclidean similarity of two SortedRows rows
 
         Parameters:
-        -- prefs: dictionary containing user-item matrix
-        -- method: sim_distance, sim_pearson, or getRecommendations
-                   [sim_distance is default]
+        -- prefs: SortedRows U-I matrix
+        -- p1: string containing name of user 1
+        -- p2: string containing name of user 2
+        -- sim_weighting: similarity significance weighting factor (0, 25, 50)
+        -- kind: 'pearson' or 'distance'
 
         Returns:
-        -- None
+        -- The same similarity as sim_pearson() / sim_distance(), as a float
 
     '''
 
-    if method == getRecommendations:
-        for user in prefs:
-            print('Recommendations for {}:'.format(user))
-            print('User-based CF recs for {}, sim_pearson: '.format(user),
-                  getRecommendations(prefs, user))
-            print('User-based CF recs for {}, sim_distance: '.format(user),
-                  getRecommendations(prefs, user, similarity=sim_distance))
-            print()
-    else:
-        for u1 in prefs:
-            for u2 in prefs:
-                if u1 != u2:
-                    if method == sim_distance:
-                        print('Distance sim {} & {}: '.format(
-                            u1, u2), sim_distance(prefs, u1, u2))
-                    else:
-                        print('Pearson sim {} & {}: '.format(
-                            u1, u2), sim_pearson(prefs, u1, u2))
+    x_ids, x_ratings = prefs.arrays[p1]
+    y_ids, y_ratings = prefs.arrays[p2]
 
-    return
+    # merge-join of the two sorted id arrays
+    shared, ix, iy = np.intersect1d(x_ids, y_ids, assume_unique=True, return_indices=True)
+    n_shared = len(shared)
 
+    # if they have no ratings in common, return 0
+    if n_shared == 0:
+        return 0
 
-def loo_cv(prefs, metric, sim, algo):
-    ''' Leave_One_Out Evaluation: evaluates recommender system ACCURACY
+    x = x_ratings[ix]
+    y = y_ratings[iy]
 
-        Parameters:
-        -- prefs: dataset of critics, ml-100K, etc.
-        -- metric: MSE, MAE, RMSE, etc.
-        -- sim: distance, pearson, etc.
-        -- algo: user-based recommender, item-based recommender, etc.
+    if kind == 'distance':
+        diff = x - y
+        sim = 1/(1+sqrt(float(np.dot(diff, diff))))
+        return significance_weight(sim_distance, sim, n_shared, sim_weighting)
 
-        Returns:
-        -- error: MSE, MAE, RMSE totals for this set of conditions
-        -- error_list: list of actual-predicted differences
+    # pearson, using the averages of the shared ratings only
+    x = x - x.mean()
+    y = y - y.mean()
+    denominator = sqrt(float(np.dot(x, x))) * sqrt(float(np.dot(y, y)))
 
-    '''
+    # catch divide-by-0 errors
+    if denominator == 0:
+        return 0
 
-    error = 0
-    error_list = []
-    recs = []
+    return significance_weight(sim_pearson, float(np.dot(x, y)) / denominator, n_shared,
+                               sim_weighting)
 
-    ### UNCOMMENT FOR DEBUG PRINTS ###
-    # pred_found = False 
 
-    # Create a temp copy of prefs
-    prefs_cp = copy.deepcopy(prefs)
+def _column_means(prefs):
+    ''' Returns the mean rating of every column (e.g. user, for item rows) of prefs '''
 
-    # iterate through all ratings
-    for user in prefs:
-        for item in prefs[user]:
-            # remove a rating
-            removed_rating = prefs_cp[user].pop(item)
-            # get list of recommendations
-            recs = algo(prefs_cp, user, similarity=sim)
+    sums = {}
+    counts = {}
+    for row in prefs:
+        for col, rating in prefs[row].items():
+            sums[col] = sums.get(col, 0) + rating
+            counts[col] = counts.get(col, 0) + 1
 
-            # iterate through recommendations
-            for rec in recs:
-                # if this item is in the recommendations, calculate error
-                if item in rec:
-                    ### UNCOMMENT FOR DEBUG PRINTS ###
-                    # pred_found = True
-                    predicted_rating = rec[0]
-                    error_i = 0
-                    if metric == "MAE" or metric == "mae":
-                        error_i = abs(predicted_rating - removed_rating)
-                    else:
-                        error_i = (predicted_rating - removed_rating)**2
-                    error_list.append(error_i)
+    return {col: sums[col] / counts[col] for col in sums}
 
-            ### UNCOMMENT FOR DEBUG PRINTS [use w/ small datasets or implement a way to limit these] ###
-                    # print('User : {}, Item: {}, Prediction {}, Actual: {}, Error: {}'.format(
-                    #     user, item, predicted_rating, removed_rating, error_i))
-            # if pred_found == False:
-                # print('From loo_cv(), No prediction calculated for item {}, user {} in pred_list: {}'.format(
-                #     item, user, recs))
-                # pass
-            #pred_found = False
-            
-            # add the previously removed rating back
-            prefs_cp[user][item] = removed_rating
 
-    # average all errors (if RMSE, square root the average)
-    if metric == "RMSE" or metric == "rmse":
-        error = sqrt(np.average(error_list))
-    else:
-        error = np.average(error_list)
+# Column means of the prefs the builders are comparing rows of, by id(prefs)
+_COLUMN_MEANS = {}
 
-    return error, error_list
 
+@contextmanager
+def _cached_column_means(rowPrefs, similarity):
+    ''' Lets sim_adjusted_cosine() reuse the column means of rowPrefs while a
+        builder compares its rows (rowPrefs isn't changed meanwhile) '''
 
-def topMatches(prefs, person, similarity=sim_pearson, n=5, sim_weighting=0, sim_threshold=0):
-    ''' Returns the best matches for person from the prefs dictionary
+    if similarity != sim_adjusted_cosine:
+        yield
+        return
+    _COLUMN_MEANS[id(rowPrefs)] = _column_means(rowPrefs)
+    try:
+        yield
+    finally:
+        _COLUMN_MEANS.pop(id(rowPrefs), None)
+
+
+def sim_cosine(prefs, p1, p2, sim_weighting=0):
+    ''' Calculate Cosine similarity (unrated items count as 0)
 
         Parameters:
         -- prefs: dictionary containing user-item matrix
-        -- person: string containing name of user
-        -- similarity: function to calc similarity [sim_pearson is default]
-        -- n: number of matches to find/return [5 is default]
-        -- sim_weighting: similarity significance weighting factor (0, 25, 50) 
+        -- p1: string containing name of user 1
+        -- p2: string containing name of user 2
+        -- sim_weighting: similarity significance weighting factor (0, 25, 50)
                           [default is 0, which represents No Weighting]
 
         Returns:
-        -- A list of similar matches with 0 or more tuples,
-           each tuple contains (similarity, item name).
-           List is sorted, high to low, by similarity.
-           An empty list is returned when no matches have been calc'd.
+        -- Cosine similarity as a float
 
     '''
-    scores = []
 
-    # iterate through users in prefs
-    for other in prefs:
-        # calculate similarity score
-        score = similarity(prefs, person, other, sim_weighting)
-        # don't compare me to myself, accept scores above the threshold
-        if other != person and score > sim_threshold:
-            scores.append((score, other))
+    si = [item for item in prefs[p1] if item in prefs[p2]]
 
-    scores.sort()
-    scores.reverse()
-    return scores[0:n]
+    # if they have no ratings in common, return 0
+    if len(si) == 0:
+        return 0
 
+    numerator = sum([prefs[p1][item] * prefs[p2][item] for item in si])
+    denominator = sqrt(sum([r**2 for r in prefs[p1].values()])) * \
+        sqrt(sum([r**2 for r in prefs[p2].values()]))
 
-def transformPrefs(prefs):
-    ''' Transposes U-I matrix (prefs dictionary)
+    if denominator == 0:
+        return 0
+
+    return significance_weight(sim_cosine, numerator / denominator, len(si), sim_weighting)
+
+
+def sim_adjusted_cosine(prefs, p1, p2, sim_weighting=0):
+    ''' Calculate Adjusted Cosine similarity: cosine over the shared columns
+        after subtracting each column's mean rating (for item-item similarity,
+        each user's mean rating)
+
+        Called on its own it calculates the column means of prefs on every
+        call; the similarity matrix builders calculate them once per build.
 
         Parameters:
         -- prefs: dictionary containing user-item matrix
+        -- p1: string containing name of user 1
+        -- p2: string containing name of user 2
+        -- sim_weighting: similarity significance weighting factor (0, 25, 50)
+                          [default is 0, which represents No Weighting]
 
         Returns:
-        -- A transposed U-I matrix, i.e., if prefs was a U-I matrix,
-           this function returns an I-U matrix
+        -- Adjusted Cosine similarity as a float
 
     '''
 
-    result = {}
+    si = [item for item in prefs[p1] if item in prefs[p2]]
 
-    for person in prefs:
-        for item in prefs[person]:
-            result.setdefault(item, {})
-            # Flip item and person
-            result[item][person] = prefs[person][item]
-    
-    return result
+    # if they have no ratings in common, return 0
+    if len(si) == 0:
+        return 0
 
+    means = _COLUMN_MEANS.get(id(prefs))
+    if means is None:
+        means = _column_means(prefs)
+    x = [prefs[p1][item] - means[item] for item in si]
+    y = [prefs[p2][item] - means[item] for item in si]
 
-def calculateSimilarItems(prefs, n=100, similarity=sim_pearson, sim_weighting=0, sim_threshold=0):
-    ''' Creates a dictionary of items showing which other items they are most
-        similar to.
+    numerator = sum([a * b for a, b in zip(x, y)])
+    denominator = sqrt(sum([a**2 for a in x])) * sqrt(sum([b**2 for b in y]))
+
+    if denominator < 1e-9:
+        return 0
+
+    return significance_weight(sim_adjusted_cosine, numerator / denominator, len(si),
+                               sim_weighting)
+
+
+def sim_jaccard(prefs, p1, p2, sim_weighting=0):
+    ''' Calculate Jaccard similarity: shared ratings / all ratings of the pair
 
         Parameters:
         -- prefs: dictionary containing user-item matrix
-        -- n: number of similar matches for topMatches() to return
-        -- similarity: function to calc similarity (sim_pearson is default)
-        -- sim_weighting: similarity significance weighting factor (0, 25, 50), 
-                            default is 0 [None]
+        -- p1: string containing name of user 1
+        -- p2: string containing name of user 2
+        -- sim_weighting: similarity significance weighting factor (0, 25, 50)
+                          [default is 0, which represents No Weighting]
 
         Returns:
-        -- A dictionary with a similarity matrix
+        -- Jaccard similarity as a float
 
     '''
 
-    result = {}
-    c = 0
+    n_shared = len([item for item in prefs[p1] if item in prefs[p2]])
 
-    # Invert the preference matrix to be item-centric
-    itemPrefs = transformPrefs(prefs)
+    # if they have no ratings in common, return 0
+    if n_shared == 0:
+        return 0
 
-    for item in itemPrefs:
-      # Status updates for larger datasets
-        c += 1
-        if c % 100 == 0:
-            percent_complete = (100*c)/len(itemPrefs)
-            print(str(percent_complete)+"% complete")
-
-        # Find the most similar items to this one
-        scores = topMatches(itemPrefs, item, similarity, n,
-                            sim_weighting, sim_threshold)
-        result[item] = scores
-    return result
+    jaccard = n_shared / (len(prefs[p1]) + len(prefs[p2]) - n_shared)
 
+    return significance_weight(sim_jaccard, jaccard, n_shared, sim_weighting)
 
-def calculateSimilarUsers(prefs, n=100, similarity=sim_pearson, sim_weighting=0, sim_threshold=0):
-    ''' Creates a dictionary of users showing which other users they are most
-        similar to.
 
-        Parameters:
-        -- prefs: dictionary containing user-item matrix
-        -- n: number of similar matches for topMatches() to return
-        -- similarity: function to calc similarity (sim_pearson is default)
-        -- sim_weighting: similarity significance weighting factor (0, 25, 50), 
-                            default is 0 [None]
+def _dense(dense, key):
+    ''' Returns a derived matrix of a dense rating matrix, calculating it once '''
 
-        Returns:
-        -- A dictionary with a similarity matrix
+    if key not in dense:
+        R, M = dense['R'], dense['M']
+        if key == 'R2':
+            dense[key] = R * R
+        elif key == 'Rc':
+            col_means = R.sum(axis=0) / np.maximum(M.sum(axis=0), 1)
+            dense[key] = (R - col_means) * M
+        elif key == 'Rc2':
+            dense[key] = _dense(dense, 'Rc')**2
 
-    '''
+    return dense[key]
 
-    result = {}
-    c = 0
 
-    for user in prefs:
-      # Status updates for larger datasets
-        c += 1
-        if c % 100 == 0:
-            percent_complete = (100*c)/len(prefs)
-            print(str(percent_complete)+"% complete")
+def _block_pearson(dense, rows):
+    ''' Batched Pearson correlation of rows against all rows, using the means
+        of the shared columns only (same as sim_pearson) '''
 
-        # Find the most similar items to this one
-        scores = topMatches(prefs, user, similarity, n,
-                            sim_weighting, sim_threshold)
-        result[user] = scores
+    R, M, R2 = dense['R'], dense['M'], _dense(dense, 'R2')
+    N = M[rows] @ M.T
+    n = np.maximum(N, 1)
+    Sx = R[rows] @ M.T
+    Sy = M[rows] @ R.T
+    Sxy = R[rows] @ R.T
+    var_x = (R2[rows] @ M.T) - Sx**2 / n
+    var_y = (M[rows] @ R2.T) - Sy**2 / n
 
-    return result
+    # zero variance (e.g. one shared rating) gives 0, as in sim_pearson
+    var_x[var_x < 1e-9] = 0
+    var_y[var_y < 1e-9] = 0
+    denominator = np.sqrt(var_x) * np.sqrt(var_y)
+    S = np.where(denominator > 0, (Sxy - Sx * Sy / n) / np.where(denominator > 0, denominator, 1), 0)
 
+    return S, N
 
-def getRecommendedItems(prefs, itemMatch, user, sim_threshold=0):
-    ''' Calculates recommendations for a given user
+
+def _block_distance(dense, rows):
+    ''' Batched Euclidean distance similarity over the shared columns '''
+
+    R, M, R2 = dense['R'], dense['M'], _dense(dense, 'R2')
+    N = M[rows] @ M.T
+    SS = (R2[rows] @ M.T) + (M[rows] @ R2.T) - 2 * (R[rows] @ R.T)
+    S = np.where(N > 0, 1 / (1 + np.sqrt(np.maximum(SS, 0))), 0)
+
+    return S, N
+
+
+def _block_cosine(dense, rows):
+    ''' Batched Cosine similarity (unrated columns count as 0) '''
+
+    R, M, R2 = dense['R'], dense['M'], _dense(dense, 'R2')
+    N = M[rows] @ M.T
+    norms = np.sqrt(R2.sum(axis=1))
+    denominator = norms[rows][:, None] * norms[None, :]
+    S = np.where((N > 0) & (denominator > 0),
+                 (R[rows] @ R.T) / np.where(denominator > 0, denominator, 1), 0)
+
+    return S, N
+
+
+def _block_adjusted_cosine(dense, rows):
+    ''' Batched Adjusted Cosine similarity over the shared columns '''
+
+    M, Rc, Rc2 = dense['M'], _dense(dense, 'Rc'), _dense(dense, 'Rc2')
+    N = M[rows] @ M.T
+    var_x = Rc2[rows] @ M.T
+    var_y = M[rows] @ Rc2.T
+    var_x[var_x < 1e-9] = 0
+    var_y[var_y < 1e-9] = 0
+    denominator = np.sqrt(var_x) * np.sqrt(var_y)
+    S = np.where(denominator > 0, (Rc[rows] @ Rc.T) / np.where(denominator > 0, denominator, 1), 0)
+
+    return S, N
+
+
+def _block_jaccard(dense, rows):
+    ''' Batched Jaccard similarity '''
+
+    M = dense['M']
+    N = M[rows] @ M.T
+    counts = M.sum(axis=1)
+    union = counts[rows][:, None] + counts[None, :] - N
+    S = np.where(N > 0, N / np.where(union > 0, union, 1), 0)
+
+    return S, N
+
+
+# Registry of similarity methods, by function name:
+# -- label: name used in printouts
+# -- pair: per-pair reference function, similarity(prefs, p1, p2, sim_weighting)
+# -- block: batched kernel(dense, rows) -> (unweighted similarities, co-counts)
+#           of the given rows against all rows of a dense rating matrix
+# -- weighting: 'linear' scales by n/sim_weighting, 'capped' only scales down
+#               pairs with fewer than sim_weighting co-ratings
+# -- max: largest unweighted value, used for threshold pruning
+SIMILARITIES = {}
+
+
+def register_similarity(pair, block=None, label=None, weighting='capped', max_value=1.0):
+    ''' Adds a similarity method to the registry
+
+        Parameters:
+        -- pair: per-pair function, similarity(prefs, p1, p2, sim_weighting=0)
+        -- block: batched kernel(dense, rows) [optional, without it the
+                  builders fall back to calling pair for every pair]
+        -- label: name used in printouts [default is the function name]
+        -- weighting: significance weighting rule, 'linear' or 'capped'
+        -- max_value: largest possible unweighted similarity [1.0 is default]
+
+        Returns:
+        -- The registry entry
+
+    '''
+
+    entry = {'name': pair.__name__, 'label': label or pair.__name__, 'pair': pair,
+             'block': block, 'weighting': weighting, 'max': max_value}
+    SIMILARITIES[pair.__name__] = entry
+
+    return entry
+
+
+def get_similarity(similarity):
+    ''' Returns the registry entry of a similarity function or name (or None) '''
+
+    if isinstance(similarity, str):
+        return SIMILARITIES.get(similarity)
+    entry = SIMILARITIES.get(getattr(similarity, '__name__', None))
+    if entry is not None and entry['pair'] is similarity:
+        return entry
+
+    return None
+
+
+register_similarity(sim_distance, _block_distance, 'Distance', weighting='capped')
+register_similarity(sim_pearson, _block_pearson, 'Pearson', weighting='linear')
+register_similarity(sim_cosine, _block_cosine, 'Cosine')
+register_similarity(sim_adjusted_cosine, _block_adjusted_cosine, 'Adjusted cosine')
+register_similarity(sim_jaccard, _block_jaccard, 'Jaccard')
+
+
+# Sim/Simu sub-command codes of the other registered similarity methods
+SIM_SUBCOMMANDS = {'C': 'sim_cosine', 'AC': 'sim_adjusted_cosine', 'J': 'sim_jaccard'}
+
+
+def calculateSimilarBatched(rowPrefs, n=100, similarity=sim_pearson, sim_weighting=0,
+                            sim_threshold=0, min_overlap=1, block_size=256, store=None):
+    ''' Calculates a similarity matrix with a registered batched kernel
+
+        The kernel returns unweighted similarities and co-counts for a block
+        of rows at a time; significance weighting, the threshold, the minimum
+        overlap and the top-n cut are then applied the same way for every
+        similarity method.
+
+        Parameters:
+        -- rowPrefs: dictionary whose rows are compared (prefs for a user-user
+                     matrix, transformPrefs(prefs) for an item-item matrix)
+        -- n: number of similar matches to keep per row [100 is default]
+        -- similarity: registered similarity function (sim_pearson is default)
+        -- sim_weighting: similarity significance weighting factor (0, 25, 50)
+        -- sim_threshold: minimum similarity to be considered a neighbor
+        -- min_overlap: minimum number of co-ratings [1 is default]
+        -- block_size: number of rows calculated at once [256 is default]
+        -- store: prefs_to_arrays(rowPrefs), if already built [optional]
+
+        Returns:
+        -- A dictionary with a similarity matrix, same format as topMatches()
+           per row: (similarity, name) tuples sorted high to low
+
+    '''
+
+    entry = get_similarity(similarity)
+    rows, dense = _dense_rows(rowPrefs, store)
+    n_rows = len(rows)
+
+    result = {}
+    for start in range(0, n_rows, block_size):
+        block = np.arange(start, min(start + block_size, n_rows))
+        result.update(_batched_top_matches(entry, dense, rows, block, n, sim_weighting,
+                                           sim_threshold, min_overlap))
+
+        # Status updates for larger datasets
+        print(str((100*block[-1] + 100)/n_rows)+"% complete")
+
+    return result
+
+
+def _batched_block_size(n_rows, n_cols, block_size=256):
+    ''' Largest block size (up to block_size) whose dense n_rows x n_cols
+        matrices fit the memory budget; None if even the smallest blocks don't
+        fit and the policy is 'degrade' (the row-at-a-time builders are used
+        instead) '''
+
+    # R, M and up to two derived matrices; about a dozen block x rows temporaries
+    dense_bytes = 4 * 8 * n_rows * n_cols
+    block_bytes = 12 * 8 * n_rows
+
+    budget = MEMORY_BUDGET['bytes']
+    if budget is not None and MEMORY_BUDGET['policy'] == 'degrade':
+        room = budget - _rss_bytes() - dense_bytes
+        if room >= block_bytes * min(block_size, 16):
+            return int(min(block_size, room // block_bytes))
+    if not check_memory_budget(dense_bytes + block_bytes * min(block_size, n_rows),
+                               'batched similarity (%d x %d dense)' % (n_rows, n_cols)):
+        return None
+    return block_size
+
+
+def calculateSimilarBitset(bitrows, n=100, similarity=sim_jaccard, sim_weighting=0, sim_threshold=0,
+                           min_overlap=1, block_size=256):
+    ''' Calculates a sim_jaccard or sim_cosine similarity matrix of implicit
+        feedback rows from their packed bit arrays
+
+        Parameters:
+        -- bitrows: BitsetRows whose rows are compared (the prefs for a user-user
+                    matrix, bitrows.transposed() for an item-item matrix)
+        -- n: number of similar matches to keep per row [100 is default]
+        -- similarity: sim_jaccard (default) or sim_cosine
+        -- sim_weighting: similarity significance weighting factor (0, 25, 50)
+        -- sim_threshold: minimum similarity to be considered a neighbor
+        -- min_overlap: minimum number of co-occurrences [1 is default]
+        -- block_size: number of rows calculated at once [256 is default]
+
+        Returns:
+        -- A dictionary with a similarity matrix, same format as topMatches()
+           per row: (similarity, name) tuples sorted high to low
+
+    '''
+
+    counts = bitrows.counts.astype(np.float64)
+
+    def kernel(dense, rows):
+        N = bitset_co_counts(bitrows, rows)
+        if similarity == sim_cosine:
+            S = N / np.sqrt(counts[rows][:, None] * counts[None, :])
+        else:
+            S = N / (counts[rows][:, None] + counts[None, :] - N)
+        return S, N
+
+    # same weighting, threshold and top-n cut as the batched builders
+    entry = dict(get_similarity(similarity), block=kernel)
+    result = {}
+    for start in range(0, len(bitrows.rows), block_size):
+        block = np.arange(start, min(start + block_size, len(bitrows.rows)))
+        result.update(_batched_top_matches(entry, None, bitrows.rows, block, n, sim_weighting,
+                                           sim_threshold, min_overlap))
+
+        # Status updates for larger datasets
+        print(str((100*block[-1] + 100)/len(bitrows.rows))+"% complete")
+
+    return result
+
+
+def benchmark_implicit(prefs, threshold=None, n=100, similarity=sim_jaccard, sim_weighting=0):
+    ''' Compares the packed bit array item-item build with the float paths
+        on the same implicit feedback
 
         Parameters:
         -- prefs: dictionary containing user-item matrix
-        -- itemMatch: dictionary containing similarity matrix
+        -- threshold: only ratings >= threshold count as interactions
+        -- n: number of neighbors per item [100 is default]
+        -- similarity: sim_jaccard (default) or sim_cosine
+        -- sim_weighting: similarity significance weighting factor (0, 25, 50)
+
+        Returns:
+        -- A list of dictionaries (path, seconds, bytes, overlap), bytes being
+           the size of the matrix the path compares rows with and overlap
+           the average fraction of a row's bitset neighbors it found
+
+    '''
+
+    bitrows = BitsetRows(prefs, threshold)
+    itemPrefs = {item: dict(ratings) for item, ratings in transformPrefs(bitrows).items()}
+
+    results = []
+    runs = [('bitset', lambda: calculateSimilarBitset(bitrows.transposed(), n, similarity, sim_weighting),
+             lambda: bitrows.transposed().bits.nbytes),
+            ('batched float', lambda: calculateSimilarBatched(itemPrefs, n, similarity, sim_weighting),
+             lambda: 2 * 8 * len(itemPrefs) * len(bitrows)),
+            ('dictionary', lambda: calculateSimilarItems(transformPrefs(itemPrefs), n, similarity,
+                                                         sim_weighting, batched=False),
+             lambda: deep_sizeof(itemPrefs))]
+    for (path, build, size) in runs:
+        t = time.time()
+        matrix = build()
+        seconds = time.time() - t
+        if path == 'bitset':
+            exact = matrix
+        overlaps = []
+        for row in exact:
+            if len(exact[row]) > 0:
+                found = set([other for (sim, other) in matrix.get(row, [])])
+                overlaps.append(len([other for (sim, other) in exact[row] if other in found]) /
+                                len(exact[row]))
+        results.append({'path': path, 'seconds': seconds, 'bytes': size(),
+                        'overlap': float(np.average(overlaps)) if len(overlaps) > 0 else float('nan')})
+
+    print('%d users, %d items, %d interactions' % (len(bitrows), len(itemPrefs), int(bitrows.counts.sum())))
+    print('Path'.ljust(16) + 'Secs'.ljust(10) + 'Bytes'.ljust(14) + 'Overlap@%d' % n)
+    for result in results:
+        print(result['path'].ljust(16) + ('%.2f' % result['seconds']).ljust(10) +
+              str(result['bytes']).ljust(14) + '%.4f' % result['overlap'])
+
+    return results
+
+
+def _dense_rows(rowPrefs, store=None):
+    ''' Returns the row names and the dense rating matrix (0 = not rated) and
+        its 0/1 mask, as used by the batched kernels; store is
+        prefs_to_arrays(rowPrefs), if already built '''
+
+    if store is None:
+        store = prefs_to_arrays(rowPrefs)
+    rows = store['users']
+    n_rows, n_cols = len(rows), len(store['items'])
+
+    R = np.zeros((n_rows, n_cols))
+    row_of = np.repeat(np.arange(n_rows), np.diff(store['indptr']))
+    R[row_of, store['indices']] = store['ratings']
+    M = np.zeros((n_rows, n_cols))
+    M[row_of, store['indices']] = 1
+
+    return rows, {'R': R, 'M': M}
+
+
+def _batched_top_matches(entry, dense, rows, block, n, sim_weighting, sim_threshold, min_overlap):
+    ''' Top-n matches of a block of row indices with a registered kernel,
+        as a dictionary of topMatches() lists '''
+
+    S, N = entry['block'](dense, block)
+
+    # significance weighting, applied the same way for every kernel
+    if sim_weighting != 0:
+        factor = N / sim_weighting
+        if entry['weighting'] == 'capped':
+            factor = np.minimum(factor, 1)
+        S = S * factor
+
+    valid = (N >= max(min_overlap, 1)) & (np.round(S, SIM_DIGITS) > sim_threshold)
+    valid[np.arange(len(block)), block] = False  # don't compare me to myself
+
+    result = {}
+    for r, row in enumerate(block):
+        cols = np.nonzero(valid[r])[0]
+        values = S[r, cols]
+        # keep everything (about) tied with the n-th best; the kernels' sums
+        # differ from the per-pair ones in the last bits, so the scores are
+        # rounded to SIM_DIGITS and ties are settled by name
+        if len(cols) > n:
+            kth = np.partition(values, len(values) - n)[len(values) - n]
+            keep = values >= kth - 1e-9
+            cols, values = cols[keep], values[keep]
+        scores = [(round(float(v), SIM_DIGITS), rows[c]) for v, c in zip(values, cols)]
+        scores.sort()
+        scores.reverse()
+        result[rows[row]] = scores[0:n]
+
+    return result
+
+
+class LazyNeighbors(Mapping):
+    ''' Similarity matrix whose rows are calculated the first time they are
+        read, instead of all up front
+
+        It can be passed as the userMatch of getRecommendationSim() or the
+        itemMatch of getRecommendedItems(); every row holds the same list
+        calculateSimilarUsers() / calculateSimilarItems() would give it.
+        At most capacity rows are kept, the least recently used row is
+        evicted first. prefetch() calculates rows in a background thread
+        pool, a block of rows at a time when the similarity has a batched
+        kernel.
+
+    '''
+
+    def __init__(self, rowPrefs, n=100, similarity=sim_pearson, sim_weighting=0, sim_threshold=0,
+                 min_overlap=1, capacity=1000, n_threads=2, block_size=64):
+        ''' Parameters:
+            -- rowPrefs: dictionary whose rows are compared (prefs for
+                         user neighbors, transformPrefs(prefs) for item neighbors)
+            -- n, similarity, sim_weighting, sim_threshold, min_overlap:
+                         as in calculateSimilarBatched()
+            -- capacity: max number of rows kept [1000 is default]
+            -- n_threads: number of prefetch threads [2 is default]
+            -- block_size: max rows calculated together by a prefetch task
+        '''
+
+        self.n = n
+        self.similarity = similarity
+        self.sim_weighting = sim_weighting
+        self.sim_threshold = sim_threshold
+        self.min_overlap = min_overlap
+        self.capacity = capacity
+        self.block_size = block_size
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(n_threads)
+        self.stats = {'hits': 0, 'misses': 0, 'prefetched': 0, 'evictions': 0}
+        self.refresh(rowPrefs)
+
+    def refresh(self, rowPrefs):
+        ''' Switches to new ratings: drops every calculated row '''
+
+        with self.lock:
+            self.rowPrefs = rowPrefs
+            self.cache = OrderedDict()
+            self.pending = {}  # row -> prefetch future
+            self.dense = None  # built by the first batched calculation
+            self.generation = getattr(self, 'generation', 0) + 1
+
+    def _calculate(self, rows):
+        ''' Calculates the rows (without touching the cache) '''
+
+        entry = get_similarity(self.similarity)
+        if entry is None or entry['block'] is None:
+            return dict([(row, topMatches(self.rowPrefs, row, self.similarity, self.n,
+                                          self.sim_weighting, self.sim_threshold))
+                         for row in rows])
+
+        with self.lock:
+            if self.dense is None:
+                names, dense = _dense_rows(self.rowPrefs)
+                self.dense = (names, dict([(name, i) for i, name in enumerate(names)]), dense)
+            names, position, dense = self.dense
+        return _batched_top_matches(entry, dense, names, np.array([position[row] for row in rows]),
+                                    self.n, self.sim_weighting, self.sim_threshold, self.min_overlap)
+
+    def _store(self, results, generation):
+        ''' Adds calculated rows to the cache, evicting the least recently used '''
+
+        with self.lock:
+            if generation != self.generation:
+                return  # calculated from ratings that have been replaced
+            for row, scores in results.items():
+                self.cache[row] = scores
+                self.cache.move_to_end(row)
+                self.pending.pop(row, None)
+            while len(self.cache) > self.capacity:
+                self.cache.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def __getitem__(self, row):
+        with self.lock:
+            if row in self.cache:
+                self.cache.move_to_end(row)
+                self.stats['hits'] += 1
+                return self.cache[row]
+            future = self.pending.get(row)
+            generation = self.generation
+        if row not in self.rowPrefs:
+            raise KeyError(row)
+
+        # being prefetched: wait for it rather than calculating it twice
+        if future is not None:
+            results = future.result()
+            if row in results:
+                with self.lock:
+                    self.stats['hits'] += 1
+                return results[row]
+
+        results = self._calculate([row])
+        with self.lock:
+            self.stats['misses'] += 1
+        self._store(results, generation)
+        return results[row]
+
+    def __contains__(self, row):
+        return row in self.rowPrefs
+
+    def __iter__(self):
+        return iter(self.rowPrefs)
+
+    def __len__(self):
+        return len(self.rowPrefs)
+
+    def _prefetch_task(self, rows, generation):
+        results = self._calculate(rows)
+        self._store(results, generation)
+        with self.lock:
+            self.stats['prefetched'] += len(results)
+        return results
+
+    def prefetch(self, rows):
+        ''' Calculates rows that aren't cached or pending in the background
+
+            Parameters:
+            -- rows: rows expected to be read soon, most likely first
+
+            Returns:
+            -- A list of futures, one per block of rows submitted
+
+        '''
+
+        with self.lock:
+            todo = []
+            for row in rows:
+                if row in self.rowPrefs and row not in self.cache and row not in self.pending \
+                        and row not in todo:
+                    todo.append(row)
+            todo = todo[0:self.capacity]  # more would evict each other
+            futures = []
+            for start in range(0, len(todo), self.block_size):
+                block = todo[start:start + self.block_size]
+                future = self.executor.submit(self._prefetch_task, block, self.generation)
+                for row in block:
+                    self.pending[row] = future
+                futures.append(future)
+
+        return futures
+
+    def close(self):
+        ''' Stops the prefetch threads '''
+
+        self.executor.shutdown(wait=True)
+
+
+def predict_active_users(events, n=100, now=None, half_life=7 * 24 * 3600):
+    ''' Ranks users by recency-weighted activity, to choose what to prefetch
+
+        Parameters:
+        -- events: list of (timestamp, user, item, rating) from from_file_to_events()
+        -- n: number of users returned [100 is default]
+        -- now: timestamp the activity is measured at [default is the last event]
+        -- half_life: seconds after which a rating counts half [one week]
+
+        Returns:
+        -- A list of the n most active users, most active first
+
+    '''
+
+    if len(events) == 0:
+        return []
+    if now is None:
+        now = max([event[0] for event in events])
+
+    activity = {}
+    for (ts, user, item, rating) in events:
+        activity[user] = activity.get(user, 0) + 0.5 ** ((now - ts) / half_life)
+
+    return sorted(activity, key=lambda user: activity[user], reverse=True)[0:n]
+
+
+def _csr_matmul(indptr, indices, values, X, block_nnz=None):
+    ''' Product of a CSR matrix with a dense matrix X, accumulated a block
+        of rows (about block_nnz ratings) at a time, so the temporary
+        nnz x width products stay small '''
+
+    n_rows = len(indptr) - 1
+    if block_nnz is None:
+        block_nnz = max(1, (1 << 20) // max(X.shape[1], 1))
+    products = np.zeros((n_rows, X.shape[1]))
+    start = 0
+    while start < n_rows:
+        stop = int(np.searchsorted(indptr, indptr[start] + block_nnz, side='right')) - 1
+        stop = min(max(stop, start + 1), n_rows)
+        lo, hi = indptr[start], indptr[stop]
+        nonempty = np.diff(indptr[start:stop + 1]) > 0
+        if nonempty.any():
+            products[start:stop][nonempty] = np.add.reduceat(
+                values[lo:hi, None] * X[indices[lo:hi]], indptr[start:stop][nonempty] - lo, axis=0)
+        start = stop
+    return products
+
+
+def randomized_svd(rowPrefs, k=50, oversample=10, power_iters=2, seed=0, order='file'):
+    ''' Projects mean-centered rows into a k-dimensional latent space with a
+        randomized truncated SVD (Halko, Martinsson and Tropp 2011)
+
+        The rows' ratings minus the row mean form a sparse matrix A (unrated
+        = 0); A is only used in sparse products with thin dense matrices.
+
+        Parameters:
+        -- rowPrefs: dictionary whose rows are projected (prefs for users,
+                     transformPrefs(prefs) for items)
+        -- k: number of latent dimensions [50 is default]
+        -- oversample: extra random directions for accuracy [10 is default]
+        -- power_iters: power iterations, sharpen the spectrum [2 is default]
+        -- seed: random seed [0 is default]
+        -- order: id order of the rows and columns, see id_order() ['file']
+
+        Returns:
+        -- rows: list of row names
+        -- embedding: (rows x k) array, U_k * S_k
+
+    '''
+
+    store = prefs_to_arrays(rowPrefs, order)
+    rows = store['users']
+    n_rows, n_cols = len(rows), len(store['items'])
+    counts = np.diff(store['indptr'])
+    means = np.add.reduceat(store['ratings'], store['indptr'][:-1][counts > 0]) / counts[counts > 0]
+    row_means = np.zeros(n_rows)
+    row_means[counts > 0] = means
+
+    values = store['ratings'] - np.repeat(row_means, counts)
+    col_values = store['item_ratings'] - row_means[store['item_indices']]
+
+    def A(X):
+        return _csr_matmul(store['indptr'], store['indices'], values, X)
+
+    def At(Y):
+        return _csr_matmul(store['item_indptr'], store['item_indices'], col_values, Y)
+
+    rng = np.random.default_rng(seed)
+    width = min(k + oversample, n_rows, n_cols)
+    Q, r = np.linalg.qr(A(rng.normal(size=(n_cols, width))))
+    for i in range(power_iters):
+        Q, r = np.linalg.qr(At(Q))
+        Q, r = np.linalg.qr(A(Q))
+
+    # small SVD of B = Q^T A
+    Ub, S, Vt = np.linalg.svd(At(Q).T, full_matrices=False)
+    k = min(k, width)
+
+    return rows, (Q @ Ub[:, 0:k]) * S[0:k]
+
+
+def calculateSimilarLatent(rowPrefs, n=100, similarity=sim_pearson, sim_weighting=0, sim_threshold=0,
+                           k=50, rescore=True, n_candidates=None, metric=None, block_size=256, seed=0,
+                           order='file'):
+    ''' Approximate similarity matrix from a nearest-neighbor search in a
+        latent space
+
+        Rows are projected with randomized_svd(); the candidates of each row
+        are the rows with the highest latent cosine (or dot product) there,
+        found with blocked dense products. With rescore the candidates are
+        then scored with the exact similarity, otherwise the latent score is
+        the similarity.
+
+        Parameters:
+        -- rowPrefs: dictionary whose rows are compared (prefs for a user-user
+                     matrix, transformPrefs(prefs) for an item-item matrix)
+        -- n: number of similar matches to keep per row [100 is default]
+        -- similarity: function used to re-score the candidates [sim_pearson]
+        -- sim_weighting: similarity significance weighting factor (0, 25, 50)
+        -- sim_threshold: minimum similarity to be considered a neighbor
+        -- k: number of latent dimensions [50 is default]
+        -- rescore: re-score the candidates exactly [True is default]
+        -- n_candidates: candidates per row [default is 2 * n with rescore, n without]
+        -- metric: 'cosine' or 'dot'; the dot product also grows with the
+                   number of ratings, like significance weighting does
+                   [default is 'dot' with sim_weighting, 'cosine' without]
+        -- block_size: number of rows searched at once [256 is default]
+        -- seed: random seed of the SVD
+        -- order: id order of the SVD, see id_order() ['file' is default]
+
+        Returns:
+        -- A dictionary with a similarity matrix, same format as topMatches()
+           per row: (similarity, name) tuples sorted high to low
+
+    '''
+
+    rows, embedding = randomized_svd(rowPrefs, k, seed=seed, order=order)
+    if metric is None:
+        metric = 'dot' if sim_weighting != 0 else 'cosine'
+    if metric == 'cosine':
+        norms = np.linalg.norm(embedding, axis=1)
+        embedding = embedding / np.where(norms > 0, norms, 1)[:, None]
+    n_rows = len(rows)
+    if n_candidates is None:
+        n_candidates = 2 * n if rescore else n
+    n_candidates = min(n_candidates, n_rows - 1)
+
+    result = {}
+    for start in range(0, n_rows, block_size):
+        block = np.arange(start, min(start + block_size, n_rows))
+        S = embedding[block] @ embedding.T
+        S[np.arange(len(block)), block] = -np.inf  # don't compare me to myself
+        if n_candidates <= 0:
+            top = np.zeros((len(block), 0), dtype=np.int64)
+        else:
+            top = np.argpartition(-S, n_candidates - 1, axis=1)[:, 0:n_candidates]
+
+        for r, row in enumerate(block):
+            if rescore:
+                scores = [(similarity(rowPrefs, rows[row], rows[c], sim_weighting), rows[c])
+                          for c in top[r]]
+            else:
+                scores = [(float(S[r, c]), rows[c]) for c in top[r]]
+            scores = [score for score in scores if round(score[0], SIM_DIGITS) > sim_threshold]
+            scores.sort()
+            scores.reverse()
+            result[rows[row]] = scores[0:n]
+
+        # Status updates for larger datasets
+        print(str((100*block[-1] + 100)/n_rows)+"% complete")
+
+    return result
+
+
+def benchmark_latent(prefs, rows='items', ks=(10, 50), n=100, similarity=sim_pearson,
+                     sim_weighting=0, candidate_factors=(1, 2, 4)):
+    ''' Compares latent-space neighbor search with the exact similarity matrix
+
+        Parameters:
+        -- prefs: dictionary containing user-item matrix
+        -- rows: 'items' or 'users' ['items' is default]
+        -- ks: latent dimensions to try
+        -- n: number of neighbors per row [100 is default]
+        -- similarity: similarity of the exact matrix (and re-scoring)
+        -- sim_weighting: similarity significance weighting factor (0, 25, 50)
+        -- candidate_factors: candidates per row, as multiples of n, tried
+                              with re-scoring
+
+        Returns:
+        -- A list of dictionaries (k, candidates, rescore, seconds, overlap),
+           overlap being the average fraction of a row's exact neighbors
+           that were found; the first one (k None) is the exact build
+
+    '''
+
+    rowPrefs = transformPrefs(prefs) if rows == 'items' else prefs
+
+    t = time.time()
+    if rows == 'items':
+        exact = calculateSimilarItems(prefs, n, similarity, sim_weighting, batched=True)
+    else:
+        exact = calculateSimilarUsers(prefs, n, similarity, sim_weighting, batched=True)
+    results = [{'k': None, 'candidates': None, 'rescore': None, 'seconds': time.time() - t,
+                'overlap': 1.0}]
+
+    runs = [(k, n, False) for k in ks] + [(k, factor * n, True) for k in ks for factor in candidate_factors]
+    for (k, n_candidates, rescore) in runs:
+        t = time.time()
+        approx = calculateSimilarLatent(rowPrefs, n, similarity, sim_weighting, k=k, rescore=rescore,
+                                        n_candidates=n_candidates)
+        seconds = time.time() - t
+        overlaps = []
+        for row in exact:
+            if len(exact[row]) > 0:
+                found = set([other for (sim, other) in approx.get(row, [])])
+                overlaps.append(len([other for (sim, other) in exact[row] if other in found]) /
+                                len(exact[row]))
+        results.append({'k': k, 'candidates': n_candidates, 'rescore': rescore, 'seconds': seconds,
+                        'overlap': float(np.average(overlaps)) if len(overlaps) > 0 else float('nan')})
+
+    print('k'.ljust(8) + 'Candidates'.ljust(12) + 'Rescore'.ljust(10) + 'Secs'.ljust(10) + 'Overlap@%d' % n)
+    for result in results:
+        print(str(result['k'] or 'exact').ljust(8) + str(result['candidates'] or '-').ljust(12) +
+              str(result['rescore'] if result['k'] else '-').ljust(10) +
+              ('%.2f' % result['seconds']).ljust(10) + '%.4f' % result['overlap'])
+
+    return results
+
+
+def getPredictedRating(prefs, person, item, similarity=sim_pearson, item_index=None):
+    ''' Predicts one rating with user-based CF, without scoring other items
+
+        Same prediction getRecommendations() makes for this item.
+
+        Parameters:
+        -- prefs: dictionary containing user-item matrix
+        -- person: string containing name of user
+        -- item: string containing name of item
+        -- similarity: function to calc similarity [sim_pearson is default]
+        -- item_index: inverted index returned by build_item_index(); when
+                       given, only the raters of item are visited
+
+        Returns:
+        -- The predicted rating as a float, or None if it can't be calc'd
+
+    '''
+
+    if item_index is not None:
+        others = sorted(item_index['raters'].get(item, ()),
+                        key=lambda other: item_index['order'][other])
+    else:
+        others = [other for other in prefs if item in prefs[other]]
+
+    total = 0
+    simSum = 0
+    for other in others:
+        if other == person or person not in prefs:
+            continue
+        sim = similarity(prefs, person, other)
+
+        # ignore scores of zero or lower (rounded, as in topMatches())
+        if round(sim, SIM_DIGITS) <= 0:
+            continue
+        total += prefs[other][item]*sim
+        simSum += sim
+
+    if simSum == 0:
+        return None
+
+    return total/simSum
+
+
+def build_item_index(prefs):
+    ''' Builds an inverted index from each item to the users who rated it
+
+        Parameters:
+        -- prefs: dictionary containing user-item matrix
+
+        Returns:
+        -- A dictionary with raters (item -> set of users) and order
+           (user -> position in prefs, used to visit users in prefs order)
+
+    '''
+
+    index = {'raters': {}, 'order': {}}
+    for user in prefs:
+        index['order'][user] = len(index['order'])
+        for item in prefs[user]:
+            index['raters'].setdefault(item, set())
+            index['raters'][item].add(user)
+
+    return index
+
+
+def add_rating(prefs, index, user, item, rating):
+    ''' Adds (or changes) a rating, keeping the inverted item index up to date
+
+        Parameters:
+        -- prefs: dictionary containing user-item matrix
+        -- index: inverted index returned by build_item_index()
         -- user: string containing name of user
-        -- sim_threshold: minimum similarity to be considered a neighbor, default is >0
+        -- item: string containing name of item
+        -- rating: the rating as a float
+
+        Returns:
+        -- None
+
+    '''
+
+    prefs.setdefault(user, {})
+    prefs[user][item] = rating
+    index['order'].setdefault(user, len(index['order']))
+    index['raters'].setdefault(item, set())
+    index['raters'][item].add(user)
+
+    return
+
+
+def remove_rating(prefs, index, user, item):
+    ''' Removes a rating, keeping the inverted item index up to date
+
+        Parameters:
+        -- prefs: dictionary containing user-item matrix
+        -- index: inverted index returned by build_item_index()
+        -- user: string containing name of user
+        -- item: string containing name of item
+
+        Returns:
+        -- The removed rating
+
+    '''
+
+    rating = prefs[user].pop(item)
+    index['raters'][item].discard(user)
+
+    return rating
+
+
+def getRecommendations(prefs, person, similarity=sim_pearson, item_index=None):
+    ''' Calculates recommendations for a given user
+
+        Parameters:
+        -- prefs: dictionary containing user-item matrix
+        -- person: string containing name of user
+        -- similarity: function to calc similarity [sim_pearson is default]
+        -- item_index: inverted index returned by build_item_index(); when
+                       given, only users who share an item with person and
+                       rated something person hasn't are visited
 
         Returns:
         -- A list of recommended items with 0 or more tuples,
@@ -679,150 +1627,4885 @@ def getRecommendedItems(prefs, itemMatch, user, sim_threshold=0):
 
     '''
 
-    userRatings = prefs[user]
-    scores = {}
-    totalSim = {}
+    totals = {}
+    simSums = {}
 
-    # Loop over items rated by this user
-    for (item, rating) in userRatings.items():
-      
-      # Loop over items similar to this one
-        for (similarity, item2) in itemMatch[item]:
-      
-            # Ignore if this user has already rated this item
-            if item2 in userRatings:
-                continue
-            # ignore scores below similarity thresold
-            if similarity <= sim_threshold:
-                continue
+    others = prefs
+    if item_index is not None:
+        # co-raters, with the number of items they share with person that
+        # person has actually rated (0 ratings count as not yet seen)
+        shared = {}
+        for item in prefs[person]:
+            seen = prefs[person][item] != 0
+            for other in item_index['raters'].get(item, ()):
+                shared[other] = shared.get(other, 0) + seen
+
+        # users with no shared items have similarity 0, users who only rated
+        # what person already rated have nothing to add
+        others = [other for other in shared if shared[other] < len(prefs[other])]
+        others.sort(key=lambda other: item_index['order'][other])
+
+    for other in others:
+      # don't compare me to myself
+        if other == person:
+            continue
+        sim = similarity(prefs, person, other)
+
+        # ignore scores of zero or lower (rounded, as in topMatches())
+        if round(sim, SIM_DIGITS) <= 0:
+            continue
+        for item in prefs[other]:
+
+            # only score movies I haven't seen yet
+            if item not in prefs[person] or prefs[person][item] == 0:
+                # Similarity * Score
+                totals.setdefault(item, 0)
+                totals[item] += prefs[other][item]*sim
+                # Sum of similarities
+                simSums.setdefault(item, 0)
+                simSums[item] += sim
+
+    # Create the normalized list
+    rankings = [(total/simSums[item], item) for item, total in totals.items()]
+
+    # Return the sorted list
+    rankings.sort()
+    rankings.reverse()
+    return rankings
+
+
+def getRecommendationSim(prefs, userMatch, user, sim_threshold=0, k=None):
+    ''' Returns user-based recommendations
+
+        Parameters:
+        -- prefs: dictionary containing user-item matrix
+        -- userMatch: dictionary containing similarity matrix
+        -- user: string containing name of user
+        -- sim_threshold: minimum similarity to be considered a neighbor
+                          [default is >0]
+        -- k: only use the k most similar neighbors who rated each item
+              [default is None, use every neighbor]
+
+        Returns:
+        -- A list of recommended items with 0 or more tuples,
+           each tuple contains (predicted rating, item name).
+           List is sorted, high to low, by predicted rating.
+           An empty list is returned when no recommendations have been calc'd.
+
+    '''
+
+    numerators = {}
+    denominators = {}
+    counts = {}  # neighbors used so far per item
+    userRatings = prefs[user]
+    recs = []
+
+    # one pass over every neighbor's ratings; neighbors come high to low by
+    # similarity, so the first k neighbors seen for an item are its top k
+    for (sim, other) in userMatch[user]:
+        for item, rating in prefs[other].items():
+            if item in userRatings and userRatings[item] != 0:  # rated
+                continue
+            if k is not None:
+                if counts.get(item, 0) >= k:
+                    continue
+                counts[item] = counts.get(item, 0) + 1
+            numerators[item] = numerators.get(item, 0) + rating * sim
+            denominators[item] = denominators.get(item, 0) + sim
+
+    for item, denominator in denominators.items():
+        if denominator != 0:
+            # implicit feedback: every average would be 1, rank by the summed similarity
+            recValue = numerators[item] if getattr(prefs, 'implicit', False) else numerators[item] / denominator
+            if recValue > sim_threshold:
+                recs.append((recValue, item))
+
+    # Sort the list of tuples by highest to lowest ratings
+    recs = sorted(recs, key=lambda x: x[0], reverse=True)
+    
+    return recs
+
+
+def calc_all_users(prefs, method=sim_distance):
+    ''' Prints selected calculation for all users
+
+        Parameters:
+        -- prefs: dictionary containing user-item matrix
+        -- method: a registered similarity (sim_distance, sim_pearson, sim_cosine,
+                   sim_adjusted_cosine, sim_jaccard) or getRecommendations
+                   [sim_distance is default]
+
+        Returns:
+        -- None
+
+    '''
+
+    if method == getRecommendations:
+        for user in prefs:
+            print('Recommendations for {}:'.format(user))
+            print('User-based CF recs for {}, sim_pearson: '.format(user),
+                  getRecommendations(prefs, user))
+            print('User-based CF recs for {}, sim_distance: '.format(user),
+                  getRecommendations(prefs, user, similarity=sim_distance))
+            print()
+    else:
+        entry = get_similarity(method) or get_similarity(sim_pearson)
+        for u1 in prefs:
+            for u2 in prefs:
+                if u1 != u2:
+                    print('{} sim {} & {}: '.format(
+                        entry['label'], u1, u2), entry['pair'](prefs, u1, u2))
+
+    return
+
+
+# Memory budget for the whole process, see set_memory_budget()
+MEMORY_BUDGET = {'bytes': None, 'policy': 'fail'}
+
+
+def set_memory_budget(budget_bytes=None, policy='fail'):
+    ''' Sets the memory budget checked before the big allocations
+
+        Parameters:
+        -- budget_bytes: max resident set size of the process in bytes
+                         [None is default, no budget]
+        -- policy: 'fail' raises MemoryError before a stage that would go over
+                   the budget; 'degrade' switches to a slower, smaller variant
+                   (compact LOO working copies, smaller or no batched blocks)
+
+        Returns:
+        -- None
+
+    '''
+
+    if policy not in ('fail', 'degrade'):
+        raise ValueError("policy must be 'fail' or 'degrade'")
+    MEMORY_BUDGET['bytes'] = budget_bytes
+    MEMORY_BUDGET['policy'] = policy
+
+
+def _rss_bytes():
+    ''' Current resident set size of this process in bytes (peak RSS where
+        /proc isn't available) '''
+
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        import resource
+        # ru_maxrss is in kilobytes on Linux, bytes on macOS
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+def check_memory_budget(need_bytes, what):
+    ''' Checks whether need_bytes more fit in the memory budget
+
+        Parameters:
+        -- need_bytes: estimated size of the allocation
+        -- what: description of the allocation, for messages
+
+        Returns:
+        -- True if it fits (or there is no budget), False if it doesn't and
+           the policy is 'degrade'; raises MemoryError if the policy is 'fail'
+
+    '''
+
+    budget = MEMORY_BUDGET['bytes']
+    if budget is None:
+        return True
+    rss = _rss_bytes()
+    if rss + need_bytes <= budget:
+        return True
+
+    message = ('%s needs ~%.1f MB, %.1f MB in use, budget is %.1f MB'
+               % (what, need_bytes / 1e6, rss / 1e6, budget / 1e6))
+    if MEMORY_BUDGET['policy'] == 'fail':
+        raise MemoryError(message)
+    print('ALERT: %s, degrading' % message)
+    return False
+
+
+def deep_sizeof(obj, seen=None):
+    ''' Size in bytes of an object and everything it references
+
+        Objects referenced more than once (e.g. item names shared by every
+        user's ratings) are counted once.
+
+        Parameters:
+        -- obj: dictionary, list, array, etc.
+
+        Returns:
+        -- The size in bytes as an int
+
+    '''
+
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)  # an ndarray's own data is included
+    if isinstance(obj, np.ndarray):
+        if obj.base is not None:
+            size += deep_sizeof(obj.base, seen)
+    elif isinstance(obj, (dict, MappingProxyType)) or hasattr(obj, 'items') and hasattr(obj, 'keys'):
+        for key, value in obj.items():
+            size += deep_sizeof(key, seen) + deep_sizeof(value, seen)
+        if hasattr(obj, '__dict__'):
+            size += deep_sizeof(vars(obj), seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for value in obj:
+            size += deep_sizeof(value, seen)
+
+    return size
+
+
+def memory_report(components, verbose=True):
+    ''' Reports the size of each model component
+
+        Parameters:
+        -- components: dictionary mapping names to objects, e.g.
+                       {'prefs': prefs, 'itemsim': itemsim}
+        -- verbose: print the sizes
+
+        Returns:
+        -- A dictionary mapping each name to its size in bytes
+
+    '''
+
+    sizes = dict([(name, deep_sizeof(obj)) for name, obj in components.items()])
+    if verbose:
+        for name in sizes:
+            print(name.ljust(24) + '%10.1f MB' % (sizes[name] / 1e6))
+    return sizes
+
+
+@contextmanager
+def memory_stage(report, stage, trace=True, interval=0.05):
+    ''' Measures the memory used by a block of code
+
+        RSS is sampled by a background thread every interval seconds;
+        tracemalloc (if trace) gives the peak of the Python allocations.
+
+        Parameters:
+        -- report: dictionary the measurement is appended to, under 'stages'
+        -- stage: name of the stage
+        -- trace: use tracemalloc (slows pure Python code down) [True is default]
+        -- interval: RSS sampling interval in seconds
+
+        Usage:
+            with memory_stage(report, 'itemsim'):
+                itemsim = calculateSimilarItems(prefs)
+
+    '''
+
+    started = trace and not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    if trace:
+        tracemalloc.reset_peak()
+        traced_start = tracemalloc.get_traced_memory()[0]
+
+    rss_start = _rss_bytes()
+    peak = [rss_start]
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(interval):
+            peak[0] = max(peak[0], _rss_bytes())
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    start = time.time()
+    try:
+        yield
+    finally:
+        done.set()
+        sampler.join()
+        result = {'stage': stage, 'seconds': time.time() - start, 'rss_start': rss_start,
+                  'rss_peak': max(peak[0], _rss_bytes()), 'rss_end': _rss_bytes()}
+        if trace:
+            current, traced_peak = tracemalloc.get_traced_memory()
+            result['traced_peak'] = traced_peak - traced_start
+            result['traced_retained'] = current - traced_start
+            if started:
+                tracemalloc.stop()
+        report.setdefault('stages', []).append(result)
+
+
+def benchmark_memory(prefs, similarity=sim_pearson, loo_users=10, trace=True):
+    ''' Measures the memory of every model component and the peak of every
+        stage of the model lifecycle
+
+        Parameters:
+        -- prefs: dictionary containing user-item matrix
+        -- similarity: similarity the matrices are built with [sim_pearson]
+        -- loo_users: number of users left out in the loo_cv_sim() stage
+        -- trace: also measure Python allocations with tracemalloc
+
+        Returns:
+        -- A dictionary with components (name -> bytes), stages (one
+           dictionary per stage, see memory_stage()), the budget and
+           workers_per_host (how many processes with this stage peak fit
+           in the physical memory)
+
+    '''
+
+    report = {'budget': dict(MEMORY_BUDGET)}
+    with memory_stage(report, 'transformPrefs', trace):
+        itemPrefs = transformPrefs(prefs)
+    with memory_stage(report, 'copy.deepcopy(prefs)', trace):
+        prefs_cp = copy.deepcopy(prefs)
+    # the batched builds are the ones the budget can shrink
+    with memory_stage(report, 'calculateSimilarItems', trace):
+        itemsim = calculateSimilarItems(prefs, similarity=similarity, batched=True)
+    with memory_stage(report, 'calculateSimilarUsers', trace):
+        usersim = calculateSimilarUsers(prefs, similarity=similarity, batched=True)
+    with memory_stage(report, 'loo_cv_sim (%d users)' % loo_users, trace):
+        loo_cv_sim(prefs, similarity, getRecommendedItems, itemsim, users=list(prefs)[0:loo_users])
+
+    print()
+    print('Component'.ljust(24) + '      Size')
+    report['components'] = memory_report({'prefs': prefs, 'transformPrefs(prefs)': itemPrefs,
+                                          'copy.deepcopy(prefs)': prefs_cp, 'itemsim': itemsim,
+                                          'usersim': usersim})
+    print()
+    print('Stage'.ljust(28) + 'Secs'.ljust(8) + 'RSS start'.ljust(12) + 'RSS peak'.ljust(12) +
+          'RSS end'.ljust(12) + 'Traced peak')
+    for stage in report['stages']:
+        print(stage['stage'].ljust(28) + ('%.2f' % stage['seconds']).ljust(8) +
+              ('%.1f MB' % (stage['rss_start'] / 1e6)).ljust(12) +
+              ('%.1f MB' % (stage['rss_peak'] / 1e6)).ljust(12) +
+              ('%.1f MB' % (stage['rss_end'] / 1e6)).ljust(12) +
+              ('%.1f MB' % (stage['traced_peak'] / 1e6) if 'traced_peak' in stage else '-'))
+
+    peak = max([stage['rss_peak'] for stage in report['stages']])
+    try:
+        host = os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+        report['workers_per_host'] = int(host // peak)
+        print('Peak RSS %.1f MB: %d worker processes fit in %.1f GB of physical memory'
+              % (peak / 1e6, report['workers_per_host'], host / 1e9))
+    except (ValueError, AttributeError, OSError):
+        report['workers_per_host'] = None
+
+    return report
+
+
+def _loo_working_copy(prefs, users=None):
+    ''' Working copy of prefs for leave-one-out: a deep copy, or (when only
+        some users are left out, or a deep copy doesn't fit the memory
+        budget) a compact copy that shares the rows with prefs; the LOO loops
+        then copy only the row being changed, see _loo_row() '''
+
+    # BitsetRows is read-only: leave-one-out changes a dict of its rows
+    copy_type = _ImplicitRows if isinstance(prefs, BitsetRows) else dict
+    if users is not None and len(users) < len(prefs):
+        return copy_type(prefs), True
+    if MEMORY_BUDGET['bytes'] is None or check_memory_budget(deep_sizeof(prefs), 'copy.deepcopy(prefs)'):
+        if copy_type is _ImplicitRows:
+            return _ImplicitRows([(row, dict(prefs[row])) for row in prefs]), False
+        return copy.deepcopy(prefs), False
+    return copy_type(prefs), True
+
+
+def _loo_row(prefs, prefs_cp, compact, user, done=None):
+    ''' In a compact working copy, gives user a private copy of their row
+        (and puts back the shared row of the user done before) '''
+
+    if compact:
+        if done is not None:
+            prefs_cp[done] = prefs[done]
+        prefs_cp[user] = dict(prefs[user])
+
+
+def loo_cv(prefs, metric, sim, algo):
+    ''' Leave_One_Out Evaluation: evaluates recommender system ACCURACY
+
+        Parameters:
+        -- prefs: dataset of critics, ml-100K, etc.
+        -- metric: MSE, MAE, RMSE, etc.
+        -- sim: distance, pearson, etc.
+        -- algo: user-based recommender, item-based recommender, etc.
+
+        Returns:
+        -- error: MSE, MAE, RMSE totals for this set of conditions
+        -- error_list: list of actual-predicted differences
+
+    '''
+
+    error = 0
+    error_list = []
+    recs = []
+
+    ### UNCOMMENT FOR DEBUG PRINTS ###
+    # pred_found = False 
+
+    # Create a temp copy of prefs
+    prefs_cp, compact = _loo_working_copy(prefs)
+
+    # getRecommendations only needs to visit co-raters
+    item_index = None
+    if algo == getRecommendations:
+        item_index = build_item_index(prefs_cp)
+
+    # iterate through all ratings
+    previous = None
+    for user in prefs:
+        _loo_row(prefs, prefs_cp, compact, user, previous)
+        previous = user
+        for item in prefs[user]:
+            # remove a rating
+            if item_index is not None:
+                removed_rating = remove_rating(prefs_cp, item_index, user, item)
+                recs = algo(prefs_cp, user, similarity=sim, item_index=item_index)
+            else:
+                removed_rating = prefs_cp[user].pop(item)
+                # get list of recommendations
+                recs = algo(prefs_cp, user, similarity=sim)
+
+            # iterate through recommendations
+            for rec in recs:
+                # if this item is in the recommendations, calculate error
+                if item in rec:
+                    ### UNCOMMENT FOR DEBUG PRINTS ###
+                    # pred_found = True
+                    predicted_rating = rec[0]
+                    error_i = 0
+                    if metric == "MAE" or metric == "mae":
+                        error_i = abs(predicted_rating - removed_rating)
+                    else:
+                        error_i = (predicted_rating - removed_rating)**2
+                    error_list.append(error_i)
+
+            ### UNCOMMENT FOR DEBUG PRINTS [use w/ small datasets or implement a way to limit these] ###
+                    # print('User : {}, Item: {}, Prediction {}, Actual: {}, Error: {}'.format(
+                    #     user, item, predicted_rating, removed_rating, error_i))
+            # if pred_found == False:
+                # print('From loo_cv(), No prediction calculated for item {}, user {} in pred_list: {}'.format(
+                #     item, user, recs))
+                # pass
+            #pred_found = False
+            
+            # add the previously removed rating back
+            if item_index is not None:
+                add_rating(prefs_cp, item_index, user, item, removed_rating)
+            else:
+                prefs_cp[user][item] = removed_rating
+
+    # average all errors (if RMSE, square root the average)
+    if metric == "RMSE" or metric == "rmse":
+        error = sqrt(np.average(error_list))
+    else:
+        error = np.average(error_list)
+
+    return error, error_list
+
+
+def significance_weight(similarity, sim, n_shared, sim_weighting=0):
+    ''' Applies similarity significance weighting to an unweighted similarity
+
+        Parameters:
+        -- similarity: function the similarity was calculated with
+        -- sim: unweighted similarity as a float
+        -- n_shared: number of items (or users) the pair has in common
+        -- sim_weighting: similarity significance weighting factor (0, 25, 50)
+                          [default is 0, which represents No Weighting]
+
+        Returns:
+        -- The weighted similarity, using the rule registered for the
+           similarity: 'capped' (only scaled down when n_shared < sim_weighting,
+           as in sim_distance()) or 'linear' (always scaled by
+           n_shared/sim_weighting, as in sim_pearson())
+
+    '''
+
+    if sim_weighting == 0 or sim == 0:
+        return sim
+    entry = get_similarity(similarity)
+    if entry is not None and entry['weighting'] == 'capped':
+        if n_shared < sim_weighting:
+            sim *= (n_shared / sim_weighting)
+    else:
+        sim *= (n_shared / sim_weighting)
+
+    return sim
+
+
+def similarity_upper_bound(similarity, n_shared, sim_weighting=0):
+    ''' Returns the highest (weighted) similarity a pair with n_shared
+        co-ratings can possibly reach
+
+        Parameters:
+        -- similarity: function the similarity is calculated with
+        -- n_shared: number of items (or users) the pair has in common
+        -- sim_weighting: similarity significance weighting factor (0, 25, 50)
+
+        Returns:
+        -- The upper bound as a float (inf if unknown for this similarity)
+
+    '''
+
+    entry = get_similarity(similarity)
+    if entry is None:
+        return float('inf')
+
+    return significance_weight(similarity, entry['max'], n_shared, sim_weighting)
+
+
+def sim_distance_bounded(prefs, p1, p2, sim_weighting=0, sim_threshold=0):
+    ''' Calculate Euclidean distance similarity, giving up as soon as the
+        partial sum of squares shows it cannot be above sim_threshold
+
+        Parameters:
+        -- prefs: dictionary containing user-item matrix
+        -- p1: string containing name of user 1
+        -- p2: string containing name of user 2
+        -- sim_weighting: similarity significance weighting factor (0, 25, 50)
+                          [default is 0, which represents No Weighting]
+        -- sim_threshold: minimum similarity that is of interest [default is >0]
+
+        Returns:
+        -- Same value as sim_distance(), or None if the pair was pruned
+
+    '''
+
+    n_shared = 0
+    for item in prefs[p1]:
+        if item in prefs[p2]:
+            n_shared += 1
+
+    # if they have no ratings in common, return 0
+    if n_shared == 0:
+        return 0
+
+    # 1/(1+sqrt(SS)) * weight <= sim_threshold once SS reaches this cutoff
+    weight = significance_weight(sim_distance, 1.0, n_shared, sim_weighting)
+    if sim_threshold > 0:
+        cutoff = (weight / sim_threshold - 1)**2 if weight > sim_threshold else 0
+    else:
+        cutoff = float('inf')
+
+    sum_of_squares = 0
+    for item in prefs[p1]:
+        if item in prefs[p2]:
+            sum_of_squares += pow(prefs[p1][item]-prefs[p2][item], 2)
+            if sum_of_squares > cutoff * (1 + 1e-9) + 1e-12:
+                return None
+
+    distance_sim = 1/(1+sqrt(sum_of_squares))
+
+    return significance_weight(sim_distance, distance_sim, n_shared, sim_weighting)
+
+
+# Similarities are compared with the threshold, and ranked, at this many
+# decimals, so that sums in another order (which differ in the last bits) land
+# on the same side of the threshold and settle ties by name
+SIM_DIGITS = 10
+
+
+def topMatches(prefs, person, similarity=sim_pearson, n=5, sim_weighting=0, sim_threshold=0,
+               candidates=None, stats=None):
+    ''' Returns the best matches for person from the prefs dictionary
+
+        Parameters:
+        -- prefs: dictionary containing user-item matrix
+        -- person: string containing name of user
+        -- similarity: function to calc similarity [sim_pearson is default]
+        -- n: number of matches to find/return [5 is default]
+        -- sim_weighting: similarity significance weighting factor (0, 25, 50) 
+                          [default is 0, which represents No Weighting]
+        -- candidates: dictionary mapping the only others to compare with to
+                       their co-rating counts, see co_rating_counts()
+                       [default is None, compare with everyone in prefs]
+        -- stats: dictionary in which the number of candidates pruned by
+                  threshold bounds is accumulated under 'pruned' [optional]
+
+        Returns:
+        -- A list of similar matches with 0 or more tuples,
+           each tuple contains (similarity, item name).
+           List is sorted, high to low, by similarity (then name).
+           An empty list is returned when no matches have been calc'd.
+
+    '''
+    scores = []
+
+    # only score the candidates, their co-counts give the significance weighting
+    if candidates is not None:
+        pruned = 0
+        for other, n_shared in candidates.items():
+            # skip pairs whose co-count bound can't pass the threshold
+            # (with a little slack, so rounding never drops a pair that passes)
+            if sim_threshold >= 0 and similarity_upper_bound(
+                    similarity, n_shared, sim_weighting) * (1 + 1e-9) <= sim_threshold:
+                pruned += 1
+                continue
+
+            if similarity == sim_distance and sim_threshold > 0:
+                score = sim_distance_bounded(prefs, person, other, sim_weighting, sim_threshold)
+                if score is None:
+                    pruned += 1
+                    continue
+            elif get_similarity(similarity) is None:
+                # unregistered: no known weighting rule, it weights itself
+                score = similarity(prefs, person, other, sim_weighting)
+            else:
+                score = significance_weight(similarity, similarity(prefs, person, other),
+                                            n_shared, sim_weighting)
+            # threshold on the rounded score: sums in another order (pool,
+            # SortedRows, batched kernels) may land on either side of it
+            if other != person and round(score, SIM_DIGITS) > sim_threshold:
+                scores.append((score, other))
+
+        if stats is not None:
+            stats['pruned'] = stats.get('pruned', 0) + pruned
+
+        scores.sort(key=lambda score: (round(score[0], SIM_DIGITS), score[1]), reverse=True)
+        return scores[0:n]
+
+    # iterate through users in prefs
+    for other in prefs:
+        # calculate similarity score
+        score = similarity(prefs, person, other, sim_weighting)
+        # don't compare me to myself, accept (rounded) scores above the threshold
+        if other != person and round(score, SIM_DIGITS) > sim_threshold:
+            scores.append((score, other))
+
+    # high to low; scores equal at SIM_DIGITS decimals are ordered by name,
+    # so the n-th place doesn't depend on the order of the sums either
+    scores.sort(key=lambda score: (round(score[0], SIM_DIGITS), score[1]), reverse=True)
+    return scores[0:n]
+
+
+def transformPrefs(prefs):
+    ''' Transposes U-I matrix (prefs dictionary)
+
+        Parameters:
+        -- prefs: dictionary containing user-item matrix
+
+        Returns:
+        -- A transposed U-I matrix, i.e., if prefs was a U-I matrix,
+           this function returns an I-U matrix
+
+    '''
+
+    result = {}
+
+    for person in prefs:
+        for item in prefs[person]:
+            result.setdefault(item, {})
+            # Flip item and person
+            result[item][person] = prefs[person][item]
+    
+    return result
+
+
+def co_rating_counts(prefs, min_overlap=1, block_size=256, order='file'):
+    ''' Counts, for every pair of rows in prefs, how many columns both have rated
+
+        The counts are the sparse product of the binarized rating matrix with
+        its transpose, built a block of rows at a time (so only the pairs that
+        actually share a rating are ever generated).
+
+        Parameters:
+        -- prefs: dictionary containing user-item matrix (or the transposed
+                  item-user matrix, to count co-raters of item pairs)
+        -- min_overlap: minimum co-count for a pair to be kept [1 is default]
+        -- block_size: number of rows multiplied at once [256 is default]
+        -- order: id order of the rows and columns, see id_order() ['file']
+
+        Returns:
+        -- counts: a nested dictionary, counts[p1][p2] = number of shared ratings,
+                   containing only pairs (p1 != p2) with at least min_overlap
+        -- skipped: number of ordered pairs left out of counts
+
+    '''
+
+    store = prefs_to_arrays(prefs, order)
+    rows, n_rows = store['users'], len(store['users'])
+    indptr, indices = store['indptr'], store['indices']
+    col_indptr, col_indices = store['item_indptr'], store['item_indices']
+    col_degree = np.diff(col_indptr)
+
+    counts = {}
+    kept = 0
+
+    for start in range(0, n_rows, block_size):
+        stop = min(start + block_size, n_rows)
+        lo, hi = indptr[start], indptr[stop]
+
+        # every (row, column) entry in the block expands into the column's raters
+        entry_row = np.repeat(np.arange(start, stop), np.diff(indptr[start:stop + 1]))
+        entry_col = indices[lo:hi]
+        lens = col_degree[entry_col]
+        offsets = np.repeat(col_indptr[entry_col] - np.cumsum(lens) + lens, lens) + \
+            np.arange(lens.sum())
+        other = col_indices[offsets]
+        keys, key_counts = np.unique(np.repeat(entry_row, lens) * n_rows + other,
+                                     return_counts=True)
+        key_row, key_other = keys // n_rows, keys % n_rows
+
+        # don't pair me with myself, drop pairs below the minimum overlap
+        keep = (key_row != key_other) & (key_counts >= max(min_overlap, 1))
+        key_row, key_other, key_counts = key_row[keep], key_other[keep], key_counts[keep]
+
+        bounds = np.searchsorted(key_row, np.arange(start, stop + 1))
+        for r in range(start, stop):
+            a, b = bounds[r - start], bounds[r - start + 1]
+            counts[rows[r]] = dict(zip([rows[o] for o in key_other[a:b]],
+                                       key_counts[a:b].tolist()))
+        kept += len(key_row)
+
+    skipped = n_rows * (n_rows - 1) - kept
+
+    return counts, skipped
+
+
+# Mersenne prime for the universal hash functions of the sketches
+SKETCH_PRIME = (1 << 31) - 1
+
+
+def sketch_co_ratings(events, rows='items', n_hashes=128, depth=4, width=1 << 18, seed=0,
+                      buffer_size=1 << 20, history_size=256, history_slots=1 << 14):
+    ''' Streams a rating log once, sketching the co-rating counts of every
+        pair of rows in a fixed amount of memory
+
+        Two sketches are built side by side: a MinHash signature per row
+        (n_hashes minimum hash values of the columns it was rated by/rated,
+        estimates Jaccard overlap) and a count-min sketch of the pair counts
+        (depth x width counters; never underestimates, overestimates by at
+        most e/width * pair updates with probability 1 - e^-depth). Pair
+        updates are buffered and applied as conservative updates (each
+        counter is only raised to the pair's new estimate), which keeps the
+        guarantees and cuts the overestimates by a lot.
+
+        The rows seen with each column are kept in a fixed table of
+        history_slots reservoir samples of at most history_size rows each
+        (a column's slot is a hash of it), so the history memory and the pair
+        updates per event are bounded. Once a slot has seen more rows than
+        that, a new row is paired with the sample only, each update weighted
+        by (rows seen / sample size): the counts stay unbiased, but are no
+        longer guaranteed to be upper bounds. Columns that hash to the same
+        slot share it, which can only add co-ratings that didn't happen
+        (the builders recount the candidates exactly anyway).
+
+        Parameters:
+        -- events: iterable of (timestamp, user, item, rating) tuples, as
+                   returned by from_file_to_events() (order doesn't matter)
+        -- rows: 'items' to sketch item pairs (co-raters), 'users' to sketch
+                 user pairs (co-rated items) ['items' is default]
+        -- n_hashes: length of the MinHash signatures [128 is default]
+        -- depth: number of count-min hash functions [4 is default]
+        -- width: number of counters per count-min hash function [2**18]
+        -- seed: seed for the hash functions
+        -- buffer_size: number of pair updates buffered before they are
+                        applied to the count-min sketch [2**20 is default]
+        -- history_size: max number of rows kept per history slot [256 is default]
+        -- history_slots: number of history slots, columns are hashed onto
+                          them [2**14 is default; 16 MB with history_size 256]
+
+        Returns:
+        -- A sketch dictionary: rows, names (row index -> name), index
+           (name -> row index), degree, signatures (rows x n_hashes),
+           table (depth x width counts), the hash coefficients, events,
+           updates (number of pair updates counted) and sampled (whether any
+           history slot outgrew its sample, so the counts are estimates)
+
+    '''
+
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, SKETCH_PRIME, n_hashes, dtype=np.int64)
+    b = rng.integers(0, SKETCH_PRIME, n_hashes, dtype=np.int64)
+    cm_a = rng.integers(1, SKETCH_PRIME, depth, dtype=np.int64)
+    cm_b = rng.integers(0, SKETCH_PRIME, depth, dtype=np.int64)
+    cm_c = rng.integers(1, SKETCH_PRIME, depth, dtype=np.int64)
+
+    names, index, degree, signatures = [], {}, [], []
+    table = np.zeros((depth, width), dtype=np.float32)
+    # per slot: rows seen with its columns, and a reservoir sample of them
+    history_seen = np.zeros(history_slots, dtype=np.int64)
+    history = np.zeros((history_slots, history_size), dtype=np.int32)
+    buffer, weights, buffered = [], [], 0
+    updates = 0
+    sampled = False
+    n_events = 0
+
+    def flush(buffer, weights):
+        keys, inverse = np.unique(np.concatenate(buffer), return_inverse=True)
+        counts = np.bincount(inverse, weights=np.concatenate(weights))
+        lo, hi = keys >> 32, keys & 0xffffffff
+        buckets = [_countmin_hash(cm_a[d], cm_b[d], cm_c[d], lo, hi, width) for d in range(depth)]
+        estimate = np.min([table[d][buckets[d]] for d in range(depth)], axis=0) + counts
+        for d in range(depth):
+            np.maximum.at(table[d], buckets[d], estimate.astype(np.float32))
+
+    for (ts, user, item, rating) in events:
+        row, column = (item, user) if rows == 'items' else (user, item)
+        n_events += 1
+        if row not in index:
+            index[row] = len(names)
+            names.append(row)
+            degree.append(0)
+            signatures.append(np.full(n_hashes, SKETCH_PRIME, dtype=np.int64))
+        r = index[row]
+        degree[r] += 1
+
+        # MinHash: keep the smallest hash of any column seen with this row
+        crc = zlib.crc32(str(column).encode())
+        x = crc % SKETCH_PRIME
+        np.minimum(signatures[r], (a * x + b) % SKETCH_PRIME, out=signatures[r])
+
+        # count-min: one more co-rating for this row and every earlier row
+        # that shares the column's slot (or a weighted sample of them)
+        slot = crc % history_slots
+        seen = int(history_seen[slot])
+        others = history[slot, 0:min(seen, history_size)].astype(np.int64)
+        weight = seen / len(others) if len(others) > 0 else 0
+        others = others[others != r]  # a row of two columns sharing the slot
+        if len(others) > 0:
+            buffer.append((np.minimum(others, r) << 32) | np.maximum(others, r))
+            weights.append(np.full(len(others), weight))
+            buffered += len(others)
+            updates += weight * len(others)
+            if buffered >= buffer_size:
+                flush(buffer, weights)
+                buffer, weights, buffered = [], [], 0
+
+        # reservoir sample of the rows seen with this slot
+        history_seen[slot] += 1
+        if seen < history_size:
+            history[slot, seen] = r
+        else:
+            sampled = True
+            j = int(rng.integers(0, seen + 1))
+            if j < history_size:
+                history[slot, j] = r
+
+    if buffered > 0:
+        flush(buffer, weights)
+
+    return {'rows': rows, 'names': names, 'index': index, 'degree': np.array(degree),
+            'signatures': np.array(signatures).reshape(len(names), n_hashes),
+            'table': table, 'a': a, 'b': b, 'cm_a': cm_a, 'cm_b': cm_b, 'cm_c': cm_c,
+            'events': n_events, 'updates': int(round(updates)), 'sampled': sampled}
+
+
+def _countmin_hash(a, b, c, lo, hi, width):
+    ''' Count-min bucket of the row pairs (lo, hi), lo <= hi '''
+
+    return ((a * lo + c * hi + b) % SKETCH_PRIME) % width
+
+
+def sketch_overlap(sketch, p1, p2, estimator='countmin'):
+    ''' Estimates the number of co-ratings of two rows from a sketch
+
+        Parameters:
+        -- sketch: dictionary returned by sketch_co_ratings()
+        -- p1, p2: row names
+        -- estimator: 'countmin' (never underestimates) or 'minhash'
+                      (Jaccard estimate times the union size)
+
+        Returns:
+        -- The estimated number of co-ratings as a float
+
+    '''
+
+    if p1 not in sketch['index'] or p2 not in sketch['index'] or p1 == p2:
+        return 0.0
+    r1, r2 = sketch['index'][p1], sketch['index'][p2]
+
+    if estimator == 'minhash':
+        jaccard = float(np.average(sketch['signatures'][r1] == sketch['signatures'][r2]))
+        return jaccard * (sketch['degree'][r1] + sketch['degree'][r2]) / (1 + jaccard)
+
+    lo, hi = min(r1, r2), max(r1, r2)
+    return float(min([sketch['table'][d, _countmin_hash(sketch['cm_a'][d], sketch['cm_b'][d],
+                                                        sketch['cm_c'][d], lo, hi,
+                                                        sketch['table'].shape[1])]
+                      for d in range(len(sketch['table']))]))
+
+
+def _sketch_pairs(sketch, lo, hi, estimator='countmin'):
+    ''' Estimated co-rating counts of the row pairs (lo, hi), lo < hi, as
+        a float array '''
+
+    if estimator == 'minhash':
+        estimate = np.empty(len(lo))
+        for start in range(0, len(lo), 1 << 16):
+            stop = min(start + (1 << 16), len(lo))
+            estimate[start:stop] = np.average(sketch['signatures'][lo[start:stop]] ==
+                                              sketch['signatures'][hi[start:stop]], axis=1)
+        union = sketch['degree'][lo] + sketch['degree'][hi]
+        return estimate * union / (1 + estimate)
+
+    estimate = None
+    for d in range(len(sketch['table'])):
+        counts = sketch['table'][d][_countmin_hash(sketch['cm_a'][d], sketch['cm_b'][d],
+                                                   sketch['cm_c'][d], lo, hi,
+                                                   sketch['table'].shape[1])]
+        estimate = counts if estimate is None else np.minimum(estimate, counts)
+    return estimate.astype(float)
+
+
+def sketch_lsh_pairs(sketch, band_rows=1):
+    ''' Candidate row pairs from the MinHash signatures by LSH banding
+
+        The signatures are cut into bands of band_rows hash values; rows that
+        agree on a whole band fall in the same bucket and are paired. A pair
+        with Jaccard overlap J is found with probability
+        1 - (1 - J**band_rows)**(n_hashes / band_rows).
+
+        Parameters:
+        -- sketch: dictionary returned by sketch_co_ratings()
+        -- band_rows: number of hash values per band [1 is default, pairs
+                      that share any minimum hash]
+
+        Returns:
+        -- lo, hi: arrays of row indices, lo < hi, one entry per pair
+
+    '''
+
+    signatures = sketch['signatures']
+    keys = []
+    for start in range(0, signatures.shape[1] - band_rows + 1, band_rows):
+        band = signatures[:, start:start + band_rows]
+        labels = np.unique(band, axis=0, return_inverse=True)[1].ravel()
+        order = np.argsort(labels, kind='stable')
+        bounds = np.flatnonzero(np.diff(labels[order])) + 1
+        for bucket in np.split(order, bounds):
+            if len(bucket) > 1:
+                i, j = np.triu_indices(len(bucket), 1)
+                keys.append((bucket[i].astype(np.int64) << 32) | bucket[j])
+    if len(keys) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    keys = np.unique(np.concatenate(keys))
+    return keys >> 32, keys & 0xffffffff
+
+
+def sketch_candidates(sketch, min_overlap=1, estimator='countmin', band_rows=1):
+    ''' Candidate generation from a sketch, in place of co_rating_counts()
+
+        Only the pairs found by LSH banding of the MinHash signatures (see
+        sketch_lsh_pairs()) are estimated, not all rows x rows pairs; pairs
+        with a small overlap can be missed. The estimated counts may be too
+        high (count-min) or too low (minhash, sampled histories), so the
+        builders recount the candidates exactly, see exact_candidate_counts().
+
+        Parameters:
+        -- sketch: dictionary returned by sketch_co_ratings()
+        -- min_overlap: minimum estimated co-count for a pair to be kept
+        -- estimator: 'countmin' (default) or 'minhash'
+        -- band_rows: number of hash values per LSH band [1 is default]
+
+        Returns:
+        -- counts: a nested dictionary, counts[p1][p2] = estimated co-ratings
+        -- skipped: number of ordered pairs left out of counts
+
+    '''
+
+    names = sketch['names']
+    n_rows = len(names)
+    lo, hi = sketch_lsh_pairs(sketch, band_rows)
+    estimate = _sketch_pairs(sketch, lo, hi, estimator)
+
+    keep = estimate >= max(min_overlap, 1)
+    counts = dict([(name, {}) for name in names])
+    for (r1, r2, count) in zip(lo[keep].tolist(), hi[keep].tolist(), estimate[keep].tolist()):
+        counts[names[r1]][names[r2]] = count
+        counts[names[r2]][names[r1]] = count
+
+    return counts, n_rows * (n_rows - 1) - 2 * int(keep.sum())
+
+
+def exact_candidate_counts(rowPrefs, candidates, min_overlap=1):
+    ''' Recounts the co-ratings of candidate pairs exactly
+
+        The significance weighting and the threshold bounds of topMatches()
+        use the candidates' co-counts, so sketched (estimated) counts are
+        replaced by the exact ones before the similarities are calculated.
+
+        Parameters:
+        -- rowPrefs: dictionary of the rows being compared
+        -- candidates: nested dictionary of candidate pairs, e.g. returned
+                       by sketch_candidates()
+        -- min_overlap: pairs with fewer exact co-ratings are dropped
+
+        Returns:
+        -- counts: a nested dictionary, counts[p1][p2] = co-ratings
+        -- skipped: number of ordered pairs left out of counts
+
+    '''
+
+    counts = {}
+    kept = 0
+    for row in rowPrefs:
+        counts[row] = {}
+        rated = rowPrefs[row].keys()
+        for other in candidates.get(row, {}):
+            if other in rowPrefs:
+                n_shared = len(rated & rowPrefs[other].keys())
+                if n_shared >= max(min_overlap, 1):
+                    counts[row][other] = n_shared
+        kept += len(counts[row])
+
+    return counts, len(rowPrefs) * (len(rowPrefs) - 1) - kept
+
+
+def sketch_error_report(prefs, sketch, weightings=(25, 50), n_pairs=100000, seed=0):
+    ''' Compares a sketch's co-rating estimates with the exact counts, on a
+        uniform sample of row pairs (so the report doesn't need the rows x
+        rows exact counts the sketch stands in for)
+
+        Parameters:
+        -- prefs: dictionary containing user-item matrix (the ratings that
+                  were streamed into the sketch)
+        -- sketch: dictionary returned by sketch_co_ratings()
+        -- weightings: significance weighting factors to report errors for
+        -- n_pairs: number of row pairs sampled [100000 is default, every
+                    pair when there are fewer]
+        -- seed: random seed of the sample
+
+        Returns:
+        -- A dictionary per estimator ('countmin', 'minhash') with the mean,
+           p95 and max absolute error of the co-rating counts over the pairs,
+           the mean absolute error of the weighting factors min(n, w)/w, and
+           recall/precision of the pairs with at least one co-rating; plus
+           the theoretical count-min bound, its confidence and the fraction
+           of pairs within it, the number of pairs compared, and the sketch
+           and (estimated) exact-count memory in bytes
+
+    '''
+
+    rowPrefs = transformPrefs(prefs) if sketch['rows'] == 'items' else prefs
+    names = sketch['names']
+    n_rows = len(names)
+    total_pairs = n_rows * (n_rows - 1) // 2
+    if total_pairs <= n_pairs:
+        lo, hi = np.triu_indices(n_rows, 1)
+    else:
+        rng = np.random.default_rng(seed)
+        lo = rng.integers(0, n_rows, n_pairs)
+        hi = (lo + rng.integers(1, n_rows, n_pairs)) % n_rows  # any other row
+        lo, hi = np.minimum(lo, hi), np.maximum(lo, hi)
+    lo, hi = lo.astype(np.int64), hi.astype(np.int64)
+    exact = np.array([len(rowPrefs[names[r1]].keys() & rowPrefs[names[r2]].keys())
+                      for (r1, r2) in zip(lo.tolist(), hi.tolist())], dtype=float)
+
+    bound = math.e / sketch['table'].shape[1] * sketch['updates']
+    report = {'pairs': len(lo)}
+    for estimator in ('countmin', 'minhash'):
+        estimate = _sketch_pairs(sketch, lo, hi, estimator)
+        errors = np.abs(estimate - exact)
+        true_pos = int(((estimate >= 1) & (exact >= 1)).sum())
+        false_pos = int(((estimate >= 1) & (exact < 1)).sum())
+        false_neg = int(((estimate < 1) & (exact >= 1)).sum())
+        report[estimator] = {'mean_abs': float(np.average(errors)),
+                             'p95_abs': float(np.percentile(errors, 95)),
+                             'max_abs': float(np.max(errors)),
+                             'weight_mae': dict([(w, float(np.average(np.abs(np.minimum(estimate, w) -
+                                                                             np.minimum(exact, w)))) / w)
+                                                 for w in weightings]),
+                             'recall': true_pos / (true_pos + false_neg) if true_pos + false_neg > 0 else 1.0,
+                             'precision': true_pos / (true_pos + false_pos) if true_pos + false_pos > 0 else 1.0}
+        if estimator == 'countmin':
+            report[estimator]['bound'] = bound
+            report[estimator]['confidence'] = 1 - math.exp(-len(sketch['table']))
+            report[estimator]['within_bound'] = float(np.average(estimate - exact <= bound))
+
+    # a nested dict entry (key + int) costs roughly 100 bytes in CPython, two
+    # per pair with a co-rating
+    report['sketch_bytes'] = sketch['table'].nbytes + sketch['signatures'].nbytes
+    report['exact_bytes'] = int(100 * 2 * total_pairs * float(np.average(exact >= 1)))
+
+    print('Estimator'.ljust(11) + 'Mean err'.ljust(10) + 'p95 err'.ljust(10) + 'Max err'.ljust(10) +
+          ''.join([('w/%d err' % w).ljust(10) for w in weightings]) + 'Recall'.ljust(8) + 'Precision')
+    for estimator in ('countmin', 'minhash'):
+        r = report[estimator]
+        print(estimator.ljust(11) + ('%.3f' % r['mean_abs']).ljust(10) + ('%.1f' % r['p95_abs']).ljust(10) +
+              ('%.1f' % r['max_abs']).ljust(10) +
+              ''.join([('%.4f' % r['weight_mae'][w]).ljust(10) for w in weightings]) +
+              ('%.4f' % r['recall']).ljust(8) + '%.4f' % r['precision'])
+    print('Count-min bound: error <= %.1f with probability %.3f (%.2f%% of pairs within it)'
+          % (bound, report['countmin']['confidence'], 100 * report['countmin']['within_bound']))
+    if sketch['sampled']:
+        print('(history slots outgrew their sample of rows, pair counts were sampled)')
+    print('Memory: sketch %.1f MB vs ~%.1f MB for exact pair counts (%d pairs compared)'
+          % (report['sketch_bytes'] / 1e6, report['exact_bytes'] / 1e6, report['pairs']))
+
+    return report
+
+
+def calculateSimilarItems(prefs, n=100, similarity=sim_pearson, sim_weighting=0, sim_threshold=0,
+                          min_overlap=1, n_workers=1, batched=True, sketch=None, latent_k=None,
+                          order='file'):
+    ''' Creates a dictionary of items showing which other items they are most
+        similar to.
+
+        Parameters:
+        -- prefs: dictionary containing user-item matrix
+        -- n: number of similar matches for topMatches() to return
+        -- similarity: function to calc similarity (sim_pearson is default)
+        -- sim_weighting: similarity significance weighting factor (0, 25, 50), 
+                            default is 0 [None]
+        -- min_overlap: only calc similarity for pairs with at least this many
+                        co-ratings (1 is default, 0 disables candidate generation)
+        -- n_workers: number of worker processes for the per-pair loop (1 is
+                      default, no pool)
+        -- batched: use the similarity's registered batched kernel, if it has
+                    one (True is default); it compares dense blocks of the
+                    whole matrix in one process, so it takes rows x columns
+                    memory. The per-pair loop (or the pool, with n_workers > 1)
+                    is the fallback: for unregistered similarities, a sketch,
+                    a negative sim_threshold, or blocks over the memory budget
+        -- sketch: sketch_co_ratings() of the same ratings; candidates come
+                   from it instead of the exact counts, their co-counts are
+                   recounted exactly [optional, not used by the batched kernels]
+        -- latent_k: search the neighbors in a latent_k-dimensional latent
+                     space and re-score them exactly, see
+                     calculateSimilarLatent() [optional, approximate]
+        -- order: id order of the rating store (batched blocks, co-rating
+                  counts, shared arrays, latent SVD), see id_order()
+                  ['file' is default]
+
+        Returns:
+        -- A dictionary with a similarity matrix
+
+    '''
+
+    result = {}
+    stats = {}
+    c = 0
+
+    # implicit feedback: Jaccard and cosine from the packed bit arrays
+    if isinstance(prefs, BitsetRows) and similarity in (sim_jaccard, sim_cosine):
+        return calculateSimilarBitset(prefs.transposed(), n, similarity, sim_weighting, sim_threshold, min_overlap)
+
+    # Invert the preference matrix to be item-centric (there is no smaller
+    # variant of the copy, with the 'degrade' policy it's only reported)
+    if MEMORY_BUDGET['bytes'] is not None:
+        check_memory_budget(deep_sizeof(prefs), 'transformPrefs(prefs)')
+    itemPrefs = transformPrefs(prefs)
+
+    if latent_k is not None:
+        return calculateSimilarLatent(itemPrefs, n, similarity, sim_weighting, sim_threshold, k=latent_k,
+                                      order=order)
+
+    # Registered similarities are calculated a block of rows at a time
+    entry = get_similarity(similarity)
+    degraded = False
+    if batched and sketch is None and sim_threshold >= 0 and entry is not None and entry['block'] is not None:
+        store = prefs_to_arrays(itemPrefs, order)
+        block_size = _batched_block_size(len(store['users']), len(store['items']))
+        if block_size is not None:
+            return calculateSimilarBatched(itemPrefs, n, similarity, sim_weighting,
+                                           sim_threshold, min_overlap, block_size, store)
+        del store
+        degraded = True
+
+    # Pairs without co-ratings have similarity 0 and can never pass the threshold
+    # (the co-counts take a lot of memory, so not when degrading to save some)
+    candidates = None
+    if sketch is not None:
+        candidates, skipped = exact_candidate_counts(itemPrefs, sketch_candidates(sketch, min_overlap)[0],
+                                                     min_overlap)
+        print('Candidate generation: skipped %d of %d item pairs (sketched, co-ratings < %d)'
+              % (skipped, len(itemPrefs) * (len(itemPrefs) - 1), min_overlap))
+    elif min_overlap > 1 or (min_overlap == 1 and sim_threshold >= 0 and not degraded):
+        candidates, skipped = co_rating_counts(itemPrefs, min_overlap, order=order)
+        print('Candidate generation: skipped %d of %d item pairs (co-ratings < %d)'
+              % (skipped, len(itemPrefs) * (len(itemPrefs) - 1), min_overlap))
+
+    if n_workers > 1:
+        # Split the rows over a pool of worker processes
+        result = calculateSimilarParallel(itemPrefs, n, similarity, sim_weighting, sim_threshold,
+                                          candidates, n_workers, stats, order=order)
+
+    else:
+        with _cached_column_means(itemPrefs, similarity):
+            for item in itemPrefs:
+                # Status updates for larger datasets
+                c += 1
+                if c % 100 == 0:
+                    percent_complete = (100*c)/len(itemPrefs)
+                    print(str(percent_complete)+"% complete")
+
+                # Find the most similar items to this one
+                scores = topMatches(itemPrefs, item, similarity, n, sim_weighting, sim_threshold,
+                                    candidates[item] if candidates is not None else None, stats)
+                result[item] = scores
+
+    if candidates is not None:
+        print('Threshold pruning: skipped %d item pairs that cannot be >%s'
+              % (stats.get('pruned', 0), sim_threshold))
+    return result
+
+
+def calculateSimilarUsers(prefs, n=100, similarity=sim_pearson, sim_weighting=0, sim_threshold=0,
+                          min_overlap=1, n_workers=1, batched=True, sketch=None, latent_k=None,
+                          order='file'):
+    ''' Creates a dictionary of users showing which other users they are most
+        similar to.
+
+        Parameters:
+        -- prefs: dictionary containing user-item matrix
+        -- n: number of similar matches for topMatches() to return
+        -- similarity: function to calc similarity (sim_pearson is default)
+        -- sim_weighting: similarity significance weighting factor (0, 25, 50), 
+                            default is 0 [None]
+        -- min_overlap: only calc similarity for pairs with at least this many
+                        co-ratings (1 is default, 0 disables candidate generation)
+        -- n_workers: number of worker processes for the per-pair loop (1 is
+                      default, no pool)
+        -- batched: use the similarity's registered batched kernel, if it has
+                    one (True is default); it compares dense blocks of the
+                    whole matrix in one process, so it takes rows x columns
+                    memory. The per-pair loop (or the pool, with n_workers > 1)
+                    is the fallback: for unregistered similarities, a sketch,
+                    a negative sim_threshold, or blocks over the memory budget
+        -- sketch: sketch_co_ratings() of the same ratings; candidates come
+                   from it instead of the exact counts, their co-counts are
+                   recounted exactly [optional, not used by the batched kernels]
+        -- latent_k: search the neighbors in a latent_k-dimensional latent
+                     space and re-score them exactly, see
+                     calculateSimilarLatent() [optional, approximate]
+        -- order: id order of the rating store (batched blocks, co-rating
+                  counts, shared arrays, latent SVD), see id_order()
+                  ['file' is default]
+
+        Returns:
+        -- A dictionary with a similarity matrix
+
+    '''
+
+    result = {}
+    stats = {}
+    c = 0
+
+    # implicit feedback: Jaccard and cosine from the packed bit arrays
+    if isinstance(prefs, BitsetRows) and similarity in (sim_jaccard, sim_cosine):
+        return calculateSimilarBitset(prefs, n, similarity, sim_weighting, sim_threshold, min_overlap)
+
+    if latent_k is not None:
+        return calculateSimilarLatent(prefs, n, similarity, sim_weighting, sim_threshold, k=latent_k,
+                                      order=order)
+
+    # Registered similarities are calculated a block of rows at a time
+    entry = get_similarity(similarity)
+    degraded = False
+    if batched and sketch is None and sim_threshold >= 0 and entry is not None and entry['block'] is not None:
+        store = prefs_to_arrays(prefs, order)
+        block_size = _batched_block_size(len(store['users']), len(store['items']))
+        if block_size is not None:
+            return calculateSimilarBatched(prefs, n, similarity, sim_weighting,
+                                           sim_threshold, min_overlap, block_size, store)
+        del store
+        degraded = True
+
+    # Pairs without co-ratings have similarity 0 and can never pass the threshold
+    # (the co-counts take a lot of memory, so not when degrading to save some)
+    candidates = None
+    if sketch is not None:
+        candidates, skipped = exact_candidate_counts(prefs, sketch_candidates(sketch, min_overlap)[0],
+                                                     min_overlap)
+        print('Candidate generation: skipped %d of %d user pairs (sketched, co-ratings < %d)'
+              % (skipped, len(prefs) * (len(prefs) - 1), min_overlap))
+    elif min_overlap > 1 or (min_overlap == 1 and sim_threshold >= 0 and not degraded):
+        candidates, skipped = co_rating_counts(prefs, min_overlap, order=order)
+        print('Candidate generation: skipped %d of %d user pairs (co-ratings < %d)'
+              % (skipped, len(prefs) * (len(prefs) - 1), min_overlap))
+
+    if n_workers > 1:
+        # Split the rows over a pool of worker processes
+        result = calculateSimilarParallel(prefs, n, similarity, sim_weighting, sim_threshold,
+                                          candidates, n_workers, stats, order=order)
+
+    else:
+        with _cached_column_means(prefs, similarity):
+            for user in prefs:
+                # Status updates for larger datasets
+                c += 1
+                if c % 100 == 0:
+                    percent_complete = (100*c)/len(prefs)
+                    print(str(percent_complete)+"% complete")
+
+                # Find the most similar items to this one
+                scores = topMatches(prefs, user, similarity, n, sim_weighting, sim_threshold,
+                                    candidates[user] if candidates is not None else None, stats)
+                result[user] = scores
+
+    if candidates is not None:
+        print('Threshold pruning: skipped %d user pairs that cannot be >%s'
+              % (stats.get('pruned', 0), sim_threshold))
+
+    return result
+
+
+_builder_state = {}
+
+
+def _builder_init(manifest, lock, n, similarity, sim_weighting, sim_threshold):
+    ''' Pool initializer: attaches the worker to the shared (read-only) rating
+        arrays and candidate co-counts of the rows being compared, see
+        publish_shared_model(); nothing is copied into the worker
+    '''
+
+    model = attach_shared_model(manifest, lock)
+    # detach when the worker exits normally (pool.close() + pool.join())
+    multiprocessing.util.Finalize(None, detach_shared_model, args=(model,), exitpriority=10)
+
+    rowPrefs = SortedRows.from_arrays(model['users'], model['items'], model['indptr'],
+                                      model['indices'], model['ratings'])
+    if similarity == sim_adjusted_cosine:
+        # column means straight from the arrays, without building the row dictionaries
+        sums = np.bincount(model['indices'], weights=model['ratings'], minlength=len(model['items']))
+        counts = np.bincount(model['indices'], minlength=len(model['items']))
+        _COLUMN_MEANS[id(rowPrefs)] = {col: sums[i] / counts[i] for i, col in enumerate(model['items'])
+                                       if counts[i] > 0}
+
+    _builder_state.update(model=model, rowPrefs=rowPrefs, n=n, similarity=similarity,
+                          sim_weighting=sim_weighting, sim_threshold=sim_threshold)
+
+
+def _builder_task(rows):
+    ''' Pool task: top matches for one chunk of rows '''
+
+    st = _builder_state
+    model = st['model']
+    stats = {}
+    result = []
+    for row in rows:
+        candidates = None
+        if 'candidates_indptr' in model:
+            r = model['user_index'][row]
+            lo, hi = model['candidates_indptr'][r], model['candidates_indptr'][r + 1]
+            candidates = dict(zip([model['users'][o] for o in model['candidates_neighbors'][lo:hi]],
+                                  model['candidates_counts'][lo:hi].tolist()))
+        scores = topMatches(st['rowPrefs'], row, st['similarity'], st['n'], st['sim_weighting'],
+                            st['sim_threshold'], candidates, stats)
+        result.append((row, scores))
+
+    return result, stats.get('pruned', 0)
+
+
+def partition_rows(costs, n_chunks):
+    ''' Splits rows into chunks of about equal total cost
+
+        Rows are assigned, most expensive first, to the chunk with the lowest
+        total so far (longest processing time first), so a few heavy rows on
+        a power-law dataset don't all end up in the same chunk.
+
+        Parameters:
+        -- costs: dictionary mapping each row to its estimated cost
+        -- n_chunks: number of chunks
+
+        Returns:
+        -- A list of n_chunks lists of rows, most expensive chunk first
+
+    '''
+
+    chunks = [[] for i in range(n_chunks)]
+    totals = np.zeros(n_chunks)
+    for row in sorted(costs, key=lambda row: costs[row], reverse=True):
+        c = int(np.argmin(totals))
+        chunks[c].append(row)
+        totals[c] += costs[row]
+
+    order = np.argsort(-totals)
+    return [chunks[c] for c in order if len(chunks[c]) > 0]
+
+
+def calculateSimilarParallel(rowPrefs, n=100, similarity=sim_pearson, sim_weighting=0,
+                             sim_threshold=0, candidates=None, n_workers=None, stats=None,
+                             chunks_per_worker=4, order='file'):
+    ''' Calculates a similarity matrix with a pool of worker processes
+
+        Gives the same matrix as the serial loop in calculateSimilarItems() /
+        calculateSimilarUsers(), since every row is still calculated by
+        topMatches(). The ratings (and candidates) are published once as
+        shared memory arrays, the workers read them as SortedRows; their rows
+        are in column order, so a score can differ in its last bits
+        (floating point sums in another order); topMatches() thresholds on
+        the score rounded to SIM_DIGITS so both keep the same neighbors.
+
+        Parameters:
+        -- rowPrefs: dictionary whose rows are compared (prefs for a user-user
+                     matrix, transformPrefs(prefs) for an item-item matrix)
+        -- n: number of similar matches for topMatches() to return
+        -- similarity: function to calc similarity (sim_pearson is default)
+        -- sim_weighting: similarity significance weighting factor (0, 25, 50)
+        -- sim_threshold: minimum similarity to be considered a neighbor
+        -- candidates: co-rating counts from co_rating_counts() [optional]
+        -- n_workers: number of worker processes [default is the number of cores]
+        -- stats: dictionary in which pruned pairs are counted [optional]
+        -- chunks_per_worker: chunks per worker, more chunks even out the load
+                              as the pool hands them out [4 is default]
+        -- order: id order of the shared arrays, see id_order() ['file' is default]
+
+        Returns:
+        -- A dictionary with a similarity matrix
+
+    '''
+
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+
+    # cost of a row ~ its length times the number of rows it is compared to
+    costs = {}
+    for row in rowPrefs:
+        others = len(candidates[row]) if candidates is not None else len(rowPrefs)
+        costs[row] = len(rowPrefs[row]) * max(others, 1)
+    chunks = partition_rows(costs, n_workers * chunks_per_worker)
+
+    scores = {}
+    pruned = 0
+    done = 0
+    model = publish_shared_model(rowPrefs, candidates=candidates, order=order)
+    pool = multiprocessing.Pool(n_workers, initializer=_builder_init,
+                                initargs=(model['manifest'], model['lock'], n, similarity,
+                                          sim_weighting, sim_threshold))
+    try:
+        for chunk_scores, chunk_pruned in pool.imap_unordered(_builder_task, chunks):
+            scores.update(chunk_scores)
+            pruned += chunk_pruned
+            # Status updates for larger datasets
+            done += 1
+            print(str((100*done)/len(chunks))+"% complete")
+    finally:
+        pool.close()
+        pool.join()
+        detach_shared_model(model)
+
+    if stats is not None:
+        stats['pruned'] = stats.get('pruned', 0) + pruned
+
+    # merge in the same row order as the serial builder
+    return {row: scores[row] for row in rowPrefs}
+
+
+def getRecommendedItems(prefs, itemMatch, user, sim_threshold=0):
+    ''' Calculates recommendations for a given user
+
+        Parameters:
+        -- prefs: dictionary containing user-item matrix
+        -- itemMatch: dictionary containing similarity matrix
+        -- user: string containing name of user
+        -- sim_threshold: minimum similarity to be considered a neighbor, default is >0
+
+        Returns:
+        -- A list of recommended items with 0 or more tuples,
+           each tuple contains (predicted rating, item name).
+           List is sorted, high to low, by predicted rating.
+           An empty list is returned when no recommendations have been calc'd.
+
+    '''
+
+    userRatings = prefs[user]
+    scores = {}
+    totalSim = {}
+
+    # Loop over items rated by this user
+    for (item, rating) in userRatings.items():
+      
+      # Loop over items similar to this one
+        for (similarity, item2) in itemMatch[item]:
+      
+            # Ignore if this user has already rated this item
+            if item2 in userRatings:
+                continue
+            # ignore scores below similarity thresold
+            if similarity <= sim_threshold:
+                continue
+
+            # Weighted sum of rating times similarity
+            scores.setdefault(item2, 0)
+            scores[item2] += similarity*rating
+
+            # Sum of all the similarities
+            totalSim.setdefault(item2, 0)
+            totalSim[item2] += similarity
+
+    # Divide each total score by total weighting to get an average
+    # (implicit feedback: every average would be 1, rank by the summed similarity)
+    if getattr(prefs, 'implicit', False):
+        rankings = [(score, item) for item, score in scores.items()]
+    else:
+        rankings = [(score/totalSim[item], item) for item, score in scores.items()]
+
+    # Return the rankings from highest to lowest
+    rankings.sort()
+    rankings.reverse()
+    return rankings
+
+
+def build_candidate_sources(prefs, n_cooccur=50):
+    ''' Precomputes the cheap statistics used to propose candidate items
+
+        Parameters:
+        -- prefs: dictionary containing user-item matrix
+        -- n_cooccur: number of co-occurring items kept per item [50 is default]
+
+        Returns:
+        -- A dictionary with popular (items sorted by number of ratings, then
+           average rating, as in popular_items()) and cooccur (item -> items
+           most often rated by the same users, high to low)
+
+    '''
+
+    itemPrefs = transformPrefs(prefs)
+    popular = sorted(itemPrefs, key=lambda item: (len(itemPrefs[item]),
+                                                  np.average(list(itemPrefs[item].values()))),
+                     reverse=True)
+
+    counts, skipped = co_rating_counts(itemPrefs)
+    cooccur = {}
+    for item in counts:
+        ranked = sorted(counts[item].items(), key=lambda x: (x[1], x[0]), reverse=True)
+        cooccur[item] = [other for (other, count) in ranked[0:n_cooccur]]
+
+    return {'popular': popular, 'cooccur': cooccur}
+
+
+def build_reverse_sim_index(itemMatch):
+    ''' Inverts an item-item similarity matrix: for each item, the items
+        that have it in their neighbor list, with the similarity
+
+        Parameters:
+        -- itemMatch: dictionary containing item-item similarity matrix
+
+        Returns:
+        -- A dictionary mapping item2 to a list of (similarity, item) for
+           every item whose neighbor list contains item2
+
+    '''
+
+    reverse = {}
+    for item in itemMatch:
+        for (similarity, item2) in itemMatch[item]:
+            reverse.setdefault(item2, [])
+            reverse[item2].append((similarity, item))
+
+    return reverse
+
+
+def generate_candidates(prefs, sources, user, budget=400, usersim=None, itemsim=None, n_seed=20,
+                        n_neighbors=20, recent=None, rated_zero=True):
+    ''' Proposes a bounded set of candidate items for a user
+
+        Up to four ranked lists are merged round-robin until the budget is
+        filled: items similar to the user's seed items (if an item-item
+        matrix is given), items rated highly by the user's nearest neighbors
+        (if a user-user matrix is given), items co-occurring with the seed
+        items and popular items.
+
+        Parameters:
+        -- prefs: dictionary containing user-item matrix
+        -- sources: dictionary returned by build_candidate_sources()
+        -- user: string containing name of user
+        -- budget: max number of candidates [400 is default]
+        -- usersim: user-user similarity matrix, for neighbor items [optional]
+        -- itemsim: item-item similarity matrix, for similar items [optional]
+        -- n_seed: number of the user's items the co-occurrences start from
+        -- n_neighbors: number of neighbors whose items are proposed
+        -- recent: dictionary mapping users to their items, most recently
+                   rated first [optional, default is highest rated first]
+        -- rated_zero: whether items the user rated 0 are still candidates, as
+                       in getRecommendationSim() [default is True]; False
+                       excludes every rated item, as in getRecommendedItems()
+
+        Returns:
+        -- A list of at most budget items the user hasn't rated
+
+    '''
+
+    userRatings = prefs.get(user, {})
+
+    # seed items: the most recent (or highest rated) items of this user
+    if recent is not None and user in recent:
+        seeds = [item for item in recent[user] if item in userRatings][0:n_seed]
+    else:
+        seeds = sorted(userRatings, key=lambda item: userRatings[item], reverse=True)[0:n_seed]
+
+    cooccur = {}
+    for seed in seeds:
+        for pos, item in enumerate(sources['cooccur'].get(seed, [])):
+            cooccur[item] = cooccur.get(item, 0) + 1 / (1 + pos)
+    cooccur = sorted(cooccur, key=lambda item: cooccur[item], reverse=True)
+
+    # similar and neighbor items are ranked by a weighted average, like the
+    # exact predictions they stand in for
+    similar_items = {}
+    if itemsim is not None:
+        for seed in seeds:
+            for (sim, item) in itemsim.get(seed, []):
+                if sim > 0:
+                    score, totalSim = similar_items.get(item, (0, 0))
+                    similar_items[item] = (score + sim * userRatings[seed], totalSim + sim)
+    similar_items = sorted(similar_items, key=lambda item: similar_items[item][0] / similar_items[item][1],
+                           reverse=True)
+
+    neighbor_items = {}
+    if usersim is not None:
+        for (sim, other) in usersim.get(user, [])[0:n_neighbors]:
+            if recent is not None and other in recent:
+                others_items = recent[other][0:n_seed]
+            else:
+                others_items = prefs[other]
+            for item in others_items:
+                if prefs[other].get(item, 0) >= 4:
+                    score, totalSim = neighbor_items.get(item, (0, 0))
+                    neighbor_items[item] = (score + sim * prefs[other][item], totalSim + sim)
+    neighbor_items = sorted(neighbor_items, key=lambda item: neighbor_items[item][0] / neighbor_items[item][1],
+                            reverse=True)
+
+    lists = [similar_items, neighbor_items, cooccur, sources['popular']]
+    positions = [0] * len(lists)
+    candidates = []
+    seen = set()
+    while len(candidates) < budget and any([positions[i] < len(lists[i]) for i in range(len(lists))]):
+        for i in range(len(lists)):
+            # next unrated, unseen item of this list
+            while positions[i] < len(lists[i]):
+                item = lists[i][positions[i]]
+                positions[i] += 1
+                if item not in seen and (item not in userRatings or (rated_zero and userRatings[item] == 0)):
+                    seen.add(item)
+                    candidates.append(item)
+                    break
+            if len(candidates) >= budget:
+                break
+
+    return candidates
+
+
+def build_two_stage_index(prefs, itemsim=None):
+    ''' Builds what getRecommendationsTwoStage() needs besides the matrix,
+        once for many calls; build it again after prefs or itemsim change
+
+        Parameters:
+        -- prefs: dictionary containing user-item matrix
+        -- itemsim: item-item similarity matrix, for item-based scoring [optional]
+
+        Returns:
+        -- A dictionary with sources (build_candidate_sources()) and
+           reverse_index (build_reverse_sim_index(), None without itemsim),
+           pass it on as getRecommendationsTwoStage(..., **index)
+
+    '''
+
+    return {'sources': build_candidate_sources(prefs),
+            'reverse_index': build_reverse_sim_index(itemsim) if itemsim is not None else None}
+
+
+def getRecommendationsTwoStage(prefs, sim_matrix, user, sim_threshold=0, algo=None, sources=None,
+                               budget=400, usersim=None, reverse_index=None):
+    ''' Returns recommendations scored exactly, but only for a bounded set of
+        candidates from generate_candidates()
+
+        Parameters:
+        -- prefs: dictionary containing user-item matrix
+        -- sim_matrix: item-item (getRecommendedItems) or user-user
+                       (getRecommendationSim) similarity matrix
+        -- user: string containing name of user
+        -- sim_threshold: as in getRecommendedItems() / getRecommendationSim()
+        -- algo: getRecommendedItems (default) or getRecommendationSim, whose
+                 predictions are reproduced for the candidates
+        -- sources: dictionary returned by build_candidate_sources()
+                    [built for this call if not given]
+        -- budget: max number of candidates scored [400 is default; on
+                   ml-100k with 50 Pearson neighbors per item the recall of the
+                   exact item-based top 10 is about 0.45 at 100, 0.7 at 200 and
+                   0.9 at 400, see benchmark_two_stage()]
+        -- usersim: user-user similarity matrix for neighbor candidates
+                    [default is sim_matrix when algo is getRecommendationSim]
+        -- reverse_index: build_reverse_sim_index(sim_matrix), for item-based
+                          scoring [built for this call if not given]
+
+        Building sources and reverse_index costs much more than a call, pass
+        them in from build_two_stage_index() when recommending for many users.
+
+        Returns:
+        -- A list of recommended items with 0 or more tuples,
+           each tuple contains (predicted rating, item name).
+           List is sorted, high to low, by predicted rating.
+
+    '''
+
+    if algo is None:
+        algo = getRecommendedItems
+    if usersim is None and algo == getRecommendationSim:
+        usersim = sim_matrix
+    if sources is None:
+        sources = build_candidate_sources(prefs)
+    if reverse_index is None and algo != getRecommendationSim:
+        reverse_index = build_reverse_sim_index(sim_matrix)
+
+    userRatings = prefs[user]
+    recs = []
+
+    # Each stage-2 loop below has a cheaper mirror image: when the candidate
+    # side would touch more entries than the exact scan, the exact scan is
+    # run instead, restricted to the candidates.
+    if algo == getRecommendationSim:
+        candidates = generate_candidates(prefs, sources, user, budget, usersim=usersim)
+        neighbors = sim_matrix[user]
+        if len(candidates) * len(neighbors) <= sum([len(prefs[other]) for (sim, other) in neighbors]):
+            for item in candidates:
+                numerator, denominator = 0, 0
+                for (sim, other) in neighbors:
+                    if item in prefs[other]:  # Other has rated item
+                        numerator += prefs[other][item] * sim
+                        denominator += sim
+                if denominator != 0 and numerator / denominator > sim_threshold:
+                    recs.append((numerator / denominator, item))
+        else:
+            candidates = set(candidates)
+            totals, simSums = {}, {}
+            for (sim, other) in neighbors:
+                for item in prefs[other]:
+                    if item in candidates:
+                        totals[item] = totals.get(item, 0) + prefs[other][item] * sim
+                        simSums[item] = simSums.get(item, 0) + sim
+            for item in totals:
+                if simSums[item] != 0 and totals[item] / simSums[item] > sim_threshold:
+                    recs.append((totals[item] / simSums[item], item))
+
+    else:
+        # like getRecommendedItems(), items rated 0 are rated
+        candidates = generate_candidates(prefs, sources, user, budget, usersim=usersim, itemsim=sim_matrix,
+                                         rated_zero=False)
+        cost = sum([len(reverse_index.get(item, [])) for item in candidates])
+        if cost <= sum([len(sim_matrix.get(item, [])) for item in userRatings]):
+            for item in candidates:
+                score, totalSim = 0, 0
+                # items this user rated that have the candidate as a neighbor
+                for (similarity, item2) in reverse_index.get(item, []):
+                    if item2 in userRatings and similarity > sim_threshold:
+                        score += similarity * userRatings[item2]
+                        totalSim += similarity
+                if totalSim != 0:
+                    recs.append((score / totalSim, item))
+        else:
+            candidates = set(candidates)
+            scores, totalSims = {}, {}
+            for (item, rating) in userRatings.items():
+                for (similarity, item2) in sim_matrix.get(item, []):
+                    if item2 in candidates and similarity > sim_threshold:
+                        scores[item2] = scores.get(item2, 0) + similarity * rating
+                        totalSims[item2] = totalSims.get(item2, 0) + similarity
+            for item in scores:
+                if totalSims[item] != 0:
+                    recs.append((scores[item] / totalSims[item], item))
+
+    recs.sort()
+    recs.reverse()
+    return recs
+
+
+def benchmark_two_stage(prefs, sim_matrix, algo=getRecommendedItems, budgets=(50, 100, 200, 400, 800),
+                        top_N=10, users=None, usersim=None):
+    ''' Compares two-stage recommendations with exact recommendations
+
+        Parameters:
+        -- prefs: dictionary containing user-item matrix
+        -- sim_matrix: pre-computed similarity matrix for algo
+        -- algo: getRecommendedItems (default) or getRecommendationSim
+        -- budgets: candidate budgets to try
+        -- top_N: length of the recommendation lists compared [10 is default]
+        -- users: users to test [default is all users]
+        -- usersim: user-user similarity matrix for neighbor candidates [optional]
+
+        Returns:
+        -- A list of dictionaries, one per budget (plus one for the exact
+           algorithm, budget None), with recall of the exact top-N and mean,
+           p99 and max latency in ms
+
+    '''
+
+    if users is None:
+        users = list(prefs)
+    index = build_two_stage_index(prefs, sim_matrix if algo == getRecommendedItems else None)
+
+    exact = {}
+    times = []
+    for user in users:
+        t = time.time()
+        exact[user] = [item for (score, item) in algo(prefs, sim_matrix, user)[0:top_N]]
+        times.append(time.time() - t)
+    results = [{'budget': None, 'recall': 1.0, 'mean_ms': 1000 * float(np.average(times)),
+                'p99_ms': _percentile_ms(times, 99), 'max_ms': 1000 * max(times)}]
+
+    for budget in budgets:
+        times = []
+        hits = 0
+        total = 0
+        for user in users:
+            t = time.time()
+            recs = getRecommendationsTwoStage(prefs, sim_matrix, user, algo=algo, budget=budget,
+                                              usersim=usersim, **index)[0:top_N]
+            times.append(time.time() - t)
+            found = set([item for (score, item) in recs])
+            hits += len([item for item in exact[user] if item in found])
+            total += len(exact[user])
+        results.append({'budget': budget, 'recall': hits / total if total > 0 else float('nan'),
+                        'mean_ms': 1000 * float(np.average(times)),
+                        'p99_ms': _percentile_ms(times, 99), 'max_ms': 1000 * max(times)})
+
+    print('Budget'.ljust(10) + 'Recall@%d' % top_N + '   ' + 'Mean ms'.ljust(10) + 'p99 ms'.ljust(10) + 'Max ms')
+    for result in results:
+        print(str(result['budget'] or 'exact').ljust(10) + ('%.4f' % result['recall']).ljust(12) +
+              ('%.3f' % result['mean_ms']).ljust(10) + ('%.3f' % result['p99_ms']).ljust(10) +
+              '%.3f' % result['max_ms'])
+
+    return results
+
+
+def get_all_II_recs(prefs, itemsim, sim_method, num_users=10, top_N=5):
+    ''' Print item-based CF recommendations for all users in dataset
+
+        Parameters
+        -- prefs: U-I matrix (nested dictionary)
+        -- itemsim: item-item similarity matrix (nested dictionary)
+        -- sim_method: name of similarity method used to calc sim matrix (string)
+        -- num_users: max number of users to print (integer, default = 10)
+        -- top_N: max number of recommendations to print per user (integer, default = 5)
+
+        Returns:
+        -- None
+
+    '''
+
+    counter = 0
+
+    if num_users > 0:
+        for user in prefs:
+            if counter < num_users:
+                recs = getRecommendedItems(prefs, itemsim, user)
+                if len(recs) > top_N:
+                    recs = recs[0:top_N]
+                print('Item-based CF recs for %s, %s: ' %
+                      (user, sim_method), recs)
+            else:
+                break
+            counter += 1
+
+    return
+
+
+def loo_cv_sim(prefs, sim, algo, sim_matrix, sim_threshold=0, users=None):
+    ''' Leave-One_Out Evaluation: evaluates recommender system ACCURACY
+
+     Parameters:
+         -- prefs dataset: critics, MLK-100k
+         -- sim: distance, pearson
+         -- algo: user-based (getRecommendationSim), item-based recommender (getRecommendedItems)
+         -- sim_matrix: pre-computed similarity matrix
+         -- sim_threshold: minimum similarity to be considered a neighbor [default is >0]
+         -- users: only leave out the ratings of these users [default is all users]
+
+    Returns:
+         -- errors: MSE, MAE, RMSE totals for this set of conditions
+         -- error_lists: MSE and MAE lists of actual-predicted differences
+
+    '''
+
+    errors = {}
+    error_lists = {}
+    mse_list = []
+    mae_list = []
+    recs = []
+    c = 0
+
+    ### UNCOMMENT FOR DEBUG PRINTS ###
+    # pred_found = False
+
+
+    # create a temp copy of prefs (only the rows of users, if given)
+    prefs_cp, compact = _loo_working_copy(prefs, users)
+
+    if users is None:
+        users = prefs
+
+    # iterate through all users
+    previous = None
+    for user in users:
+        # progress status
+        c += 1
+        if c % 25 == 0:
+            percent_complete = (100*c)/len(users)
+            print("%.2f %% complete" % percent_complete)
+        _loo_row(prefs, prefs_cp, compact, user, previous)
+        previous = user
+
+        # iterate through user's ratings
+        for item in prefs[user]:
+            # remove a rating
+            removed_rating = prefs_cp[user].pop(item)
+            # get list of recommendations   
+            recs = algo(prefs_cp, sim_matrix, user, sim_threshold)
+            
+            # iterate through recommendations
+            for rec in recs:
+                # if this item is in the recommendations, calculate error
+                if item in rec:
+                    ### UNCOMMENT FOR DEBUG PRINTS ###
+                    # pred_found = True
+                    predicted_rating = rec[0]
+                    error_mse = (predicted_rating - removed_rating)**2
+                    error_mae = abs(predicted_rating - removed_rating)
+                    mse_list.append(error_mse)
+                    mae_list.append(error_mae)
+
+            ### UNCOMMENT FOR DEBUG PRINTS [use w/ small datasets or implement a way to limit these] ###
+                    # print('User : {}, Item: {}, Prediction {}, Actual: {}, Error: {}, Absolute Error: {}'.format(
+                    # user, item, predicted_rating, removed_rating, error_mse, error_mae))
+            # if pred_found == False:
+                # print('From loo_cv(), No prediction calculated for item {}, user {} in pred_list: {}'.format(
+                # item, user, recs))
+                # pass
+            # pred_found = False
+
+            # add the previously removed rating back
+            prefs_cp[user][item] = removed_rating
+
+    # average all errors (RMSE => square root the average)
+    errors['mse'] = np.average(mse_list)
+    errors['mae'] = np.average(mae_list)
+    errors['rmse'] = sqrt(np.average(mse_list))
+
+    error_lists['(r)mse'] = mse_list
+    error_lists['mae'] = mae_list
+
+    return errors, error_lists
+
+
+def loo_cv_sampled(prefs, algo, sim_matrix, sim_threshold=0, target_width=0.05, confidence=0.95,
+                   batch_size=200, max_samples=None, n_strata=4, min_predictions=30, seed=0):
+    ''' Sampled Leave-One-Out Evaluation: estimates recommender system ACCURACY
+
+        Ratings are left out in random batches, stratified by user activity
+        (each stratum is sampled in proportion to its number of ratings),
+        until the confidence intervals of MSE, MAE and RMSE are no wider than
+        target_width, or max_samples ratings have been tried.
+
+        Parameters:
+        -- prefs: dataset of critics, ml-100K, etc.
+        -- algo: user-based (getRecommendationSim), item-based recommender (getRecommendedItems)
+        -- sim_matrix: pre-computed similarity matrix
+        -- sim_threshold: minimum similarity to be considered a neighbor [default is >0]
+        -- target_width: full width of the confidence intervals to stop at [0.05 is default]
+        -- confidence: confidence level of the intervals [0.95 is default]
+        -- batch_size: number of ratings left out between checks [200 is default]
+        -- max_samples: max number of ratings to leave out [default is all of them]
+        -- n_strata: number of user activity strata [4 is default]
+        -- min_predictions: fewer predictions than this flags the configuration
+                            as too sparse to trust [30 is default]
+        -- seed: random seed, so that runs are repeatable [0 is default]
+
+        Returns:
+        -- errors: MSE, MAE, RMSE with (low, high) confidence intervals,
+                   n (predictions), samples (ratings left out), coverage
+                   (predictions / samples) and sparse (True if too few predictions)
+        -- error_lists: MSE and MAE lists of actual-predicted differences
+
+    '''
+
+    rng = np.random.default_rng(seed)
+    z = NormalDist().inv_cdf((1 + confidence) / 2)
+
+    # split users into strata of (roughly) equal size by number of ratings
+    users = sorted(prefs, key=lambda user: len(prefs[user]))
+    strata = []
+    for s in range(n_strata):
+        stratum = [(user, item) for user in users[s * len(users) // n_strata:
+                                                  (s + 1) * len(users) // n_strata]
+                   for item in prefs[user]]
+        if len(stratum) > 0:
+            strata.append([stratum[i] for i in rng.permutation(len(stratum))])
+    total = sum([len(stratum) for stratum in strata])
+    if max_samples is None:
+        max_samples = total
+
+    prefs_cp, compact = _loo_working_copy(prefs)
+    position = dict([(user, i) for i, user in enumerate(users)])
+    mse_list = []
+    mae_list = []
+    taken = [0] * len(strata)
+    samples = 0
+    errors = {}
+
+    while samples < min(max_samples, total):
+        # proportional allocation of the next batch over the strata
+        batch = []
+        for s, stratum in enumerate(strata):
+            want = int(round(len(stratum) * (samples + batch_size) / total)) - taken[s]
+            want = max(0, min(want, len(stratum) - taken[s]))
+            batch += stratum[taken[s]:taken[s] + want]
+            taken[s] += want
+        if len(batch) == 0:
+            break
+
+        # one user's samples in a row, so a compact copy copies each row once per batch
+        batch.sort(key=lambda sample: position[sample[0]])
+        current = None
+        for (user, item) in batch:
+            # remove a rating, predict it, add it back
+            if user != current:
+                _loo_row(prefs, prefs_cp, compact, user, current)
+                current = user
+            removed_rating = prefs_cp[user].pop(item)
+            recs = algo(prefs_cp, sim_matrix, user, sim_threshold)
+            for rec in recs:
+                if rec[1] == item:
+                    mse_list.append((rec[0] - removed_rating)**2)
+                    mae_list.append(abs(rec[0] - removed_rating))
+                    break
+            prefs_cp[user][item] = removed_rating
+        samples += len(batch)
+
+        errors = _sampled_errors(mse_list, mae_list, samples, z)
+        print('%d ratings sampled, %d predictions, MSE = %.5f +/- %.5f'
+              % (samples, errors['n'], errors['mse'], (errors['mse_ci'][1] - errors['mse_ci'][0]) / 2))
+
+        # stop once every interval is narrow enough
+        if errors['n'] >= min_predictions and \
+                max([errors[key][1] - errors[key][0] for key in ['mse_ci', 'mae_ci', 'rmse_ci']]) <= target_width:
+            break
+
+    if not errors:
+        errors = _sampled_errors(mse_list, mae_list, samples, z)
+    errors['sparse'] = errors['n'] < min_predictions
+
+    error_lists = {'(r)mse': mse_list, 'mae': mae_list}
+
+    return errors, error_lists
+
+
+def _sampled_errors(mse_list, mae_list, samples, z):
+    ''' Means and normal-approximation confidence intervals of sampled errors '''
+
+    nan = float('nan')
+    n = len(mse_list)
+    errors = {'n': n, 'samples': samples, 'coverage': n / samples if samples > 0 else 0.0}
+
+    if n == 0:
+        for key in ['mse', 'mae', 'rmse']:
+            errors[key] = nan
+            errors[key + '_ci'] = (nan, nan)
+        return errors
+
+    for key, values in [('mse', mse_list), ('mae', mae_list)]:
+        mean = float(np.average(values))
+        hw = z * float(np.std(values, ddof=1)) / sqrt(n) if n > 1 else float('inf')
+        errors[key] = mean
+        errors[key + '_ci'] = (mean - hw, mean + hw)
+
+    # delta method: d sqrt(x) = dx / (2 sqrt(x))
+    errors['rmse'] = sqrt(errors['mse'])
+    hw = (errors['mse_ci'][1] - errors['mse'])
+    hw = hw / (2 * errors['rmse']) if errors['rmse'] > 0 else hw
+    errors['rmse_ci'] = (max(errors['rmse'] - hw, 0), errors['rmse'] + hw)
+
+    return errors
+
+
+def screen_configurations(prefs, algos=('U', 'I'), sims=(sim_distance, sim_pearson),
+                          weightings=(0, 25, 50), thresholds=(0, 0.3, 0.5), **kwargs):
+    ''' Screens a grid of configurations with sampled LOO evaluation
+
+        Parameters:
+        -- prefs: dataset of critics, ml-100K, etc.
+        -- algos: 'U' (user-based) and/or 'I' (item-based)
+        -- sims: similarity functions
+        -- weightings: similarity significance weighting factors
+        -- thresholds: similarity thresholds
+        -- kwargs: passed on to loo_cv_sampled() (target_width, seed, ...)
+
+        Returns:
+        -- A list of dictionaries, one per configuration, with its settings
+           and the errors returned by loo_cv_sampled()
+
+    '''
+
+    results = []
+    for algo_name in algos:
+        for sim in sims:
+            for sim_weighting in weightings:
+                for sim_threshold in thresholds:
+                    # many matrices to build: the batched kernels
+                    if algo_name == 'I':
+                        algo = getRecommendedItems
+                        sim_matrix = calculateSimilarItems(prefs, similarity=sim, sim_weighting=sim_weighting,
+                                                           sim_threshold=sim_threshold, batched=True)
+                    else:
+                        algo = getRecommendationSim
+                        sim_matrix = calculateSimilarUsers(prefs, similarity=sim, sim_weighting=sim_weighting,
+                                                           sim_threshold=sim_threshold, batched=True)
+
+                    errors, error_lists = loo_cv_sampled(prefs, algo, sim_matrix, sim_threshold, **kwargs)
+                    results.append({'algo': algo.__name__, 'similarity': sim.__name__,
+                                    'sim_weighting': sim_weighting, 'sim_threshold': sim_threshold,
+                                    'errors': errors})
+
+    print()
+    print('Algorithm'.ljust(22) + 'Similarity'.ljust(22) + 'Weight'.ljust(8) + 'Thresh'.ljust(8) +
+          'MSE (CI)'.ljust(26) + 'MAE'.ljust(10) + 'RMSE'.ljust(10) + 'Coverage')
+    for result in results:
+        errors = result['errors']
+        print(result['algo'].ljust(22) + result['similarity'].ljust(22) +
+              str(result['sim_weighting']).ljust(8) + ('>%s' % result['sim_threshold']).ljust(8) +
+              ('%.4f (%.4f-%.4f)' % (errors['mse'], errors['mse_ci'][0], errors['mse_ci'][1])).ljust(26) +
+              ('%.4f' % errors['mae']).ljust(10) + ('%.4f' % errors['rmse']).ljust(10) +
+              ('%.2f%%' % (100 * errors['coverage'])) + ('  TOO SPARSE' if errors['sparse'] else ''))
+
+    return results
+
+
+def split_prefs_holdout(prefs, test_size=0.2, seed=0):
+    ''' Splits the U-I matrix into a training and a held-out (test) set
+
+        Parameters:
+        -- prefs: dictionary containing user-item matrix
+        -- test_size: fraction of each user's ratings to hold out [0.2 is default]
+        -- seed: random seed, so that splits are repeatable [0 is default]
+
+        Returns:
+        -- train: user-item matrix with the held-out ratings removed
+        -- test: user-item matrix containing only the held-out ratings
+
+    '''
+
+    rng = np.random.default_rng(seed)
+    train = {}
+    test = {}
+
+    for user in prefs:
+        items = list(prefs[user])
+        # keep at least one rating per user in the training set
+        n_test = min(int(round(len(items) * test_size)), len(items) - 1)
+        held_out = set()
+        if n_test > 0:
+            held_out = set(rng.choice(len(items), n_test, replace=False))
+
+        train[user] = {}
+        for i, item in enumerate(items):
+            if i in held_out:
+                test.setdefault(user, {})
+                test[user][item] = prefs[user][item]
+            else:
+                train[user][item] = prefs[user][item]
+
+    return train, test
+
+
+def get_all_top_n(prefs, sim_matrix, algo, top_N=10, sim_threshold=0, users=None):
+    ''' Calculates top-N recommendations for all users in dataset
+
+        Parameters:
+        -- prefs: dictionary containing user-item matrix
+        -- sim_matrix: pre-computed similarity matrix
+        -- algo: user-based (getRecommendationSim), item-based recommender (getRecommendedItems)
+        -- top_N: max number of recommendations to keep per user [10 is default]
+        -- sim_threshold: minimum similarity to be considered a neighbor [default is >0]
+        -- users: users to calculate recommendations for [default is all users]
+
+        Returns:
+        -- A dictionary mapping each user to a list of recommended items,
+           sorted high to low by predicted rating.
+
+    '''
+
+    if users is None:
+        users = prefs
+
+    top_n = {}
+    for user in users:
+        recs = algo(prefs, sim_matrix, user, sim_threshold)
+        top_n[user] = [item for (score, item) in recs[0:top_N]]
+
+    return top_n
+
+
+_batch_state = {}
+
+
+def _batch_init(prefs, sim_matrix, algo, top_N, sim_threshold, directory, item_ids):
+    ''' Pool initializer: keeps the model in the worker (shared copy-on-write
+        with the fork start method) '''
+
+    _batch_state.update(prefs=prefs, sim_matrix=sim_matrix, algo=algo, top_N=top_N,
+                        sim_threshold=sim_threshold, directory=directory, item_ids=item_ids)
+
+
+def _batch_task(task):
+    ''' Pool task: scores one chunk of users and writes their rows in place '''
+
+    chunk, start, users = task
+    st = _batch_state
+    items = np.load(os.path.join(st['directory'], 'items.npy'), mmap_mode='r+')
+    scores = np.load(os.path.join(st['directory'], 'scores.npy'), mmap_mode='r+')
+
+    for r, user in enumerate(users):
+        recs = st['algo'](st['prefs'], st['sim_matrix'], user, st['sim_threshold'])[0:st['top_N']]
+        items[start + r, :] = -1
+        scores[start + r, :] = np.nan
+        items[start + r, 0:len(recs)] = [st['item_ids'][item] for (score, item) in recs]
+        scores[start + r, 0:len(recs)] = [score for (score, item) in recs]
+
+    # the chunk is on disk before it is reported (and checkpointed) as done
+    items.flush()
+    scores.flush()
+    del items, scores
+
+    return chunk
+
+
+def write_all_recs(prefs, sim_matrix, algo, directory='batch_recs', sim_method='', top_N=10,
+                   sim_threshold=0, chunk_size=100, n_workers=1, sim_weighting=0):
+    ''' Offline batch job: top-N recommendations for every user, written to
+        a compact columnar file set
+
+        Files in directory:
+        -- items.npy: int32 (users x top_N) item ids, -1 pads short lists
+        -- scores.npy: float32 (users x top_N) predicted ratings, nan pads
+        -- users.txt / items.txt: one name per line, the line number is the id
+        -- job.p: the job's configuration; done.txt: finished chunk ids
+
+        Row r holds the r-th user's list, so a lookup is one seek of
+        r * top_N * 4 bytes past the .npy header. Users are scored in chunks
+        that are checkpointed as they finish; running the same job again
+        skips the finished chunks.
+
+        Parameters:
+        -- prefs: dictionary containing user-item matrix
+        -- sim_matrix: pre-computed similarity matrix
+        -- algo: user-based (getRecommendationSim), item-based recommender (getRecommendedItems)
+        -- directory: directory to write the files to ['batch_recs' is default]
+        -- sim_method: name of the similarity method, recorded with the job
+        -- top_N: max number of recommendations per user [10 is default]
+        -- sim_threshold: minimum similarity to be considered a neighbor [default is >0]
+        -- chunk_size: number of users per checkpointed chunk [100 is default]
+        -- n_workers: number of worker processes (1 is default, no pool)
+        -- sim_weighting: significance weighting the matrix was built with,
+                          recorded with the job [0 is default]
+
+        Returns:
+        -- A dictionary with users, chunks, chunks resumed and seconds
+
+    '''
+
+    job = {'fingerprint': dataset_fingerprint(prefs), 'algo': algo.__name__,
+           'sim_method': sim_method, 'sim_weighting': sim_weighting, 'top_N': top_N,
+           'sim_threshold': float(sim_threshold), 'matrix': sim_matrix_fingerprint(sim_matrix),
+           'chunk_size': chunk_size}
+    users = list(prefs)
+    chunks = [users[i:i + chunk_size] for i in range(0, len(users), chunk_size)]
+    job_path = os.path.join(directory, 'job.p')
+    done_path = os.path.join(directory, 'done.txt')
+
+    # resume only a job with the same configuration, on the same ratings
+    done = set()
+    if os.path.exists(job_path) and os.path.exists(done_path):
+        with open(job_path, 'rb') as f:
+            if pickle.load(f) == job:
+                with open(done_path) as f:
+                    done = set([int(line) for line in f if line.strip() != ''])
+                print('Resuming batch job, %d of %d chunks done' % (len(done), len(chunks)))
+
+    items = sorted(set([item for user in prefs for item in prefs[user]]))
+    item_ids = dict([(item, i) for i, item in enumerate(items)])
+    if len(done) == 0:
+        os.makedirs(directory, exist_ok=True)
+        np.lib.format.open_memmap(os.path.join(directory, 'items.npy'), mode='w+',
+                                  dtype=np.int32, shape=(len(users), top_N))[:] = -1
+        np.lib.format.open_memmap(os.path.join(directory, 'scores.npy'), mode='w+',
+                                  dtype=np.float32, shape=(len(users), top_N))[:] = np.nan
+        with open(os.path.join(directory, 'users.txt'), 'w') as f:
+            f.write(''.join([user + '\n' for user in users]))
+        with open(os.path.join(directory, 'items.txt'), 'w') as f:
+            f.write(''.join([item + '\n' for item in items]))
+        with open(job_path, 'wb') as f:
+            pickle.dump(job, f)
+        open(done_path, 'w').close()
+
+    tasks = [(c, c * chunk_size, chunks[c]) for c in range(len(chunks)) if c not in done]
+    start = time.time()
+    with open(done_path, 'a') as checkpoint:
+        def finished(chunk):
+            checkpoint.write('%d\n' % chunk)
+            checkpoint.flush()
+            os.fsync(checkpoint.fileno())
+            print('Chunk %d of %d done' % (len(done) + 1, len(chunks)))
+            done.add(chunk)
+
+        if n_workers > 1:
+            pool = multiprocessing.Pool(n_workers, initializer=_batch_init,
+                                        initargs=(prefs, sim_matrix, algo, top_N, sim_threshold,
+                                                  directory, item_ids))
+            try:
+                for chunk in pool.imap_unordered(_batch_task, tasks):
+                    finished(chunk)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            _batch_init(prefs, sim_matrix, algo, top_N, sim_threshold, directory, item_ids)
+            for task in tasks:
+                finished(_batch_task(task))
+
+    return {'users': len(users), 'chunks': len(chunks), 'resumed': len(chunks) - len(tasks),
+            'seconds': time.time() - start}
+
+
+def load_all_recs(directory='batch_recs', mmap_mode='r'):
+    ''' Opens the files written by write_all_recs() for lookups
+
+        Parameters:
+        -- directory: directory containing the files ['batch_recs' is default]
+        -- mmap_mode: numpy memory-map mode ['r' is default, None loads them]
+
+        Returns:
+        -- A dictionary with items, scores (arrays), users, item_names and
+           user_index (name -> row)
+
+    '''
+
+    with open(os.path.join(directory, 'users.txt')) as f:
+        users = f.read().split('\n')[0:-1]
+    with open(os.path.join(directory, 'items.txt')) as f:
+        item_names = f.read().split('\n')[0:-1]
+
+    return {'items': np.load(os.path.join(directory, 'items.npy'), mmap_mode=mmap_mode),
+            'scores': np.load(os.path.join(directory, 'scores.npy'), mmap_mode=mmap_mode),
+            'users': users, 'item_names': item_names,
+            'user_index': dict([(user, r) for r, user in enumerate(users)])}
+
+
+def lookup_recs(store, user):
+    ''' Returns a user's precomputed recommendations from load_all_recs()
+
+        Returns:
+        -- A list of (predicted rating, item name), high to low; an empty
+           list for unknown users
+
+    '''
+
+    if user not in store['user_index']:
+        return []
+    r = store['user_index'][user]
+    items, scores = store['items'][r], store['scores'][r]
+
+    return [(float(scores[i]), store['item_names'][items[i]]) for i in range(len(items))
+            if items[i] >= 0]
+
+
+def _ranking_block(rec_idx, rel_keys, n_rel, n_items, k):
+    ''' Calculates per-user ranking metrics for one block of users
+
+        Parameters:
+        -- rec_idx: (users x k) matrix of recommended item indexes, -1 = empty slot
+        -- rel_keys: sorted array of (user * n_items + item) keys of relevant items
+        -- n_rel: number of relevant (held-out) items per user in this block
+        -- n_items: number of items in the catalog
+        -- k: cut-off of the ranked lists
+
+        Returns:
+        -- precision, recall, ndcg, ap: arrays with one value per user
+
+    '''
+
+    rows = np.arange(rec_idx.shape[0]).reshape(-1, 1)
+    keys = rows * n_items + rec_idx
+
+    # a slot is a hit if it is filled and (user, item) was held out as relevant
+    if len(rel_keys) > 0:
+        pos = np.searchsorted(rel_keys, keys)
+        pos[pos >= len(rel_keys)] = 0
+        hits = (rec_idx >= 0) & (rel_keys[pos] == keys)
+    else:
+        hits = np.zeros(rec_idx.shape, dtype=bool)
+
+    n_hits = hits.sum(axis=1)
+    n_rel_safe = np.where(n_rel > 0, n_rel, 1)
+
+    precision = n_hits / k
+    recall = n_hits / n_rel_safe
+
+    # discounted cumulative gain, normalized by the ideal ordering
+    discounts = 1 / np.log2(np.arange(2, k + 2))
+    dcg = (hits * discounts).sum(axis=1)
+    ideal = np.concatenate(([0], np.cumsum(discounts)))
+    idcg = ideal[np.minimum(n_rel, k)]
+    ndcg = dcg / np.where(idcg > 0, idcg, 1)
+
+    # average precision, truncated at k
+    cum_hits = np.cumsum(hits, axis=1)
+    prec_at_i = cum_hits / np.arange(1, k + 1)
+    ap = (prec_at_i * hits).sum(axis=1) / np.minimum(n_rel_safe, k)
+
+    return precision, recall, ndcg, ap
+
+
+def ranking_metrics(top_n, test, k=10, relevance_threshold=4.0, n_items=None, n_jobs=1, block_size=10000):
+    ''' Top-N Evaluation: evaluates recommender system RANKING quality
+
+        Parameters:
+        -- top_n: dictionary mapping each user to a ranked list of recommended items
+        -- test: held-out user-item matrix (nested dictionary)
+        -- k: cut-off of the ranked lists [10 is default]
+        -- relevance_threshold: minimum held-out rating for an item to count as
+                                relevant [4.0 is default]
+        -- n_items: number of items in the catalog, used for coverage
+                    [default is the number of distinct items in top_n and test]
+        -- n_jobs: number of threads evaluating blocks of users in parallel [1 is default]
+        -- block_size: number of users per block [10000 is default]
+
+        Returns:
+        -- metrics: precision@k, recall@k, ndcg@k, map@k (averaged over users
+                    with at least one relevant item) and catalog coverage
+        -- metric_lists: per-user precision, recall, ndcg and ap arrays
+
+    '''
+
+    users = [user for user in top_n if user in test]
+
+    # map items to contiguous integer indexes
+    item_index = {}
+    for user in top_n:
+        for item in top_n[user]:
+            item_index.setdefault(item, len(item_index))
+    for user in test:
+        for item in test[user]:
+            item_index.setdefault(item, len(item_index))
+    n_idx = max(len(item_index), 1)
+
+    # ranked lists as a (users x k) matrix, padded with -1
+    rec_idx = np.full((len(users), k), -1, dtype=np.int64)
+    for u, user in enumerate(users):
+        row = [item_index[item] for item in top_n[user][0:k]]
+        rec_idx[u, 0:len(row)] = row
+
+    # relevant held-out items as sorted (user, item) keys
+    rel_keys = []
+    n_rel = np.zeros(len(users), dtype=np.int64)
+    for u, user in enumerate(users):
+        for item, rating in test[user].items():
+            if rating >= relevance_threshold:
+                rel_keys.append(u * n_idx + item_index[item])
+                n_rel[u] += 1
+    rel_keys = np.sort(np.array(rel_keys, dtype=np.int64))
+
+    # evaluate blocks of users, optionally in parallel (numpy releases the GIL)
+    blocks = []
+    for start in range(0, len(users), block_size):
+        stop = min(start + block_size, len(users))
+        lo, hi = np.searchsorted(rel_keys, [start * n_idx, stop * n_idx])
+        blocks.append((rec_idx[start:stop], rel_keys[lo:hi] - start * n_idx,
+                       n_rel[start:stop], n_idx, k))
+
+    if n_jobs > 1 and len(blocks) > 1:
+        with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+            results = list(pool.map(lambda b: _ranking_block(*b), blocks))
+    else:
+        results = [_ranking_block(*b) for b in blocks]
+
+    metric_lists = {}
+    for i, name in enumerate(['precision', 'recall', 'ndcg', 'ap']):
+        if results:
+            metric_lists[name] = np.concatenate([r[i] for r in results])
+        else:
+            metric_lists[name] = np.zeros(0)
+
+    # only users with at least one relevant item take part in the averages
+    has_rel = n_rel > 0
+    metrics = {}
+    for name, key in [('precision', 'precision'), ('recall', 'recall'),
+                      ('ndcg', 'ndcg'), ('map', 'ap')]:
+        if has_rel.any():
+            metrics['%s@%d' % (name, k)] = np.average(metric_lists[key][has_rel])
+        else:
+            metrics['%s@%d' % (name, k)] = float('nan')
+
+    # catalog coverage: fraction of the catalog recommended to at least one user
+    if n_items is None:
+        n_items = len(item_index)
+    recommended = np.unique(rec_idx[rec_idx >= 0])
+    metrics['coverage'] = len(recommended) / n_items if n_items > 0 else 0.0
+    metrics['users'] = int(has_rel.sum())
+
+    return metrics, metric_lists
+
+
+def id_order(prefs, order='degree'):
+    ''' Orders the user and item names for cache locality
+
+        Parameters:
+        -- prefs: dictionary containing user-item matrix
+        -- order: 'file': first seen, as read;
+                  'degree': most ratings first, so the rows that most
+                      kernels touch are next to each other;
+                  'rcm': reverse Cuthill-McKee on the bipartite user-item
+                      graph, users who rated the same items (and items rated
+                      by the same users) get nearby ids, which keeps the
+                      ratings of the CSR store close to its diagonal
+                  ['degree' is default]
+
+        Returns:
+        -- users, items: lists of names, the list position is the new id
+
+        The order is passed (order=) to prefs_to_arrays() and the functions
+        built on it: the similarity builders, co_rating_counts(), train_mf()
+        and publish_shared_model(). Ids never leave their structures,
+        everything they return is keyed by name, so the order changes
+        locality, not results.
+
+    '''
+
+    store = prefs_to_arrays(prefs, order='file')
+    users, items = store['users'], store['items']
+    user_degree, item_degree = np.diff(store['indptr']), np.diff(store['item_indptr'])
+    if order == 'file':
+        return users, items
+    if order == 'degree':
+        return ([users[u] for u in np.argsort(-user_degree, kind='stable')],
+                [items[i] for i in np.argsort(-item_degree, kind='stable')])
+    if order != 'rcm':
+        raise ValueError("order must be 'file', 'degree' or 'rcm'")
+
+    # one graph: nodes 0..n_users-1 are the users, the items follow
+    n_users = len(users)
+    degree = np.concatenate((user_degree, item_degree))
+    indptr = np.concatenate((store['indptr'], store['item_indptr'][1:] + store['indptr'][-1]))
+    indices = np.concatenate((store['indices'] + n_users, store['item_indices']))
+
+    # breadth-first from a lowest-degree node of every connected component,
+    # neighbors are queued by increasing degree
+    visited = np.zeros(len(degree), dtype=bool)
+    nodes = []
+    for start in np.argsort(degree, kind='stable'):
+        if visited[start]:
+            continue
+        visited[start] = True
+        queue = [int(start)]
+        head = 0
+        while head < len(queue):
+            node = queue[head]
+            head += 1
+            neighbors = indices[indptr[node]:indptr[node + 1]]
+            neighbors = neighbors[~visited[neighbors]]
+            neighbors = neighbors[np.argsort(degree[neighbors], kind='stable')]
+            visited[neighbors] = True
+            queue += neighbors.tolist()
+        nodes += queue
+    nodes.reverse()
+
+    return ([users[node] for node in nodes if node < n_users],
+            [items[node - n_users] for node in nodes if node >= n_users])
+
+
+def reorder_prefs(prefs, order='degree'):
+    ''' Copy of prefs with users and every user's items in id_order() order,
+        for the dictionary code paths (same ratings, same results) '''
+
+    users, items = id_order(prefs, order)
+    position = dict([(item, i) for i, item in enumerate(items)])
+
+    return dict([(user, dict([(item, prefs[user][item]) for item in sorted(prefs[user], key=position.get)]))
+                 for user in users])
+
+
+def benchmark_id_order(prefs, orders=('file', 'degree', 'rcm'), similarity=sim_pearson, loo_users=10):
+    ''' Times the similarity build, batch scoring and LOO with the user and
+        item ids in each order
+
+        Parameters:
+        -- prefs: dictionary containing user-item matrix
+        -- orders: id orders to compare, see id_order()
+        -- similarity: similarity of the item-item matrix [sim_pearson is default]
+        -- loo_users: number of users left out in the loo_cv_sim() stage
+
+        Returns:
+        -- A list of dictionaries (order, gap, reorder, sim, batch, loo, mse),
+           gap being the average distance between consecutive item ids of a
+           user's row, the stages in seconds, mse the LOO error (the same for
+           every order)
+
+    '''
+
+    loo_set = list(prefs)[0:loo_users]
+    results = []
+    for order in orders:
+        result = {'order': order}
+        t = time.time()
+        rowPrefs = prefs if order == 'file' else reorder_prefs(prefs, order)
+        store = prefs_to_arrays(rowPrefs, order)
+        result['reorder'] = time.time() - t
+        gaps = np.diff(store['indices'])
+        result['gap'] = float(np.average(gaps[gaps > 0]))
+
+        # the batched build is the one laid out by the id order
+        t = time.time()
+        itemsim = calculateSimilarItems(rowPrefs, similarity=similarity, order=order)
+        result['sim'] = time.time() - t
+
+        t = time.time()
+        for user in rowPrefs:
+            getRecommendedItems(rowPrefs, itemsim, user)[0:10]
+        result['batch'] = time.time() - t
+
+        t = time.time()
+        errors, error_lists = loo_cv_sim(rowPrefs, similarity, getRecommendedItems, itemsim,
+                                         users=loo_set)
+        result['loo'] = time.time() - t
+        result['mse'] = errors['mse']
+        results.append(result)
+
+    print('Order'.ljust(8) + 'Id gap'.ljust(10) + 'Reorder'.ljust(10) + 'Sim'.ljust(10) +
+          'Batch'.ljust(10) + ('LOO(%d)' % loo_users).ljust(10) + 'MSE')
+    for result in results:
+        print(result['order'].ljust(8) + ('%.1f' % result['gap']).ljust(10) +
+              ('%.2f' % result['reorder']).ljust(10) + ('%.2f' % result['sim']).ljust(10) +
+              ('%.2f' % result['batch']).ljust(10) + ('%.2f' % result['loo']).ljust(10) +
+              '%.5f' % result['mse'])
+
+    return results
+
+
+def prefs_to_arrays(prefs, order='file'):
+    ''' Converts the U-I matrix (prefs dictionary) into index-based arrays
+
+        Parameters:
+        -- prefs: dictionary containing user-item matrix
+        -- order: id order, see id_order() ['file' is default]
+
+        Returns:
+        -- A dictionary (rating store) containing:
+           users, items: lists mapping integer indexes back to names
+           user_index, item_index: dictionaries mapping names to indexes
+           indptr, indices, ratings: user-major (CSR) arrays, the ratings of
+               user u are ratings[indptr[u]:indptr[u+1]] for the items
+               indices[indptr[u]:indptr[u+1]] (sorted by item index)
+           item_indptr, item_indices, item_ratings: the same, item-major
+
+    '''
+
+    if order == 'file':
+        users = list(prefs)
+        item_index = {}
+        for user in prefs:
+            for item in prefs[user]:
+                item_index.setdefault(item, len(item_index))
+        items = list(item_index)
+    else:
+        users, items = id_order(prefs, order)
+        item_index = {item: i for i, item in enumerate(items)}
+    user_index = {user: u for u, user in enumerate(users)}
+
+    n_ratings = sum([len(prefs[user]) for user in prefs])
+    row = np.zeros(n_ratings, dtype=np.int64)
+    col = np.zeros(n_ratings, dtype=np.int64)
+    val = np.zeros(n_ratings, dtype=np.float64)
+    c = 0
+    for u, user in enumerate(users):
+        for item, rating in prefs[user].items():
+            row[c] = u
+            col[c] = item_index[item]
+            val[c] = rating
+            c += 1
+
+    store = {'users': users, 'items': items,
+             'user_index': user_index, 'item_index': item_index}
+
+    # user-major layout, items sorted within each user
+    order = np.lexsort((col, row))
+    store['indptr'] = np.concatenate(
+        ([0], np.cumsum(np.bincount(row, minlength=len(users)))))
+    store['indices'] = col[order]
+    store['ratings'] = val[order]
+
+    # item-major layout, users sorted within each item
+    order = np.lexsort((row, col))
+    store['item_indptr'] = np.concatenate(
+        ([0], np.cumsum(np.bincount(col, minlength=len(items)))))
+    store['item_indices'] = row[order]
+    store['item_ratings'] = val[order]
+
+    return store
+
+
+def _als_solve(indptr, indices, values, other, reg, block_nnz=None):
+    ''' Solves the regularized least squares problem of one ALS half-step
+
+        Parameters:
+        -- indptr, indices, values: CSR arrays of the rows being solved for
+        -- other: factor matrix of the fixed side (indexed by indices)
+        -- reg: regularization, scaled by the number of ratings in each row
+        -- block_nnz: number of ratings whose k x k terms are built at once
+                      [default is None, as many as fit in about 64 MB]
+
+        Returns:
+        -- A factor matrix with one row per CSR row
+
+    '''
+
+    n_rows = len(indptr) - 1
+    k = other.shape[1]
+    result = np.zeros((n_rows, k))
+    eye = np.eye(k)
+    if block_nnz is None:
+        block_nnz = max(1, (1 << 23) // (k * k))
+
+    start = 0
+    while start < n_rows:
+        # as many rows as fit in block_nnz ratings (a longer row is a block of its own)
+        stop = int(np.searchsorted(indptr, indptr[start] + block_nnz, side='right')) - 1
+        stop = min(max(stop, start + 1), n_rows)
+        lo, hi = indptr[start], indptr[stop]
+        counts = np.diff(indptr[start:stop + 1])
+        nonempty = counts > 0
+
+        # gather the fixed factors of every rating in the block
+        Y = other[indices[lo:hi]]
+        rhs = Y * values[lo:hi, None]
+
+        # sum the per-rating terms into per-row normal equations
+        A = np.zeros((stop - start, k, k))
+        b = np.zeros((stop - start, k))
+        if stop - start == 1:
+            A[0] = Y.T @ Y
+            b[0] = rhs.sum(axis=0)
+        elif hi > lo:
+            outer = Y[:, :, None] * Y[:, None, :]
+            seg = indptr[start:stop][nonempty] - lo
+            A[nonempty] = np.add.reduceat(outer, seg, axis=0)
+            b[nonempty] = np.add.reduceat(rhs, seg, axis=0)
+        A += reg * np.maximum(counts, 1)[:, None, None] * eye
+
+        # batched solve, runs through (multithreaded) LAPACK
+        result[start:stop] = np.linalg.solve(A, b[:, :, None])[:, :, 0]
+        start = stop
+
+    return result
+
+
+def train_mf(prefs, factors=10, reg=0.1, iterations=15, method='als', learning_rate=0.01,
+             batch_size=4096, seed=0, verbose=True, order='file'):
+    ''' Trains a matrix factorization (latent factor) model
+
+        Parameters:
+        -- prefs: dictionary containing user-item matrix
+        -- factors: number of latent factors [10 is default]
+        -- reg: regularization factor [0.1 is default]
+        -- iterations: number of ALS sweeps or SGD epochs [15 is default]
+        -- method: 'als' (alternating least squares) or 'sgd' (mini-batch
+                   stochastic gradient descent) ['als' is default]
+        -- learning_rate: SGD step size [0.01 is default]
+        -- batch_size: number of ratings per SGD mini-batch [4096 is default]
+        -- seed: random seed for the initial factors [0 is default]
+        -- verbose: print the training error after every iteration
+        -- order: id order of the factor rows, see id_order() ['file' is default]
+
+        Returns:
+        -- A dictionary with the model: P (user factors), Q (item factors),
+           mu (global mean), reg, method, reg_scaled (whether reg is scaled
+           by the number of ratings), users, items, user_index, item_index
+           and the rating range used to clip predictions
+
+    '''
+
+    store = prefs_to_arrays(prefs, order)
+    rng = np.random.default_rng(seed)
+    n_users, n_items = len(store['users']), len(store['items'])
+
+    mu = np.average(store['ratings']) if len(store['ratings']) > 0 else 0.0
+    residual = store['ratings'] - mu
+    item_residual = store['item_ratings'] - mu
+    row = np.repeat(np.arange(n_users), np.diff(store['indptr']))
+    col = store['indices']
+
+    P = rng.normal(scale=0.1, size=(n_users, factors))
+    Q = rng.normal(scale=0.1, size=(n_items, factors))
+
+    for it in range(iterations):
+        if method == 'sgd':
+            # vectorized mini-batch SGD over a shuffled rating order
+            order = rng.permutation(len(residual))
+            for start in range(0, len(order), batch_size):
+                batch = order[start:start + batch_size]
+                u, i = row[batch], col[batch]
+                err = residual[batch] - np.sum(P[u] * Q[i], axis=1)
+                grad_p = err[:, None] * Q[i] - reg * P[u]
+                grad_q = err[:, None] * P[u] - reg * Q[i]
+                np.add.at(P, u, learning_rate * grad_p)
+                np.add.at(Q, i, learning_rate * grad_q)
+        else:
+            # each half-step is exact given the other side's factors
+            P = _als_solve(store['indptr'], store['indices'], residual, Q, reg)
+            Q = _als_solve(store['item_indptr'], store['item_indices'], item_residual, P, reg)
+
+        if verbose:
+            err = residual - np.sum(P[row] * Q[col], axis=1)
+            print('%s iteration %d: training RMSE = %.5f' %
+                  (method.upper(), it + 1, sqrt(np.average(err**2))))
+
+    # ALS scales reg by each row's number of ratings, SGD uses it as is
+    model = {'P': P, 'Q': Q, 'mu': mu, 'reg': reg, 'method': method,
+             'reg_scaled': method != 'sgd',
+             'users': store['users'], 'items': store['items'],
+             'user_index': store['user_index'], 'item_index': store['item_index'],
+             'min_rating': float(np.min(store['ratings'])) if len(store['ratings']) > 0 else 0.0,
+             'max_rating': float(np.max(store['ratings'])) if len(store['ratings']) > 0 else 0.0}
+
+    return model
+
+
+def predict_mf(model, user, item):
+    ''' Predicts a single rating with a matrix factorization model
+
+        Parameters:
+        -- model: dictionary returned by train_mf() or load_mf_model()
+        -- user: string containing name of user
+        -- item: string containing name of item
+
+        Returns:
+        -- The predicted rating as a float, or None for an unknown user/item
+
+    '''
+
+    if user not in model['user_index'] or item not in model['item_index']:
+        return None
+
+    pred = model['mu'] + np.dot(model['P'][model['user_index'][user]],
+                                model['Q'][model['item_index'][item]])
+
+    return float(min(max(pred, model['min_rating']), model['max_rating']))
+
+
+def fold_in_user(model, ratings):
+    ''' Solves a user's factors from their ratings with the item factors
+        fixed (the ALS user half-step for one row), with the model's form of
+        regularization: reg times the number of ratings (ALS) or reg (SGD)
+
+        Parameters:
+        -- model: dictionary returned by train_mf() or load_mf_model()
+        -- ratings: dictionary mapping items to the user's ratings
+
+        Returns:
+        -- The user's factor vector (zeros when no rated item is in the model)
+
+    '''
+
+    k = model['Q'].shape[1]
+    rated = [(model['item_index'][item], rating) for item, rating in ratings.items()
+             if item in model['item_index'] and rating != 0]
+    if len(rated) == 0:
+        return np.zeros(k)
+
+    Y = model['Q'][[i for (i, rating) in rated]]
+    r = np.array([rating for (i, rating) in rated]) - model['mu']
+    reg = model.get('reg', 0.1)
+    if model.get('reg_scaled', True):
+        reg *= len(rated)
+    A = Y.T @ Y + reg * np.eye(k)
+
+    return np.linalg.solve(A, Y.T @ r)
+
+
+def getRecommendationsMF(prefs, model, user, sim_threshold=0):
+    ''' Returns matrix factorization recommendations
+
+        Has the same signature as getRecommendationSim() and
+        getRecommendedItems(), so it can be used with loo_cv_sim() and
+        get_all_top_n() by passing the model in place of the sim matrix.
+        The user's factors are folded in from their ratings in prefs (see
+        fold_in_user()), so a rating left out of prefs, as loo_cv_sim()
+        does, is never used to predict itself.
+
+        Parameters:
+        -- prefs: dictionary containing user-item matrix
+        -- model: dictionary returned by train_mf() or load_mf_model()
+        -- user: string containing name of user
+        -- sim_threshold: unused, there are no neighbors in a latent factor model
+
+        Returns:
+        -- A list of recommended items with 0 or more tuples,
+           each tuple contains (predicted rating, item name).
+           List is sorted, high to low, by predicted rating.
+           An empty list is returned when no recommendations have been calc'd.
+
+    '''
+
+    if user not in model['user_index']:
+        return []
+
+    preds = model['mu'] + model['Q'] @ fold_in_user(model, prefs.get(user, {}))
+    preds = np.clip(preds, model['min_rating'], model['max_rating'])
+
+    rated = prefs.get(user, {})
+    recs = [(float(preds[i]), item) for i, item in enumerate(model['items'])
+            if item not in rated or rated[item] == 0]
+
+    recs = sorted(recs, key=lambda x: x[0], reverse=True)
+
+    return recs
+
+
+def save_mf_model(model, directory):
+    ''' Saves a matrix factorization model to a directory
+
+        The factor matrices are written as .npy files so that they can be
+        memory-mapped when loaded; the rest of the model is pickled.
+
+        Parameters:
+        -- model: dictionary returned by train_mf()
+        -- directory: directory to write the model files to
+
+        Returns:
+        -- None
+
+    '''
+
+    os.makedirs(directory, exist_ok=True)
+    np.save(os.path.join(directory, 'P.npy'), model['P'])
+    np.save(os.path.join(directory, 'Q.npy'), model['Q'])
+
+    meta = {key: model[key] for key in model if key not in ('P', 'Q')}
+    with open(os.path.join(directory, 'model.p'), 'wb') as f:
+        pickle.dump(meta, f)
+
+    return
+
+
+def load_mf_model(directory, mmap_mode='r'):
+    ''' Loads a matrix factorization model saved with save_mf_model()
+
+        Parameters:
+        -- directory: directory containing the model files
+        -- mmap_mode: numpy memory-map mode for the factor matrices
+                      ['r' is default, None loads them into memory]
+
+        Returns:
+        -- A model dictionary, as returned by train_mf()
+
+    '''
+
+    with open(os.path.join(directory, 'model.p'), 'rb') as f:
+        model = pickle.load(f)
+    model['P'] = np.load(os.path.join(directory, 'P.npy'), mmap_mode=mmap_mode)
+    model['Q'] = np.load(os.path.join(directory, 'Q.npy'), mmap_mode=mmap_mode)
+
+    return model
+
+
+def sim_matrix_to_arrays(sim_matrix, index):
+    ''' Converts a similarity matrix (nested dictionary) into CSR arrays
+
+        Parameters:
+        -- sim_matrix: dictionary mapping each row to a list of (similarity, name)
+        -- index: dictionary mapping names to integer indexes (e.g. the
+                  user_index or item_index of a rating store)
+
+        Returns:
+        -- A dictionary with indptr, neighbors (integer indexes) and sims;
+           the neighbors of row r are neighbors[indptr[r]:indptr[r+1]],
+           in the same (high to low) order as the similarity matrix
+
+    '''
+
+    lens = np.zeros(len(index), dtype=np.int64)
+    for name, r in index.items():
+        lens[r] = len(sim_matrix.get(name, []))
+    indptr = np.concatenate(([0], np.cumsum(lens)))
+
+    neighbors = np.zeros(indptr[-1], dtype=np.int64)
+    sims = np.zeros(indptr[-1], dtype=np.float64)
+    for name, r in index.items():
+        row = sim_matrix.get(name, [])
+        neighbors[indptr[r]:indptr[r + 1]] = [index[other] for (sim, other) in row]
+        sims[indptr[r]:indptr[r + 1]] = [sim for (sim, other) in row]
+
+    return {'indptr': indptr, 'neighbors': neighbors, 'sims': sims}
+
+
+def candidates_to_arrays(candidates, index):
+    ''' Converts co-rating counts (nested dictionary) into CSR arrays
+
+        Parameters:
+        -- candidates: dictionary mapping each row to {other: co-count}, see
+                       co_rating_counts()
+        -- index: dictionary mapping names to integer indexes
+
+        Returns:
+        -- A dictionary with indptr, neighbors (integer indexes) and counts;
+           the candidates of row r are neighbors[indptr[r]:indptr[r+1]]
+
+    '''
+
+    lens = np.zeros(len(index), dtype=np.int64)
+    for name, r in index.items():
+        lens[r] = len(candidates.get(name, {}))
+    indptr = np.concatenate(([0], np.cumsum(lens)))
+
+    neighbors = np.zeros(indptr[-1], dtype=np.int64)
+    counts = np.zeros(indptr[-1], dtype=np.int64)
+    for name, r in index.items():
+        row = candidates.get(name, {})
+        neighbors[indptr[r]:indptr[r + 1]] = [index[other] for other in row]
+        counts[indptr[r]:indptr[r + 1]] = list(row.values())
+
+    return {'indptr': indptr, 'neighbors': neighbors, 'counts': counts}
+
+
+def _attach_segment(name):
+    ''' Attaches to an existing shared memory segment without letting this
+        process' resource tracker unlink it on exit
+
+        Parameters:
+        -- name: name of the shared memory segment
+
+        Returns:
+        -- A SharedMemory object
+
+    '''
+
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # python < 3.13 has no track argument
+        return shared_memory.SharedMemory(name=name)
+
+
+def publish_shared_model(prefs, itemsim=None, usersim=None, candidates=None, order='file'):
+    ''' Publishes the rating store and similarity matrices into shared memory,
+        so that any number of worker processes can attach to one copy
+
+        Parameters:
+        -- prefs: dictionary containing user-item matrix
+        -- itemsim: item-item similarity matrix (nested dictionary) [optional]
+        -- usersim: user-user similarity matrix (nested dictionary) [optional]
+        -- candidates: co-rating counts of the rows of prefs, see
+                       co_rating_counts() [optional]
+        -- order: id order of the arrays, see id_order() ['file' is default]
+
+        Returns:
+        -- The publisher's attached model (see attach_shared_model()); pass
+           model['manifest'] and model['lock'] to the workers (e.g. as Pool
+           initializer args, so they inherit the lock) and call
+           detach_shared_model() when done. The segments are unlinked by
+           whoever detaches last, or when the publisher exits, so a worker
+           that was terminated without detaching doesn't leak them.
+
+    '''
+
+    store = prefs_to_arrays(prefs, order)
+    arrays = {key: store[key] for key in ['indptr', 'indices', 'ratings', 'item_indptr',
+                                          'item_indices', 'item_ratings']}
+    if itemsim is not None:
+        for key, value in sim_matrix_to_arrays(itemsim, store['item_index']).items():
+            arrays['itemsim_' + key] = value
+    if usersim is not None:
+        for key, value in sim_matrix_to_arrays(usersim, store['user_index']).items():
+            arrays['usersim_' + key] = value
+    if candidates is not None:
+        for key, value in candidates_to_arrays(candidates, store['user_index']).items():
+            arrays['candidates_' + key] = value
+
+    segments = {}
+    handles = []
+    for key, value in arrays.items():
+        shm = shared_memory.SharedMemory(create=True, size=max(value.nbytes, 1))
+        np.ndarray(value.shape, dtype=value.dtype, buffer=shm.buf)[:] = value
+        segments[key] = (shm.name, value.shape, value.dtype.str)
+        handles.append(shm)
+
+    # reference count of attached processes, starts with the publisher
+    refcount = shared_memory.SharedMemory(create=True, size=8)
+    np.ndarray((1,), dtype=np.int64, buffer=refcount.buf)[0] = 0
+    handles.append(refcount)
+
+    manifest = {'segments': segments, 'refcount': refcount.name,
+                'users': store['users'], 'items': store['items']}
+
+    model = attach_shared_model(manifest, multiprocessing.Lock())
+    for shm in handles:
+        shm.close()
+
+    # the publisher owns the segments: they go when it exits, whatever the refcount
+    model['_atexit'] = lambda: _unlink_segments(manifest)
+    atexit.register(model['_atexit'])
+
+    return model
+
+
+def _unlink_segments(manifest):
+    ''' Unlinks all shared memory segments of a manifest (already unlinked
+        ones are skipped); processes still attached keep their mappings '''
+
+    for name in [name for (name, shape, dtype) in manifest['segments'].values()] + [manifest['refcount']]:
+        try:
+            shm = _attach_segment(name)
+        except FileNotFoundError:
+            continue
+        shm.close()
+        try:
+            shm.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def attach_shared_model(manifest, lock):
+    ''' Attaches to a model published with publish_shared_model()
+
+        Parameters:
+        -- manifest: model['manifest'] of the published model, passed to the
+                     worker when it is started (e.g. as a Pool initializer arg)
+        -- lock: model['lock'] of the published model, passed the same way
+                 (a multiprocessing lock only works in processes that
+                 inherit it)
+
+        Returns:
+        -- A dictionary of read-only numpy arrays backed by the shared memory
+           (no copies are made), plus users/items and their indexes
+
+    '''
+
+    model = {'manifest': manifest, 'lock': lock, 'users': manifest['users'],
+             'items': manifest['items'],
+             'user_index': {user: u for u, user in enumerate(manifest['users'])},
+             'item_index': {item: i for i, item in enumerate(manifest['items'])},
+             '_handles': []}
+
+    with lock:
+        refcount = _attach_segment(manifest['refcount'])
+        np.ndarray((1,), dtype=np.int64, buffer=refcount.buf)[0] += 1
+        model['_handles'].append(refcount)
+
+        for key, (name, shape, dtype) in manifest['segments'].items():
+            shm = _attach_segment(name)
+            arr = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+            arr.flags.writeable = False
+            model[key] = arr
+            model['_handles'].append(shm)
+
+    return model
+
+
+def detach_shared_model(model):
+    ''' Detaches from a shared model, freeing the shared memory when this was
+        the last attached process
+
+        Parameters:
+        -- model: dictionary returned by publish_shared_model() or
+                  attach_shared_model()
+
+        Returns:
+        -- The number of processes still attached
+
+    '''
+
+    manifest = model['manifest']
+
+    # drop the numpy views before closing the buffers they point into
+    for key in manifest['segments']:
+        model.pop(key, None)
+
+    with model['lock']:
+        refcount = model['_handles'][0]
+        count = np.ndarray((1,), dtype=np.int64, buffer=refcount.buf)
+        count[0] -= 1
+        remaining = int(count[0])
+        del count
+
+        for shm in model['_handles']:
+            shm.close()
+            if remaining == 0:
+                try:
+                    shm.unlink()
+                except FileNotFoundError:
+                    pass
+        model['_handles'] = []
+
+    # the segments are gone, nothing left for the publisher to clean up at exit
+    if remaining == 0 and '_atexit' in model:
+        atexit.unregister(model.pop('_atexit'))
+
+    return remaining
+
+
+def getRecommendedItemsShared(model, user, sim_threshold=0):
+    ''' Calculates item-based recommendations from a shared (array) model
+
+        Same calculation as getRecommendedItems(), done on the CSR arrays.
+
+        Parameters:
+        -- model: shared model with an item-item similarity matrix
+        -- user: string containing name of user
+        -- sim_threshold: minimum similarity to be considered a neighbor, default is >0
+
+        Returns:
+        -- A list of recommended items with 0 or more tuples,
+           each tuple contains (predicted rating, item name).
+           List is sorted, high to low, by predicted rating.
+
+    '''
+
+    if user not in model['user_index']:
+        return []
+    u = model['user_index'][user]
+    n_items = len(model['items'])
+    indptr, sims_ptr = model['indptr'], model['itemsim_indptr']
+
+    rated = model['indices'][indptr[u]:indptr[u + 1]]
+    ratings = model['ratings'][indptr[u]:indptr[u + 1]]
+
+    # gather the neighbor lists of all items rated by this user
+    lens = sims_ptr[rated + 1] - sims_ptr[rated]
+    offsets = np.repeat(sims_ptr[rated] - np.cumsum(lens) + lens, lens) + np.arange(lens.sum())
+    item2 = model['itemsim_neighbors'][offsets]
+    sim = model['itemsim_sims'][offsets]
+    rating = np.repeat(ratings, lens)
+
+    # ignore items already rated and scores below the similarity threshold
+    is_rated = np.zeros(n_items, dtype=bool)
+    is_rated[rated] = True
+    keep = ~is_rated[item2] & (sim > sim_threshold)
+
+    scores = np.bincount(item2[keep], weights=sim[keep] * rating[keep], minlength=n_items)
+    totalSim = np.bincount(item2[keep], weights=sim[keep], minlength=n_items)
+
+    rankings = [(float(scores[i] / totalSim[i]), model['items'][i])
+                for i in np.nonzero(totalSim)[0]]
+    rankings.sort()
+    rankings.reverse()
+    return rankings
+
+
+def getRecommendationSimShared(model, user, sim_threshold=0):
+    ''' Calculates user-based recommendations from a shared (array) model
+
+        Same calculation as getRecommendationSim(), done on the CSR arrays.
+
+        Parameters:
+        -- model: shared model with a user-user similarity matrix
+        -- user: string containing name of user
+        -- sim_threshold: minimum predicted rating to be recommended [default is >0]
+
+        Returns:
+        -- A list of recommended items with 0 or more tuples,
+           each tuple contains (predicted rating, item name).
+           List is sorted, high to low, by predicted rating.
+
+    '''
+
+    if user not in model['user_index']:
+        return []
+    u = model['user_index'][user]
+    n_items = len(model['items'])
+    indptr, sims_ptr = model['indptr'], model['usersim_indptr']
+
+    others = model['usersim_neighbors'][sims_ptr[u]:sims_ptr[u + 1]]
+    other_sims = model['usersim_sims'][sims_ptr[u]:sims_ptr[u + 1]]
+
+    # gather the ratings of all neighbors
+    lens = indptr[others + 1] - indptr[others]
+    offsets = np.repeat(indptr[others] - np.cumsum(lens) + lens, lens) + np.arange(lens.sum())
+    items = model['indices'][offsets]
+    ratings = model['ratings'][offsets]
+    sim = np.repeat(other_sims, lens)
+
+    # only score items this user hasn't rated (a rating of 0 is unrated,
+    # as in getRecommendationSim())
+    is_rated = np.zeros(n_items, dtype=bool)
+    mine = slice(indptr[u], indptr[u + 1])
+    is_rated[model['indices'][mine][model['ratings'][mine] != 0]] = True
+    keep = ~is_rated[items]
+
+    numerator = np.bincount(items[keep], weights=ratings[keep] * sim[keep], minlength=n_items)
+    denominator = np.bincount(items[keep], weights=sim[keep], minlength=n_items)
+
+    recs = []
+    for i in np.nonzero(denominator)[0]:
+        recValue = float(numerator[i] / denominator[i])
+        if recValue > sim_threshold:
+            recs.append((recValue, model['items'][i]))
+
+    recs = sorted(recs, key=lambda x: x[0], reverse=True)
+
+    return recs
+
+
+_worker_model = {}
+
+
+def _shared_worker_init(manifest, lock):
+    ''' Pool initializer: attaches the worker process to the shared model '''
+
+    global _worker_model
+    _worker_model = attach_shared_model(manifest, lock)
+    # detach when the worker exits normally (pool.close() + pool.join())
+    multiprocessing.util.Finalize(None, detach_shared_model, args=(_worker_model,),
+                                  exitpriority=10)
+
+
+def _shared_worker_recs(args):
+    ''' Pool task: top-N recommendations for one user from the shared model '''
+
+    user, algo, top_N, sim_threshold = args
+    if algo == 'item':
+        recs = getRecommendedItemsShared(_worker_model, user, sim_threshold)
+    else:
+        recs = getRecommendationSimShared(_worker_model, user, sim_threshold)
+
+    return user, recs[0:top_N]
+
+
+def serve_shared_recs(model, users, algo='item', n_workers=4, top_N=10, sim_threshold=0):
+    ''' Serves recommendations for many users from a pool of worker processes
+        that all attach to the same shared model
+
+        Parameters:
+        -- model: dictionary returned by publish_shared_model()
+        -- users: list of users to calculate recommendations for
+        -- algo: 'item' (item-based) or 'user' (user-based) ['item' is default]
+        -- n_workers: number of worker processes [4 is default]
+        -- top_N: max number of recommendations per user [10 is default]
+        -- sim_threshold: minimum similarity to be considered a neighbor [default is >0]
+
+        Returns:
+        -- A dictionary mapping each user to a list of (predicted rating, item name)
+
+    '''
+
+    tasks = [(user, algo, top_N, sim_threshold) for user in users]
+    pool = multiprocessing.Pool(n_workers, initializer=_shared_worker_init,
+                                initargs=(model['manifest'], model['lock']))
+    try:
+        results = dict(pool.map(_shared_worker_recs, tasks, chunksize=64))
+    finally:
+        # let the workers exit (and detach) instead of terminating them
+        pool.close()
+        pool.join()
+
+    return results
+
+
+def _ring_hash(key):
+    ''' Position of a key on the consistent hashing ring '''
+
+    return int.from_bytes(hashlib.md5(str(key).encode()).digest()[0:8], 'big')
+
+
+def build_hash_ring(workers, vnodes=64):
+    ''' Builds a consistent hashing ring
+
+        Parameters:
+        -- workers: list of worker ids
+        -- vnodes: number of points each worker gets on the ring [64 is default]
+
+        Returns:
+        -- A sorted list of (position, worker id)
+
+    '''
+
+    return sorted([(_ring_hash('%s#%d' % (worker, v)), worker) for worker in workers
+                   for v in range(vnodes)])
+
+
+def ring_owner(ring, key):
+    ''' Returns the worker id that owns key: the first ring point clockwise '''
+
+    i = bisect.bisect(ring, (_ring_hash(key),))
+    return ring[i % len(ring)][1]
+
+
+def _shard_worker(conn, itemsim):
+    ''' Shard process: holds its users' rating rows and neighbor lists (and
+        the replicated item-item matrix) and answers the router's requests
+        until it is told to stop; every reply is ('ok', value) or, when a
+        request fails (e.g. an unknown user), ('error', exception) '''
+
+    prefs, usersim = {}, {}
+    while True:
+        command, args = conn.recv()
+
+        if command == 'stop':
+            conn.send(('ok', True))
+            conn.close()
+            return
+
+        try:
+            if command == 'load':
+                rows, neighbors = args
+                prefs.update(rows)
+                usersim.update(neighbors)
+                reply = len(rows)
+
+            elif command == 'rebalance':
+                # hand over the users the new ring gives to someone else
+                ring, me = args
+                moving = [user for user in prefs if ring_owner(ring, user) != me]
+                reply = ({user: prefs.pop(user) for user in moving},
+                         {user: usersim.pop(user) for user in moving if user in usersim})
+
+            elif command == 'item_recs':
+                users, top_N, sim_threshold = args
+                reply = {user: getRecommendedItems(prefs, itemsim, user, sim_threshold)[0:top_N]
+                         for user in users}
+
+            elif command == 'neighbors':
+                reply = {user: (usersim.get(user, []),
+                                [item for item in prefs[user] if prefs[user][item] != 0])
+                         for user in args}
+
+            elif command == 'partial':
+                # numerator/denominator sums over the neighbors this shard holds
+                reply = []
+                for (neighbors, rated) in args:
+                    rated = set(rated)
+                    numerators, denominators = {}, {}
+                    for (sim, other) in neighbors:
+                        for item, rating in prefs[other].items():
+                            if item in rated:
+                                continue
+                            numerators[item] = numerators.get(item, 0) + rating * sim
+                            denominators[item] = denominators.get(item, 0) + sim
+                    reply.append((numerators, denominators))
+
+            elif command == 'stats':
+                reply = {'users': len(prefs), 'ratings': sum([len(prefs[user]) for user in prefs]),
+                         'neighbors': sum([len(usersim[user]) for user in usersim])}
+
+            else:
+                raise ValueError('unknown shard command %r' % (command,))
+
+        except Exception as ex:
+            # the router raises it; the shard stays up for the next request
+            conn.send(('error', ex))
+        else:
+            conn.send(('ok', reply))
+
+
+def _start_shard(service, worker):
+    ''' Starts one shard process and registers it with the service '''
+
+    router_conn, worker_conn = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=_shard_worker, args=(worker_conn, service['itemsim']),
+                                      daemon=True)
+    process.start()
+    service['workers'][worker] = {'process': process, 'conn': router_conn}
+
+
+def _fan_out(service, requests):
+    ''' Sends {worker: (command, args)} to the shards, then collects
+        {worker: reply}; the shards work on their requests in parallel.
+        Every reply is read before the first failed request's exception is
+        raised, so the pipes stay in step for the next requests '''
+
+    for worker, request in requests.items():
+        service['workers'][worker]['conn'].send(request)
+
+    replies, error = {}, None
+    for worker in requests:
+        status, reply = service['workers'][worker]['conn'].recv()
+        if status == 'error' and error is None:
+            error = reply
+        replies[worker] = reply
+    if error is not None:
+        raise error
+
+    return replies
+
+
+def start_sharded_service(prefs, itemsim=None, usersim=None, n_workers=4, vnodes=64):
+    ''' Partitions users over worker processes by consistent hashing
+
+        Each worker holds only its shard's rating rows and user neighbor lists;
+        the item-item matrix (item-based CF) is replicated to every worker.
+
+        Parameters:
+        -- prefs: dictionary containing user-item matrix
+        -- itemsim: item-item similarity matrix [optional]
+        -- usersim: user-user similarity matrix [optional]
+        -- n_workers: number of shard processes [4 is default]
+        -- vnodes: ring points per worker [64 is default]
+
+        Returns:
+        -- A service dictionary (ring, workers, itemsim, vnodes), used with
+           sharded_recommendations(), add_shard_worker(), shard_stats() and
+           stop_sharded_service()
+
+    '''
+
+    service = {'ring': build_hash_ring(list(range(n_workers)), vnodes), 'workers': {},
+               'itemsim': itemsim if itemsim is not None else {}, 'vnodes': vnodes}
+    for worker in range(n_workers):
+        _start_shard(service, worker)
+
+    rows = dict([(worker, {}) for worker in range(n_workers)])
+    neighbors = dict([(worker, {}) for worker in range(n_workers)])
+    for user in prefs:
+        worker = ring_owner(service['ring'], user)
+        rows[worker][user] = prefs[user]
+        if usersim is not None and user in usersim:
+            neighbors[worker][user] = usersim[user]
+    _fan_out(service, dict([(worker, ('load', (rows[worker], neighbors[worker])))
+                            for worker in range(n_workers)]))
+
+    return service
+
+
+def sharded_recommendations(service, users, algo='item', top_N=10, sim_threshold=0):
+    ''' Routes a batch of recommendation requests to the shards and merges
+        the answers
+
+        Item-based requests are answered by the shard owning the user.
+        User-based requests fan out: the owner returns the user's neighbors,
+        every shard holding some of them returns partial sums over its
+        neighbors, and the router adds them up (as getRecommendationSim()).
+
+        Parameters:
+        -- service: dictionary returned by start_sharded_service()
+        -- users: list of users to calculate recommendations for
+        -- algo: 'item' (item-based) or 'user' (user-based) ['item' is default]
+        -- top_N: max number of recommendations per user [10 is default]
+        -- sim_threshold: as in getRecommendedItems() / getRecommendationSim()
+
+        Returns:
+        -- A dictionary mapping each user to a list of (predicted rating, item name)
+
+        A user no shard holds raises KeyError, as getRecommendedItems() and
+        getRecommendationSim() do for a user not in prefs.
+
+    '''
+
+    ring = service['ring']
+    by_owner = {}
+    for user in users:
+        by_owner.setdefault(ring_owner(ring, user), []).append(user)
+
+    if algo == 'item':
+        results = {}
+        replies = _fan_out(service, dict([(worker, ('item_recs', (by_owner[worker], top_N, sim_threshold)))
+                                          for worker in by_owner]))
+        for worker in replies:
+            results.update(replies[worker])
+        return results
+
+    # user-based: neighbor lists first, then partial sums from every shard
+    info = {}
+    for reply in _fan_out(service, dict([(worker, ('neighbors', by_owner[worker]))
+                                         for worker in by_owner])).values():
+        info.update(reply)
+
+    requests = {}  # worker -> list of (user, neighbors on that worker)
+    for user in users:
+        neighbors, rated = info[user]
+        split = {}
+        for (sim, other) in neighbors:
+            split.setdefault(ring_owner(ring, other), []).append((sim, other))
+        for worker in split:
+            requests.setdefault(worker, []).append((user, split[worker], rated))
+    replies = _fan_out(service, dict([(worker, ('partial', [(neighbors, rated) for (user, neighbors, rated)
+                                                            in requests[worker]]))
+                                      for worker in requests]))
+
+    numerators = dict([(user, {}) for user in users])
+    denominators = dict([(user, {}) for user in users])
+    for worker in requests:
+        for (user, neighbors, rated), (num, den) in zip(requests[worker], replies[worker]):
+            for item in den:
+                numerators[user][item] = numerators[user].get(item, 0) + num[item]
+                denominators[user][item] = denominators[user].get(item, 0) + den[item]
+
+    results = {}
+    for user in users:
+        recs = []
+        for item, denominator in denominators[user].items():
+            if denominator != 0:
+                recValue = numerators[user][item] / denominator
+                if recValue > sim_threshold:
+                    recs.append((recValue, item))
+        results[user] = sorted(recs, key=lambda x: x[0], reverse=True)[0:top_N]
+
+    return results
+
+
+def add_shard_worker(service):
+    ''' Adds a worker process and moves to it the users the new ring gives it
+        (about 1/(workers + 1) of them; nobody else moves)
+
+        Parameters:
+        -- service: dictionary returned by start_sharded_service()
+
+        Returns:
+        -- The number of users moved
+
+    '''
+
+    worker = max(service['workers']) + 1
+    ring = build_hash_ring(list(service['workers']) + [worker], service['vnodes'])
+    _start_shard(service, worker)
+
+    old_workers = [w for w in service['workers'] if w != worker]
+    rows, neighbors = {}, {}
+    for (moved_rows, moved_neighbors) in _fan_out(service, dict([(w, ('rebalance', (ring, w)))
+                                                                 for w in old_workers])).values():
+        rows.update(moved_rows)
+        neighbors.update(moved_neighbors)
+    _fan_out(service, {worker: ('load', (rows, neighbors))})
+    service['ring'] = ring
+
+    return len(rows)
+
+
+def shard_stats(service):
+    ''' Returns {worker: {users, ratings, neighbors}} held by each shard '''
+
+    return _fan_out(service, dict([(worker, ('stats', None)) for worker in service['workers']]))
+
+
+def stop_sharded_service(service):
+    ''' Stops every shard process '''
+
+    _fan_out(service, dict([(worker, ('stop', None)) for worker in service['workers']]))
+    for worker in service['workers']:
+        service['workers'][worker]['process'].join()
+    service['workers'] = {}
+
+
+def new_model_holder(prefs, sim_matrix, on_free=None):
+    ''' Creates a versioned holder for a (prefs, similarity matrix) snapshot
+
+        Readers take the current snapshot with model_snapshot(); rebuilt
+        snapshots are published with publish_model_version(), which swaps the
+        holder's pointer atomically. A replaced snapshot stays alive until its
+        last reader releases it, then it is dropped (and on_free is called).
+
+        Parameters:
+        -- prefs: dictionary containing user-item matrix
+        -- sim_matrix: similarity matrix built from prefs
+        -- on_free: function called with a retired snapshot when its last
+                    reader is done, e.g. to detach a shared model [optional]
+
+        Returns:
+        -- A dictionary holding the current snapshot (version 1)
+
+    '''
+
+    holder = {'lock': threading.Lock(), 'current': None, 'retired': [],
+              'version': 0, 'on_free': on_free}
+    publish_model_version(holder, prefs, sim_matrix)
+
+    return holder
+
+
+def _free_snapshot(holder, snapshot):
+    ''' Drops a retired snapshot; called after the holder lock is released
+        (on_free may be slow, readers must not wait for it) '''
+
+    if holder['on_free'] is not None:
+        holder['on_free'](snapshot)
+    snapshot['prefs'] = None
+    snapshot['sim_matrix'] = None
+
+
+def publish_model_version(holder, prefs, sim_matrix, meta=None):
+    ''' Publishes a new snapshot with an atomic pointer swap
+
+        Requests already running keep using the snapshot they acquired,
+        new requests get the new one. Nothing is copied under the lock.
+
+        Parameters:
+        -- holder: dictionary returned by new_model_holder()
+        -- prefs: rating snapshot the similarity matrix was built from
+        -- sim_matrix: the (re)built similarity matrix
+        -- meta: extra information to keep with the snapshot [optional]
+
+        Returns:
+        -- The version number of the published snapshot
+
+    '''
+
+    freed = None
+    with holder['lock']:
+        holder['version'] += 1
+        snapshot = {'version': holder['version'], 'prefs': prefs,
+                    'sim_matrix': sim_matrix, 'meta': meta or {}, 'readers': 0}
+        old, holder['current'] = holder['current'], snapshot
+
+        if old is not None:
+            if old['readers'] == 0:
+                freed = old
+            else:
+                holder['retired'].append(old)
+
+    if freed is not None:
+        _free_snapshot(holder, freed)
+
+    return snapshot['version']
+
+
+@contextmanager
+def model_snapshot(holder):
+    ''' Context manager giving a consistent (prefs, sim_matrix) snapshot
+
+        Usage:
+            with model_snapshot(holder) as snap:
+                recs = getRecommendedItems(snap['prefs'], snap['sim_matrix'], user)
+
+        Parameters:
+        -- holder: dictionary returned by new_model_holder()
+
+        Returns:
+        -- The snapshot dictionary (version, prefs, sim_matrix, meta)
+
+    '''
+
+    with holder['lock']:
+        snapshot = holder['current']
+        snapshot['readers'] += 1
+    try:
+        yield snapshot
+    finally:
+        freed = False
+        with holder['lock']:
+            snapshot['readers'] -= 1
+            if snapshot is not holder['current'] and snapshot['readers'] == 0:
+                # by identity: == would compare whole matrices, and two
+                # snapshots can hold equal ones
+                for i, retired in enumerate(holder['retired']):
+                    if retired is snapshot:
+                        del holder['retired'][i]
+                        freed = True
+                        break
+        if freed:
+            _free_snapshot(holder, snapshot)
+
+
+def recommend_from_holder(holder, user, algo, sim_threshold=0):
+    ''' Calculates recommendations for a user from the current snapshot
+
+        Parameters:
+        -- holder: dictionary returned by new_model_holder()
+        -- user: string containing name of user
+        -- algo: user-based (getRecommendationSim), item-based recommender (getRecommendedItems)
+        -- sim_threshold: minimum similarity to be considered a neighbor [default is >0]
+
+        Returns:
+        -- version: version of the snapshot the recommendations came from
+        -- recs: list of (predicted rating, item name), high to low
+
+    '''
+
+    with model_snapshot(holder) as snap:
+        return snap['version'], algo(snap['prefs'], snap['sim_matrix'], user, sim_threshold)
+
+
+def rebuild_model_async(holder, prefs, build, **kwargs):
+    ''' Rebuilds the similarity matrix in a worker process and publishes it
+        when it is done; readers are served from the old snapshot meanwhile
+
+        The build is CPU-bound python, in a thread it would hold the GIL and
+        stall the requests; a background thread only waits for the process.
+
+        Parameters:
+        -- holder: dictionary returned by new_model_holder()
+        -- prefs: current user-item matrix, copied before the rebuild starts
+                  so later changes don't leak into the snapshot
+        -- build: calculateSimilarItems, calculateSimilarUsers or another
+                  module-level (picklable) function build(prefs, **kwargs)
+                  returning a sim matrix
+        -- kwargs: passed on to build (similarity, sim_weighting, ...)
+
+        Returns:
+        -- The (started) background thread
+
+    '''
+
+    snapshot_prefs = copy.deepcopy(prefs)
+
+    def rebuild():
+        # not a Pool: its daemon workers can't start the builders' own pools
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            sim_matrix = executor.submit(build, snapshot_prefs, **kwargs).result()
+        publish_model_version(holder, snapshot_prefs, sim_matrix,
+                              meta={'build': build.__name__, 'kwargs': kwargs})
+
+    thread = threading.Thread(target=rebuild, daemon=True)
+    thread.start()
+
+    return thread
+
+
+def schedule_model_refresh(holder, load_prefs, build, interval=3600, **kwargs):
+    ''' Periodically reloads the ratings and rebuilds the model in the background
+
+        Parameters:
+        -- holder: dictionary returned by new_model_holder()
+        -- load_prefs: function returning the current user-item matrix
+        -- build: function building a sim matrix, see rebuild_model_async()
+        -- interval: seconds between rebuilds [3600 is default]
+        -- kwargs: passed on to build
+
+        Returns:
+        -- A threading.Event, set() it to stop refreshing
+
+    '''
+
+    stop = threading.Event()
+
+    def refresh():
+        while not stop.wait(interval):
+            rebuild_model_async(holder, load_prefs(), build, **kwargs).join()
+
+    threading.Thread(target=refresh, daemon=True).start()
+
+    return stop
+
+
+def dataset_fingerprint(prefs):
+    ''' Calculates a fingerprint identifying the contents of a U-I matrix
+
+        Parameters:
+        -- prefs: dictionary containing user-item matrix
+
+        Returns:
+        -- A hex string, equal for equal ratings regardless of dictionary order
+
+    '''
+
+    h = hashlib.sha1()
+    for user in sorted(prefs):
+        for item in sorted(prefs[user]):
+            h.update(('%s\t%s\t%r\n' % (user, item, prefs[user][item])).encode('utf-8'))
+
+    return h.hexdigest()
+
+
+def sim_matrix_fingerprint(sim_matrix):
+    ''' Calculates a fingerprint identifying the contents of a similarity
+        matrix, so results of matrices built with different parameters
+        (n, min_overlap, batched, sketch, latent_k, ...) are told apart
+
+        Parameters:
+        -- sim_matrix: dictionary mapping each row to a list of (similarity, name)
+
+        Returns:
+        -- A hex string, equal for equal matrices regardless of dictionary order
+
+    '''
+
+    h = hashlib.sha1()
+    for row in sorted(sim_matrix):
+        h.update(('%s\t%s\n' % (row, '\t'.join(['%r %s' % (sim, other)
+                                                for (sim, other) in sim_matrix[row]]))).encode('utf-8'))
+
+    return h.hexdigest()
+
+
+def open_results_store(db_path='results/results.db'):
+    ''' Opens (and creates, if needed) the SQLite store of experiment results
+
+        Parameters:
+        -- db_path: path to the SQLite database file
+
+        Returns:
+        -- An open sqlite3 connection
+
+    '''
+
+    if os.path.dirname(db_path) != '':
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+
+    conn = sqlite3.connect(db_path)
+    # results stored before the matrix fingerprint was part of the key can't
+    # be matched to a matrix any more, keep them aside
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(results)')]
+    if len(columns) > 0 and 'matrix' not in columns:
+        conn.execute('ALTER TABLE results RENAME TO results_unkeyed')
+    conn.execute('''CREATE TABLE IF NOT EXISTS results (
+                        fingerprint TEXT, matrix TEXT, dataset TEXT, algo TEXT, similarity TEXT,
+                        sim_weighting INTEGER, sim_threshold REAL,
+                        mse REAL, mae REAL, rmse REAL, n_predictions INTEGER,
+                        n_ratings INTEGER, seconds REAL, created TEXT,
+                        PRIMARY KEY (fingerprint, matrix, algo, similarity, sim_weighting,
+                                     sim_threshold))''')
+    conn.commit()
+
+    return conn
+
+
+def query_results(db_path='results/results.db', **filters):
+    ''' Returns stored experiment results, e.g. query_results(algo='getRecommendedItems')
+
+        Parameters:
+        -- db_path: path to the SQLite database file
+        -- filters: column=value pairs all results must match
+
+        Returns:
+        -- A list of dictionaries, one per stored result
+
+    '''
+
+    conn = open_results_store(db_path)
+    conn.row_factory = sqlite3.Row
+    where = ' AND '.join(['%s = ?' % column for column in filters]) or '1'
+    rows = conn.execute('SELECT * FROM results WHERE %s ORDER BY dataset, algo, similarity, '
+                        'sim_weighting, sim_threshold' % where, list(filters.values())).fetchall()
+    conn.close()
+
+    return [dict(row) for row in rows]
+
+
+def run_experiment(prefs, algo, sim_method, sim_matrix, sim_weighting=0, sim_threshold=0,
+                   dataset='', db_path='results/results.db', checkpoint_dir='checkpoints',
+                   shard_size=50):
+    ''' Runs (or resumes) a checkpointed LOO_CV_SIM evaluation and stores the result
+
+        Users are evaluated in shards; the error sums of every finished shard
+        are checkpointed, so an interrupted run picks up at the next shard.
+        Configurations already in the results store are not recomputed; a
+        configuration is the ratings, the sim matrix contents (see
+        sim_matrix_fingerprint()), algo, similarity, weighting and threshold.
+
+        Parameters:
+        -- prefs: dictionary containing user-item matrix
+        -- algo: user-based (getRecommendationSim), item-based recommender (getRecommendedItems)
+        -- sim_method: name of similarity method used to calc sim matrix (string)
+        -- sim_matrix: pre-computed similarity matrix
+        -- sim_weighting: similarity significance weighting the matrix was built with
+        -- sim_threshold: minimum similarity to be considered a neighbor [default is >0]
+        -- dataset: name of the dataset, for reports (e.g. 'critics', 'MLK-100k')
+        -- db_path: path to the SQLite results store
+        -- checkpoint_dir: directory for the partial results of unfinished runs
+        -- shard_size: number of users per checkpointed shard [50 is default]
+
+        Returns:
+        -- errors: MSE, MAE, RMSE and n (number of predictions) for this set of conditions
+
+    '''
+
+    fingerprint = dataset_fingerprint(prefs)
+    key = (fingerprint, sim_matrix_fingerprint(sim_matrix), algo.__name__, sim_method,
+           int(sim_weighting), float(sim_threshold))
+
+    # serve repeat configurations from the store
+    conn = open_results_store(db_path)
+    row = conn.execute('SELECT mse, mae, rmse, n_predictions FROM results WHERE fingerprint = ? '
+                       'AND matrix = ? AND algo = ? AND similarity = ? AND sim_weighting = ? '
+                       'AND sim_threshold = ?', key).fetchone()
+    if row is not None:
+        conn.close()
+        print('Found stored result for this configuration, not recomputing')
+        return {'mse': row[0], 'mae': row[1], 'rmse': row[2], 'n': row[3]}
+
+    # pick up where an interrupted run stopped (shard numbers depend on shard_size)
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    checkpoint = os.path.join(checkpoint_dir, '%s.p' % hashlib.sha1(
+        repr(key + (shard_size,)).encode()).hexdigest())
+    if os.path.exists(checkpoint):
+        with open(checkpoint, 'rb') as f:
+            state = pickle.load(f)
+        print('Resuming from checkpoint, %d shards done' % len(state['shards']))
+    else:
+        state = {'key': key, 'shards': {}, 'seconds': 0.0}
+
+    users = list(prefs)
+    shards = [users[i:i + shard_size] for i in range(0, len(users), shard_size)]
+
+    for s, shard in enumerate(shards):
+        if s in state['shards']:
+            continue
+        start = time.time()
+        errors, error_lists = loo_cv_sim(prefs, None, algo, sim_matrix, sim_threshold, users=shard)
+        state['shards'][s] = (float(np.sum(error_lists['(r)mse'])),
+                              float(np.sum(error_lists['mae'])), len(error_lists['mae']))
+        state['seconds'] += time.time() - start
+
+        # write the checkpoint atomically, a crash mid-write keeps the old one
+        with open(checkpoint + '.tmp', 'wb') as f:
+            pickle.dump(state, f)
+        os.replace(checkpoint + '.tmp', checkpoint)
+        print('Shard %d of %d done' % (s + 1, len(shards)))
+
+    se = sum([shard[0] for shard in state['shards'].values()])
+    ae = sum([shard[1] for shard in state['shards'].values()])
+    n = sum([shard[2] for shard in state['shards'].values()])
+    errors = {'n': n}
+    errors['mse'] = se / n if n > 0 else float('nan')
+    errors['mae'] = ae / n if n > 0 else float('nan')
+    errors['rmse'] = sqrt(errors['mse']) if n > 0 else float('nan')
+
+    conn.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                 (fingerprint, key[1], dataset, key[2], sim_method, key[4], key[5], errors['mse'],
+                  errors['mae'], errors['rmse'], n, sum([len(prefs[user]) for user in prefs]),
+                  state['seconds'], time.strftime('%Y-%m-%d %H:%M:%S')))
+    conn.commit()
+    conn.close()
+    os.remove(checkpoint)
+
+    return errors
+
+
+def _percentile_ms(latencies, q):
+    ''' Returns the q-th percentile of a list of latencies (seconds) in ms '''
+
+    if len(latencies) == 0:
+        return float('nan')
+    return float(np.percentile(latencies, q)) * 1000
+
+
+def replay_ratings(events, algo='user', similarity=sim_pearson, sim_matrix=None,
+                   query_mix=0.1, rate=None, top_N=10, max_events=None, seed=0, verbose=True):
+    ''' Replays a timestamp-ordered rating stream into an online model
+
+        Every event is first predicted (prequential, predict-then-learn) and
+        then applied as an update; after an update a recommendation query
+        for a random known user is served with probability query_mix.
+
+        Parameters:
+        -- events: list of (timestamp, user, item, rating), see from_file_to_events()
+        -- algo: 'user' (on-the-fly user-based CF, getRecommendations with an
+                 inverted index) or 'item' (getRecommendedItems with a fixed
+                 sim_matrix, updates only change the ratings) ['user' is default]
+        -- similarity: function to calc similarity [sim_pearson is default]
+        -- sim_matrix: pre-computed item-item similarity matrix (algo='item')
+        -- query_mix: recommendation queries per update [0.1 is default]
+        -- rate: target events per second, None replays as fast as possible
+        -- top_N: number of recommendations per query [10 is default]
+        -- max_events: only replay the first max_events events [default is all]
+        -- seed: random seed for choosing queries [0 is default]
+        -- verbose: print progress
+
+        Returns:
+        -- A dictionary with update throughput, query latency percentiles (ms)
+           and prequential MSE, MAE, RMSE and prediction coverage
+
+    '''
+
+    rng = np.random.default_rng(seed)
+    prefs = {}
+    index = build_item_index(prefs)
+    users = []
+
+    update_times = []
+    query_times = []
+    predict_times = []
+    mse_list = []
+    mae_list = []
+
+    if max_events is not None:
+        events = events[0:max_events]
+
+    start = time.time()
+    for c, (ts, user, item, rating) in enumerate(events):
+        # pace the stream at the requested rate
+        if rate is not None:
+            delay = start + c / rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+        # predict before learning
+        t = time.time()
+        if algo == 'item':
+            pred = None
+            if user in prefs:
+                recs = getRecommendedItems(prefs, sim_matrix, user)
+                for rec in recs:
+                    if rec[1] == item:
+                        pred = rec[0]
+                        break
+        else:
+            pred = getPredictedRating(prefs, user, item, similarity, index)
+        predict_times.append(time.time() - t)
+        if pred is not None:
+            mse_list.append((pred - rating)**2)
+            mae_list.append(abs(pred - rating))
+
+        # learn
+        t = time.time()
+        if user not in prefs:
+            users.append(user)
+        add_rating(prefs, index, user, item, rating)
+        update_times.append(time.time() - t)
+
+        # interleaved recommendation queries
+        if rng.random() < query_mix:
+            query_user = users[rng.integers(len(users))]
+            t = time.time()
+            if algo == 'item':
+                recs = getRecommendedItems(prefs, sim_matrix, query_user)[0:top_N]
+            else:
+                recs = getRecommendations(prefs, query_user, similarity, item_index=index)[0:top_N]
+            query_times.append(time.time() - t)
+
+        if verbose and (c + 1) % 5000 == 0:
+            print('%.2f %% replayed' % (100 * (c + 1) / len(events)))
+
+    elapsed = time.time() - start
+
+    report = {'events': len(events), 'seconds': elapsed, 'queries': len(query_times),
+              'updates_per_sec': len(update_times) / sum(update_times) if sum(update_times) > 0 else float('inf'),
+              'events_per_sec': len(events) / elapsed if elapsed > 0 else float('inf')}
+    for q in [50, 90, 99]:
+        report['query_p%d_ms' % q] = _percentile_ms(query_times, q)
+        report['predict_p%d_ms' % q] = _percentile_ms(predict_times, q)
+    report['query_max_ms'] = max(query_times) * 1000 if query_times else float('nan')
+
+    # prequential (predict-then-learn) accuracy
+    report['mse'] = np.average(mse_list) if mse_list else float('nan')
+    report['mae'] = np.average(mae_list) if mae_list else float('nan')
+    report['rmse'] = sqrt(report['mse']) if mse_list else float('nan')
+    report['coverage'] = len(mse_list) / len(events) if events else 0.0
+
+    return report
+
+
+# Checks of the optimized paths against the functions they replace, see
+# register_check() and run_checks()
+CHECKS = []
+
+
+def register_check(check):
+    ''' Adds a check to CHECKS (usable as a decorator)
+
+        Parameters:
+        -- check: function taking prefs and returning True when the
+                  optimized path gives the same results as its baseline
+
+        Returns:
+        -- check
+
+    '''
+
+    CHECKS.append(check)
+    return check
+
+
+def run_checks(prefs):
+    ''' Runs every registered check on prefs and prints PASS or FAIL per
+        check; quick on the critics data, minutes on ml-100k
+
+        Parameters:
+        -- prefs: dictionary containing user-item matrix
+
+        Returns:
+        -- A dictionary mapping each check's name to True (passed) or False
+
+    '''
 
-            # Weighted sum of rating times similarity
-            scores.setdefault(item2, 0)
-            scores[item2] += similarity*rating
+    results = {}
+    for check in CHECKS:
+        t = time.time()
+        # the builders print their progress
+        with redirect_stdout(io.StringIO()):
+            results[check.__name__] = bool(check(prefs))
+        print(('PASS' if results[check.__name__] else 'FAIL').ljust(6) + check.__name__.ljust(28) +
+              '%.2f secs' % (time.time() - t))
 
-            # Sum of all the similarities
-            totalSim.setdefault(item2, 0)
-            totalSim[item2] += similarity
+    return results
 
-    # Divide each total score by total weighting to get an average
-    rankings = [(score/totalSim[item], item) for item, score in scores.items()]
 
-    # Return the rankings from highest to lowest
-    rankings.sort()
-    rankings.reverse()
-    return rankings
+def _same_matrix(a, b, tol=1e-9):
+    ''' True if two similarity matrices have the same neighbors per row with
+        the same similarities (within tol) '''
 
+    if set(a) != set(b):
+        return False
+    for row in a:
+        sims_a = dict([(other, sim) for (sim, other) in a[row]])
+        sims_b = dict([(other, sim) for (sim, other) in b[row]])
+        if set(sims_a) != set(sims_b) or \
+                any([abs(sims_a[other] - sims_b[other]) > tol for other in sims_a]):
+            return False
 
-def get_all_II_recs(prefs, itemsim, sim_method, num_users=10, top_N=5):
-    ''' Print item-based CF recommendations for all users in dataset
+    return True
 
-        Parameters
-        -- prefs: U-I matrix (nested dictionary)
-        -- itemsim: item-item similarity matrix (nested dictionary)
-        -- sim_method: name of similarity method used to calc sim matrix (string)
-        -- num_users: max number of users to print (integer, default = 10)
-        -- top_N: max number of recommendations to print per user (integer, default = 5)
 
-        Returns:
-        -- None
+def _same_recs(a, b, tol=1e-9):
+    ''' True if two recommendation lists have the same items with the same
+        predictions (within tol); sums in another order can reorder ties '''
 
-    '''
+    scores_a = dict([(item, score) for (score, item) in a])
+    scores_b = dict([(item, score) for (score, item) in b])
 
-    counter = 0
+    return set(scores_a) == set(scores_b) and \
+        all([abs(scores_a[item] - scores_b[item]) <= tol for item in scores_a])
 
-    if num_users > 0:
+
+@register_check
+def check_candidates(prefs):
+    ''' Builds that only score pairs with co-ratings (co_rating_counts())
+        give the same matrices as scoring every pair '''
+
+    # an unregistered similarity, with its own weighting rule
+    def sim_halved(prefs, p1, p2, sim_weighting=0):
+        return sim_pearson(prefs, p1, p2) / (2 if sim_weighting else 1)
+
+    for (similarity, sim_weighting) in ((sim_pearson, 0), (sim_pearson, 25), (sim_halved, 25)):
+        for build in (calculateSimilarItems, calculateSimilarUsers):
+            if not _same_matrix(build(prefs, similarity=similarity, sim_weighting=sim_weighting,
+                                      min_overlap=1, batched=False),
+                                build(prefs, similarity=similarity, sim_weighting=sim_weighting,
+                                      min_overlap=0, batched=False)):
+                return False
+
+    return True
+
+
+@register_check
+def check_shared_model(prefs):
+    ''' Recommendations from the shared-memory model give the predictions of
+        getRecommendedItems() and getRecommendationSim() '''
+
+    # a rating of 0 counts as unrated for getRecommendationSim(), give the
+    # user with the fewest ratings one
+    prefs = dict(prefs)
+    user = min(prefs, key=lambda user: len(prefs[user]))
+    unrated = [item for item in transformPrefs(prefs) if item not in prefs[user]]
+    if len(unrated) > 0:
+        prefs[user] = dict(prefs[user])
+        prefs[user][unrated[0]] = 0
+
+    itemsim, usersim = calculateSimilarItems(prefs), calculateSimilarUsers(prefs)
+    model = publish_shared_model(prefs, itemsim, usersim)
+    try:
         for user in prefs:
-            if counter < num_users:
-                recs = getRecommendedItems(prefs, itemsim, user)
-                if len(recs) > top_N:
-                    recs = recs[0:top_N]
-                print('Item-based CF recs for %s, %s: ' %
-                      (user, sim_method), recs)
-            else:
-                break
-            counter += 1
+            pairs = [(getRecommendedItemsShared(model, user), getRecommendedItems(prefs, itemsim, user)),
+                     (getRecommendationSimShared(model, user), getRecommendationSim(prefs, usersim, user))]
+            for (shared, recs) in pairs:
+                shared = dict([(item, score) for (score, item) in shared])
+                recs = dict([(item, score) for (score, item) in recs])
+                if set(shared) != set(recs) or \
+                        any([not math.isclose(shared[item], recs[item], rel_tol=1e-9) for item in recs]):
+                    return False
+    finally:
+        detach_shared_model(model)
 
-    return
+    return True
 
 
-def loo_cv_sim(prefs, sim, algo, sim_matrix, sim_threshold=0):
-    ''' Leave-One_Out Evaluation: evaluates recommender system ACCURACY
+@register_check
+def check_threshold_pruning(prefs, sim_threshold=0.3):
+    ''' Builds that skip pairs whose bound can't pass sim_threshold give the
+        same matrices as scoring every pair '''
 
-     Parameters:
-         -- prefs dataset: critics, MLK-100k
-         -- sim: distance, pearson
-         -- algo: user-based (getRecommendationSim), item-based recommender (getRecommendedItems)
-         -- sim_matrix: pre-computed similarity matrix
-         -- sim_threshold: minimum similarity to be considered a neighbor [default is >0]
+    for (similarity, sim_weighting) in ((sim_pearson, 0), (sim_pearson, 25), (sim_distance, 0)):
+        for build in (calculateSimilarItems, calculateSimilarUsers):
+            if not _same_matrix(build(prefs, similarity=similarity, sim_weighting=sim_weighting,
+                                      sim_threshold=sim_threshold, batched=False),
+                                build(prefs, similarity=similarity, sim_weighting=sim_weighting,
+                                      sim_threshold=sim_threshold, min_overlap=0, batched=False)):
+                return False
 
-    Returns:
-         -- errors: MSE, MAE, RMSE totals for this set of conditions
-         -- error_lists: MSE and MAE lists of actual-predicted differences
+    return True
 
-    '''
 
-    errors = {}
-    error_lists = {}
-    mse_list = []
-    mae_list = []
-    recs = []
-    c = 0
+@register_check
+def check_item_index(prefs):
+    ''' getRecommendations() with the inverted item index gives the same lists
+        as the scan over every user '''
 
-    ### UNCOMMENT FOR DEBUG PRINTS ###
-    # pred_found = False
+    index = build_item_index(prefs)
+    return all([getRecommendations(prefs, user, item_index=index) == getRecommendations(prefs, user)
+                for user in prefs])
 
 
-    # create a temp copy of prefs
-    prefs_cp = copy.deepcopy(prefs)
+@register_check
+def check_parallel_build(prefs, n_workers=2):
+    ''' The process-pool builders (shared CSR arrays) give the matrices of
+        the serial loop '''
 
-    # iterate through all users
+    for similarity in (sim_pearson, sim_adjusted_cosine):
+        for build in (calculateSimilarItems, calculateSimilarUsers):
+            if not _same_matrix(build(prefs, similarity=similarity, sim_weighting=25, batched=False),
+                                build(prefs, similarity=similarity, sim_weighting=25, batched=False,
+                                      n_workers=n_workers)):
+                return False
+
+    return True
+
+
+@register_check
+def check_batched_kernels(prefs, weightings=(0, 25)):
+    ''' Every registered batched kernel gives the matrices of its per-pair
+        similarity, with and without significance weighting '''
+
+    for entry in SIMILARITIES.values():
+        if entry['block'] is None:
+            continue
+        for sim_weighting in weightings:
+            for build in (calculateSimilarItems, calculateSimilarUsers):
+                if not _same_matrix(build(prefs, similarity=entry['pair'], sim_weighting=sim_weighting,
+                                          batched=False),
+                                    build(prefs, similarity=entry['pair'], sim_weighting=sim_weighting)):
+                    return False
+
+    return True
+
+
+@register_check
+def check_scatter(prefs, k_values=(None, 2)):
+    ''' getRecommendationSim() (one scatter pass over the neighbors' ratings)
+        gives the predictions of a loop over all neighbors per item, and
+        with k those of each item's k most similar raters '''
+
+    usersim = calculateSimilarUsers(prefs, n=len(prefs))
+    for k in k_values:
+        for user in prefs:
+            neighbors = usersim[user]
+            expected = {}
+            for item in set([item for (sim, other) in neighbors for item in prefs[other]]):
+                if item in prefs[user] and prefs[user][item] != 0:
+                    continue
+                raters = [(sim, other) for (sim, other) in neighbors if item in prefs[other]][0:k]
+                numerator = sum([prefs[other][item] * sim for (sim, other) in raters])
+                denominator = sum([sim for (sim, other) in raters])
+                if denominator != 0 and numerator / denominator > 0:
+                    expected[item] = numerator / denominator
+
+            recs = dict([(item, score) for (score, item) in getRecommendationSim(prefs, usersim, user, k=k)])
+            if set(recs) != set(expected) or \
+                    any([not math.isclose(recs[item], expected[item], rel_tol=1e-9) for item in recs]):
+                return False
+
+    return True
+
+
+@register_check
+def check_sorted_rows(prefs):
+    ''' sim_pearson() and sim_distance() on SortedRows (one pass over two
+        sorted rows) give the similarities of the dictionary lookups, and
+        topMatches() the same neighbors at the threshold '''
+
+    for rowPrefs in (prefs, transformPrefs(prefs)):
+        sorted_rows = SortedRows(rowPrefs)
+        for similarity in (sim_pearson, sim_distance):
+            for p1 in rowPrefs:
+                for p2 in rowPrefs:
+                    for sim_weighting in (0, 25):
+                        if not math.isclose(similarity(sorted_rows, p1, p2, sim_weighting),
+                                            similarity(rowPrefs, p1, p2, sim_weighting),
+                                            rel_tol=1e-9, abs_tol=1e-12):
+                            return False
+            # the sums differ in the last bits: the same neighbors must pass
+            # the threshold, 0 included (where the sign of a tiny sum counts)
+            for sim_threshold in (0, 0.3):
+                if not _same_matrix(
+                        dict([(p1, topMatches(sorted_rows, p1, similarity, len(rowPrefs), 25, sim_threshold))
+                              for p1 in rowPrefs]),
+                        dict([(p1, topMatches(rowPrefs, p1, similarity, len(rowPrefs), 25, sim_threshold))
+                              for p1 in rowPrefs])):
+                    return False
+
+    return True
+
+
+@register_check
+def check_two_stage(prefs):
+    ''' Two-stage recommendations with a budget covering every item give the
+        lists of getRecommendedItems() and getRecommendationSim() '''
+
+    itemsim, usersim = calculateSimilarItems(prefs), calculateSimilarUsers(prefs)
+    budget = len(transformPrefs(prefs))
+    item_index, user_index = build_two_stage_index(prefs, itemsim), build_two_stage_index(prefs)
     for user in prefs:
-        # progress status
-        c += 1
-        if c % 25 == 0:
-            percent_complete = (100*c)/len(prefs)
-            print("%.2f %% complete" % percent_complete)
+        if not _same_recs(getRecommendationsTwoStage(prefs, itemsim, user, budget=budget, **item_index),
+                          getRecommendedItems(prefs, itemsim, user)):
+            return False
+        if not _same_recs(getRecommendationsTwoStage(prefs, usersim, user, algo=getRecommendationSim,
+                                                     budget=budget, **user_index),
+                          getRecommendationSim(prefs, usersim, user)):
+            return False
+
+    return True
+
+
+@register_check
+def check_bitset_rows(prefs, threshold=None):
+    ''' Jaccard and cosine builds from the packed bit arrays give the
+        matrices of the float paths on the same interactions (1.0 each), and
+        copies keep the bit arrays and the implicit ranking '''
+
+    bitrows = BitsetRows(prefs, threshold)
+    ones = dict([(row, dict([(col, 1.0) for col in bitrows[row]])) for row in bitrows])
+    for similarity in (sim_jaccard, sim_cosine):
+        for sim_weighting in (0, 25):
+            for build in (calculateSimilarItems, calculateSimilarUsers):
+                if not _same_matrix(build(bitrows, similarity=similarity, sim_weighting=sim_weighting),
+                                    build(ones, similarity=similarity, sim_weighting=sim_weighting,
+                                          batched=False)):
+                    return False
+
+    # copies (snapshots, leave-one-out) are still ranked as implicit feedback
+    copied = copy.deepcopy(bitrows)
+    if not isinstance(copied, BitsetRows) or not np.array_equal(copied.bits, bitrows.bits) or \
+            not getattr(_loo_working_copy(bitrows)[0], 'implicit', False):
+        return False
+
+    return True
+
+
+@register_check
+def check_id_order(prefs, orders=('file', 'degree', 'rcm')):
+    ''' The item-based LOO MSE is the same in every id order (reordered
+        prefs, batched build laid out by the order) as with the file order
+        and the unbatched build '''
+
+    itemsim = calculateSimilarItems(prefs, batched=False)
+    baseline = loo_cv_sim(prefs, sim_pearson, getRecommendedItems, itemsim)[0]['mse']
+
+    for order in orders:
+        rowPrefs = prefs if order == 'file' else reorder_prefs(prefs, order)
+        itemsim = calculateSimilarItems(rowPrefs, order=order)
+        mse = loo_cv_sim(rowPrefs, sim_pearson, getRecommendedItems, itemsim)[0]['mse']
+        if not math.isclose(mse, baseline, rel_tol=1e-9):
+            return False
+
+    return True
+
+
+@register_check
+def check_ranking_metrics(prefs, k=3, relevance_threshold=3.0):
+    ''' ranking_metrics() (blocks of users, evaluated in threads) gives the
+        precision, recall, nDCG and AP of a loop over each user's list '''
+
+    train, test = split_prefs_holdout(prefs, test_size=0.4)
+    top_n = get_all_top_n(train, calculateSimilarItems(train), getRecommendedItems, top_N=k)
+    metrics, metric_lists = ranking_metrics(top_n, test, k, relevance_threshold, n_jobs=2, block_size=2)
+
+    expected = dict([(name, []) for name in ('precision', 'recall', 'ndcg', 'ap')])
+    has_rel = []
+    for user in [user for user in top_n if user in test]:
+        relevant = set([item for item in test[user] if test[user][item] >= relevance_threshold])
+        hits = [item in relevant for item in top_n[user][0:k]]
+        n_rel = len(relevant)
+        dcg = sum([1 / math.log2(i + 2) for i in range(len(hits)) if hits[i]])
+        idcg = sum([1 / math.log2(i + 2) for i in range(min(n_rel, k))])
+        expected['precision'].append(sum(hits) / k)
+        expected['recall'].append(sum(hits) / n_rel if n_rel > 0 else 0)
+        expected['ndcg'].append(dcg / idcg if idcg > 0 else 0)
+        expected['ap'].append(sum([sum(hits[0:i + 1]) / (i + 1) for i in range(len(hits)) if hits[i]]) /
+                              max(min(n_rel, k), 1))
+        has_rel.append(n_rel > 0)
+
+    for name in expected:
+        if not np.allclose(metric_lists[name], expected[name]):
+            return False
+        key = '%s@%d' % ('map' if name == 'ap' else name, k)
+        if any(has_rel) and not math.isclose(metrics[key], np.average(np.array(expected[name])[has_rel]),
+                                             rel_tol=1e-9):
+            return False
+
+    return True
+
+
+@register_check
+def check_mf(prefs, factors=3, reg=0.1):
+    ''' The blocked ALS half-step gives the solutions of each row's normal
+        equations, and getRecommendationsMF() the predictions of the user's
+        factors solved from their ratings (ALS and SGD regularization) '''
+
+    store = prefs_to_arrays(prefs)
+    indptr, indices, ratings = store['indptr'], store['indices'], store['ratings']
+    Q = np.random.default_rng(0).normal(size=(len(store['items']), factors))
+    P = _als_solve(indptr, indices, ratings, Q, reg, block_nnz=4)
+    for u in range(len(store['users'])):
+        Y = Q[indices[indptr[u]:indptr[u + 1]]]
+        A = Y.T @ Y + reg * max(len(Y), 1) * np.eye(factors)
+        if not np.allclose(P[u], np.linalg.solve(A, Y.T @ ratings[indptr[u]:indptr[u + 1]])):
+            return False
+
+    for method in ('als', 'sgd'):
+        model = train_mf(prefs, factors, reg, iterations=5, method=method, verbose=False)
+        for user in prefs:
+            rated = [(item, rating) for (item, rating) in prefs[user].items() if rating != 0]
+            if len(rated) == 0:
+                continue
+            Y = model['Q'][[model['item_index'][item] for (item, rating) in rated]]
+            scaled = reg * len(rated) if method == 'als' else reg
+            p = np.linalg.solve(Y.T @ Y + scaled * np.eye(factors),
+                                Y.T @ (np.array([rating for (item, rating) in rated]) - model['mu']))
+            expected = [(min(max(model['mu'] + float(np.dot(p, model['Q'][i])), model['min_rating']),
+                             model['max_rating']), item)
+                        for (i, item) in enumerate(model['items'])
+                        if item not in prefs[user] or prefs[user][item] == 0]
+            if not _same_recs(getRecommendationsMF(prefs, model, user), expected):
+                return False
+
+    return True
+
+
+@register_check
+def check_model_snapshot(prefs):
+    ''' A reader keeps its snapshot's recommendations through a background
+        rebuild, the rebuilt version gives the recommendations of the build
+        it ran, and the old snapshot is freed when its reader is done '''
+
+    itemsim = calculateSimilarItems(prefs)
+    rebuilt = calculateSimilarItems(prefs, similarity=sim_distance)
+    freed = []
+    holder = new_model_holder(prefs, itemsim, on_free=lambda snapshot: freed.append(snapshot['version']))
+    with model_snapshot(holder) as snap:
+        rebuild_model_async(holder, prefs, calculateSimilarItems, similarity=sim_distance).join()
+        if holder['current']['version'] != 2 or freed != [] or \
+                not _same_matrix(holder['current']['sim_matrix'], rebuilt):
+            return False
+        for user in prefs:
+            version, recs = recommend_from_holder(holder, user, getRecommendedItems)
+            if version != 2 or not _same_recs(recs, getRecommendedItems(prefs, rebuilt, user)) or \
+                    getRecommendedItems(snap['prefs'], snap['sim_matrix'], user) != \
+                    getRecommendedItems(prefs, itemsim, user):
+                return False
 
-        # iterate through user's ratings
-        for item in prefs[user]:
-            # remove a rating
-            removed_rating = prefs_cp[user].pop(item)
-            # get list of recommendations   
-            recs = algo(prefs_cp, sim_matrix, user, sim_threshold)
-            
-            # iterate through recommendations
-            for rec in recs:
-                # if this item is in the recommendations, calculate error
-                if item in rec:
-                    ### UNCOMMENT FOR DEBUG PRINTS ###
-                    # pred_found = True
-                    predicted_rating = rec[0]
-                    error_mse = (predicted_rating - removed_rating)**2
-                    error_mae = abs(predicted_rating - removed_rating)
-                    mse_list.append(error_mse)
-                    mae_list.append(error_mae)
+    return freed == [1] and holder['retired'] == []
 
-            ### UNCOMMENT FOR DEBUG PRINTS [use w/ small datasets or implement a way to limit these] ###
-                    # print('User : {}, Item: {}, Prediction {}, Actual: {}, Error: {}, Absolute Error: {}'.format(
-                    # user, item, predicted_rating, removed_rating, error_mse, error_mae))
-            # if pred_found == False:
-                # print('From loo_cv(), No prediction calculated for item {}, user {} in pred_list: {}'.format(
-                # item, user, recs))
-                # pass
-            # pred_found = False
 
-            # add the previously removed rating back
-            prefs_cp[user][item] = removed_rating
+@register_check
+def check_experiment(prefs, shard_size=2):
+    ''' A run_experiment() interrupted after its first shard resumes from the
+        checkpoint to the MSE, MAE and n of loo_cv_sim(), and a repeat run is
+        served from the results store '''
 
-    # average all errors (RMSE => square root the average)
-    errors['mse'] = np.average(mse_list)
-    errors['mae'] = np.average(mae_list)
-    errors['rmse'] = sqrt(np.average(mse_list))
+    itemsim = calculateSimilarItems(prefs)
+    users = list(prefs)
+    interrupt = [True]
 
-    error_lists['(r)mse'] = mse_list
-    error_lists['mae'] = mae_list
+    def getRecommendedItemsOnce(prefs, itemMatch, user, sim_threshold=0):
+        if interrupt[0] and user == users[shard_size]:
+            interrupt[0] = False
+            raise KeyboardInterrupt
+        return getRecommendedItems(prefs, itemMatch, user, sim_threshold)
+
+    tmp = tempfile.mkdtemp()
+    try:
+        run = dict(dataset='check', db_path=os.path.join(tmp, 'results.db'),
+                   checkpoint_dir=os.path.join(tmp, 'checkpoints'), shard_size=shard_size)
+        with redirect_stdout(io.StringIO()):
+            try:
+                run_experiment(prefs, getRecommendedItemsOnce, 'pearson', itemsim, **run)
+                return False
+            except KeyboardInterrupt:
+                pass
+            if len(os.listdir(run['checkpoint_dir'])) != 1:
+                return False
+            resumed = run_experiment(prefs, getRecommendedItemsOnce, 'pearson', itemsim, **run)
+            stored = run_experiment(prefs, getRecommendedItemsOnce, 'pearson', itemsim, **run)
+            errors, error_lists = loo_cv_sim(prefs, None, getRecommendedItems, itemsim)
+    finally:
+        shutil.rmtree(tmp)
+
+    return resumed['n'] == len(error_lists['mae']) and \
+        abs(resumed['mse'] - errors['mse']) < 1e-9 and abs(resumed['mae'] - errors['mae']) < 1e-9 and \
+        stored == resumed
+
+
+@register_check
+def check_replay(prefs, seed=0):
+    ''' Ratings replayed in random order through add_rating() rebuild prefs
+        and the build_item_index() index, predictions and recommendations with
+        the index match the dict path, and replay_ratings() gives the MSE of
+        predicting each event from the ratings before it '''
+
+    rng = np.random.default_rng(seed)
+    events = [(0, user, item, prefs[user][item]) for user in prefs for item in prefs[user]]
+    events = [events[i] for i in rng.permutation(len(events))]
+
+    replayed = {}
+    index = build_item_index(replayed)
+    mse_list = []
+    for ts, user, item, rating in events:
+        pred = getPredictedRating(replayed, user, item, item_index=index)
+        if pred != getPredictedRating(replayed, user, item):
+            return False
+        if pred is not None:
+            mse_list.append((pred - rating)**2)
+        add_rating(replayed, index, user, item, rating)
+
+    if replayed != prefs or index != build_item_index(replayed):
+        return False
+    for user in replayed:
+        if getRecommendations(replayed, user, item_index=index) != getRecommendations(replayed, user):
+            return False
+
+    # a removed rating leaves the index of the remaining ratings
+    user = events[0][1]
+    item = events[0][2]
+    remove_rating(replayed, index, user, item)
+    if {item: raters for item, raters in index['raters'].items() if raters} != \
+            build_item_index(replayed)['raters']:
+        return False
+
+    report = replay_ratings(events, query_mix=0, verbose=False)
+    return abs(report['mse'] - np.average(mse_list)) < 1e-9 and \
+        report['coverage'] == len(mse_list) / len(events)
+
+
+@register_check
+def check_loo_sampled(prefs, batch_size=3):
+    ''' loo_cv_sampled() run to every rating (target width 0) gives the
+        MSE, MAE and number of predictions of loo_cv_sim() '''
+
+    itemsim = calculateSimilarItems(prefs)
+    usersim = calculateSimilarUsers(prefs)
+    for algo, sim_matrix in [(getRecommendedItems, itemsim), (getRecommendationSim, usersim)]:
+        with redirect_stdout(io.StringIO()):
+            errors, error_lists = loo_cv_sim(prefs, None, algo, sim_matrix)
+            sampled, sampled_lists = loo_cv_sampled(prefs, algo, sim_matrix, target_width=0,
+                                                    batch_size=batch_size)
+        if sampled['samples'] != sum([len(prefs[user]) for user in prefs]) or \
+                sampled['n'] != len(error_lists['mae']) or \
+                abs(sampled['mse'] - errors['mse']) > 1e-9 or abs(sampled['mae'] - errors['mae']) > 1e-9:
+            return False
+
+    return True
+
+
+@register_check
+def check_sketch(prefs, weighting=25):
+    ''' When no history was sampled, the count-min estimates of the sketched
+        candidates are never below their exact co-counts; builds with the
+        sketched candidates give each neighbor they find its exact
+        similarity, and the exact matrix when LSH found every co-rated pair '''
+
+    events = [(0, user, item, prefs[user][item]) for user in prefs for item in prefs[user]]
+    for rows, build, rowPrefs in [('items', calculateSimilarItems, transformPrefs(prefs)),
+                                  ('users', calculateSimilarUsers, prefs)]:
+        columns = transformPrefs(rowPrefs)
+        sketch = sketch_co_ratings(events, rows=rows,
+                                   history_size=max([len(columns[column]) for column in columns]))
+        counts, skipped = sketch_candidates(sketch)
+        missed = False
+        for row in rowPrefs:
+            for other in rowPrefs:
+                n_shared = len(rowPrefs[row].keys() & rowPrefs[other].keys())
+                if not sketch['sampled'] and other in counts[row] and counts[row][other] < n_shared:
+                    return False
+                missed = missed or (other != row and n_shared > 0 and other not in counts[row])
+
+        n = len(rowPrefs)
+        with redirect_stdout(io.StringIO()):
+            sketched = build(prefs, n, sim_weighting=weighting, batched=False, sketch=sketch)
+            exact = build(prefs, n, sim_weighting=weighting, batched=False)
+        if not missed and not _same_matrix(sketched, exact):
+            return False
+        for row in sketched:
+            sims = dict([(other, sim) for (sim, other) in exact[row]])
+            if any([other not in sims or abs(sim - sims[other]) > 1e-9 for (sim, other) in sketched[row]]):
+                return False
+
+    return True
+
+
+@register_check
+def check_sharded(prefs, n_workers=2):
+    ''' Sharded item-based and user-based recommendations give the lists of
+        getRecommendedItems() and getRecommendationSim(), before and after a
+        worker is added; an unknown user raises KeyError and the shards keep
+        serving '''
+
+    itemsim = calculateSimilarItems(prefs)
+    usersim = calculateSimilarUsers(prefs)
+    top_N = len(transformPrefs(prefs))
+    users = list(prefs)
+    service = start_sharded_service(prefs, itemsim, usersim, n_workers)
+    try:
+        for step in range(2):
+            item_recs = sharded_recommendations(service, users, 'item', top_N)
+            user_recs = sharded_recommendations(service, users, 'user', top_N)
+            for user in users:
+                if not _same_recs(item_recs[user], getRecommendedItems(prefs, itemsim, user)) or \
+                        not _same_recs(user_recs[user], getRecommendationSim(prefs, usersim, user)):
+                    return False
+            if sum([stats['users'] for stats in shard_stats(service).values()]) != len(prefs):
+                return False
+            add_shard_worker(service)
+
+        for algo in ('item', 'user'):
+            try:
+                sharded_recommendations(service, users + ['no such user'], algo)
+                return False
+            except KeyError:
+                pass
+        if not _same_recs(sharded_recommendations(service, users[0:1], 'item', top_N)[users[0]],
+                          item_recs[users[0]]):
+            return False
+    finally:
+        stop_sharded_service(service)
+
+    return True
+
+
+@register_check
+def check_lazy_neighbors(prefs, capacity=2):
+    ''' LazyNeighbors rows, read directly or prefetched, through evictions
+        and after a refresh, are the rows of calculateSimilarUsers() /
+        calculateSimilarItems(), and give the same recommendations '''
+
+    def sim_halved(prefs, p1, p2, sim_weighting=0):
+        return sim_pearson(prefs, p1, p2, sim_weighting) / 2
+
+    for similarity in (sim_pearson, sim_halved):
+        usersim = calculateSimilarUsers(prefs, similarity=similarity)
+        lazy = LazyNeighbors(prefs, similarity=similarity, capacity=capacity)
+        try:
+            for future in lazy.prefetch(list(prefs)[0:len(prefs) // 2]):
+                future.result()
+            if not _same_matrix(dict([(user, lazy[user]) for user in prefs]), usersim) or \
+                    lazy.stats['evictions'] == 0:
+                return False
+            for user in prefs:
+                if not _same_recs(getRecommendationSim(prefs, lazy, user),
+                                  getRecommendationSim(prefs, usersim, user)):
+                    return False
+
+            # new ratings: rows calculated before the refresh are dropped
+            changed = copy.deepcopy(prefs)
+            user = min(changed, key=lambda user: len(changed[user]))
+            changed[user].popitem()
+            lazy.refresh(changed)
+            if not _same_matrix(dict([(user, lazy[user]) for user in changed]),
+                                calculateSimilarUsers(changed, similarity=similarity)):
+                return False
+        finally:
+            lazy.close()
+
+    itemsim = calculateSimilarItems(prefs)
+    lazy = LazyNeighbors(transformPrefs(prefs), capacity=capacity)
+    try:
+        if not _same_matrix(dict([(item, lazy[item]) for item in itemsim]), itemsim):
+            return False
+        return all([_same_recs(getRecommendedItems(prefs, lazy, user), getRecommendedItems(prefs, itemsim, user))
+                    for user in prefs])
+    finally:
+        lazy.close()
 
-    return errors, error_lists
+
+@register_check
+def check_batch_recs(prefs, top_N=3, chunk_size=2):
+    ''' Lookups in the files of write_all_recs(), in one process or a pool
+        and after resuming a partly done job, give the top-N lists of
+        getRecommendedItems() / getRecommendationSim() (scores as float32) '''
+
+    def same_lookups(store, sim_matrix, algo):
+        for user in prefs:
+            recs = algo(prefs, sim_matrix, user)[0:top_N]
+            found = lookup_recs(store, user)
+            if [item for (score, item) in found] != [item for (score, item) in recs] or \
+                    any([abs(a[0] - b[0]) > 1e-5 * max(1, abs(b[0])) for a, b in zip(found, recs)]):
+                return False
+        return lookup_recs(store, 'no such user') == []
+
+    tmp = tempfile.mkdtemp()
+    try:
+        for algo, sim_matrix in [(getRecommendedItems, calculateSimilarItems(prefs)),
+                                 (getRecommendationSim, calculateSimilarUsers(prefs))]:
+            for n_workers in (1, 2):
+                directory = os.path.join(tmp, '%s_%d' % (algo.__name__, n_workers))
+                with redirect_stdout(io.StringIO()):
+                    write_all_recs(prefs, sim_matrix, algo, directory, top_N=top_N,
+                                   chunk_size=chunk_size, n_workers=n_workers)
+                if not same_lookups(load_all_recs(directory), sim_matrix, algo):
+                    return False
+
+            # interrupted after the first chunk: the rest is redone on resume
+            with open(os.path.join(directory, 'done.txt'), 'w') as f:
+                f.write('0\n')
+            items = np.load(os.path.join(directory, 'items.npy'), mmap_mode='r+')
+            items[chunk_size:, :] = -1
+            items.flush()
+            del items
+            with redirect_stdout(io.StringIO()):
+                summary = write_all_recs(prefs, sim_matrix, algo, directory, top_N=top_N,
+                                         chunk_size=chunk_size)
+            if summary['resumed'] != 1 or not same_lookups(load_all_recs(directory, None), sim_matrix, algo):
+                return False
+    finally:
+        shutil.rmtree(tmp)
+
+    return True
+
+
+@register_check
+def check_memory_degrade(prefs):
+    ''' Over a memory budget with the 'degrade' policy, leave-one-out (compact
+        working copy) and the builds (smaller or no batched blocks) give the
+        results they give without a budget; with 'fail' they raise MemoryError '''
+
+    itemsim = calculateSimilarItems(prefs, batched=False)
+    usersim = calculateSimilarUsers(prefs, batched=False)
+    with redirect_stdout(io.StringIO()):
+        baseline = loo_cv_sim(prefs, None, getRecommendedItems, itemsim)[0]
+
+    n_items = len(transformPrefs(prefs))
+    previous = dict(MEMORY_BUDGET)
+    try:
+        # no room at all, then room for a few small blocks of the item build
+        for budget in (1, _rss_bytes() + 4 * 8 * len(prefs) * n_items + 12 * 8 * n_items * 20):
+            set_memory_budget(budget, 'degrade')
+            with redirect_stdout(io.StringIO()):
+                degraded = loo_cv_sim(prefs, None, getRecommendedItems, itemsim)[0]
+                if abs(degraded['mse'] - baseline['mse']) > 1e-9 or \
+                        not _same_matrix(calculateSimilarItems(prefs), itemsim) or \
+                        not _same_matrix(calculateSimilarUsers(prefs), usersim):
+                    return False
+
+        set_memory_budget(1, 'fail')
+        try:
+            with redirect_stdout(io.StringIO()):
+                loo_cv_sim(prefs, None, getRecommendedItems, itemsim)
+            return False
+        except MemoryError:
+            pass
+    finally:
+        set_memory_budget(previous['bytes'], previous['policy'])
+
+    return True
+
+
+@register_check
+def check_latent(prefs, widths=(1, 3)):
+    ''' _csr_matmul() in blocks of any size gives the dense product, the
+        randomized SVD of a full rank keeps the rows' inner products, and
+        latent builds that re-score every row give the exact matrices '''
+
+    store = prefs_to_arrays(prefs)
+    column = dict([(item, c) for c, item in enumerate(store['items'])])
+    dense = np.zeros((len(store['users']), len(store['items'])))
+    for u, user in enumerate(store['users']):
+        for item in prefs[user]:
+            dense[u, column[item]] = prefs[user][item]
+
+    # an empty row in the middle, as a user without ratings
+    indptr = np.insert(store['indptr'], 1, store['indptr'][1])
+    dense = np.insert(dense, 1, 0, axis=0)
+    rng = np.random.default_rng(0)
+    for width in widths:
+        X = rng.normal(size=(len(store['items']), width))
+        for block_nnz in (1, 3, None):
+            if not np.allclose(_csr_matmul(indptr, store['indices'], store['ratings'], X, block_nnz), dense @ X):
+                return False
+
+    for rowPrefs, build in [(transformPrefs(prefs), calculateSimilarItems), (prefs, calculateSimilarUsers)]:
+        columns = dict([(col, c) for c, col in enumerate(transformPrefs(rowPrefs))])
+        full_rank = min(len(rowPrefs), len(columns))
+        rows, embedding = randomized_svd(rowPrefs, full_rank)
+        centered = np.zeros((len(rows), len(columns)))
+        for i, row in enumerate(rows):
+            mean = np.average(list(rowPrefs[row].values()))
+            for col in rowPrefs[row]:
+                centered[i, columns[col]] = rowPrefs[row][col] - mean
+        if not np.allclose(embedding @ embedding.T, centered @ centered.T):
+            return False
+
+        # n as large as the number of rows makes every row a candidate
+        with redirect_stdout(io.StringIO()):
+            if not _same_matrix(build(prefs, len(rowPrefs), latent_k=full_rank),
+                                build(prefs, len(rowPrefs), batched=False)):
+                return False
+
+    return True
 
 
 def main():
@@ -836,7 +6519,9 @@ def main():
     prefs = {}
     itemsim = {}
     usersim = {}
+    mf_model = {}
     sim_weighting = 0
+    store_order = 'file'  # id order of the stores the menus build, see ORDER
 
     while not done:
         print()
@@ -852,6 +6537,20 @@ def main():
                         'I(tem-based CF Recommendations)? \n'
                         'LCV(eave one out cross-validation)? \n'
                         'LCVSIM(eave one out cross-validation)? \n'
+                        'RANK(ing metrics, top-N holdout evaluation)? \n'
+                        'MF(atrix factorization model)? \n'
+                        'REPLAY(timestamp-ordered online update benchmark)? \n'
+                        'SCREEN(sampled LOO over the configuration grid)? \n'
+                        'TS(two-stage candidate generation benchmark)? \n'
+                        'SKETCH(approximate co-rating counts, error report)? \n'
+                        'SHARD(user-sharded serving over worker processes)? \n'
+                        'LAZY(on-demand user neighbors vs full Simu build)? \n'
+                        'BATCH(write top-N for every user to batch_recs/)? \n'
+                        'MEM(ory footprint of the model components and stages)? \n'
+                        'LATENT(truncated-SVD neighbor search vs exact sim matrix)? \n'
+                        'IMPLICIT(packed bitset Jaccard/cosine vs float paths)? \n'
+                        'ORDER(user/item id order for cache locality, benchmark)? \n'
+                        'CHECK(optimized paths vs the functions they replace)? \n'
                         'Sim(ilarity matrix) calc? \n'
                         'Simu(user-user sim matrix)? \n'
                         )
@@ -984,10 +6683,13 @@ def main():
             sim_matrix = {}
 
             # prompt for algorithm choice
-            algo = input('Enter algorithm: U(ser-based) or I(tem-based)')
+            algo = input('Enter algorithm: U(ser-based) or I(tem-based) or M(atrix factorization)')
             if algo == 'I' or algo == 'i':
                 algo = getRecommendedItems
                 sim_matrix = itemsim
+            elif algo == 'M' or algo == 'm':
+                algo = getRecommendationsMF
+                sim_matrix = mf_model
             else:
                 algo = getRecommendationSim
                 sim_matrix = usersim
@@ -1001,21 +6703,341 @@ def main():
                 else:
                     prefs_name = 'MLK-100k'
 
-                if sim_method == 'sim_pearson':
-                    sim = sim_pearson
-                else:
-                    sim = sim_distance
+                if algo == getRecommendationsMF:
+                    # the user factors are folded in without the held-out rating
+                    # (the item factors were still trained on all of them)
+                    errors, error_lists = loo_cv_sim(prefs, None, algo, sim_matrix)
+                    print('Errors for %s: MSE = %.5f, MAE = %.5f, RMSE = %.5f, len(SE list): %d, using %s MF with %d factors'
+                          % (prefs_name, errors['mse'], errors['mae'], errors['rmse'], len(error_lists['(r)mse']), mf_method, sim_matrix['P'].shape[1]))
+                    print()
+                    continue
 
-                errors, error_lists = loo_cv_sim(
-                    prefs, sim, algo, sim_matrix, sim_threshold=sim_threshold)
+                # checkpointed run, results are kept in results/results.db
+                errors = run_experiment(prefs, algo, sim_method, sim_matrix, sim_weighting,
+                                        sim_threshold, dataset=prefs_name)
                 print('Errors for %s: MSE = %.5f, MAE = %.5f, RMSE = %.5f, len(SE list): %d, using %s with sim_threshold >%0.1f and sim_weighting of %s'
-                      % (prefs_name, errors['mse'], errors['mae'], errors['rmse'], len(error_lists['(r)mse']), sim_method, sim_threshold, str(len(error_lists['(r)mse']))+'/' + str(sim_weighting)))
+                      % (prefs_name, errors['mse'], errors['mae'], errors['rmse'], errors['n'], sim_method, sim_threshold, str(errors['n'])+'/' + str(sim_weighting)))
                 print()
 
             else:
                 print(
                     'Empty dictionary, run R(ead) OR Empty Sim Matrix, run Simu(ilarity matrix!')
 
+        elif file_io == 'RANK' or file_io == 'rank':
+            print()
+
+            # prompt for algorithm choice
+            algo = input('Enter algorithm: U(ser-based) or I(tem-based)')
+
+            if len(prefs) > 0 and (itemsim != {} or usersim != {}):
+                print('Top-N Ranking Evaluation (80/20 holdout)')
+                train, test = split_prefs_holdout(prefs)
+
+                sim = get_similarity(sim_method)['pair']
+
+                # the sim matrix must be rebuilt without the held-out ratings
+                if algo == 'I' or algo == 'i':
+                    algo = getRecommendedItems
+                    sim_matrix = calculateSimilarItems(
+                        train, similarity=sim, sim_weighting=sim_weighting, sim_threshold=sim_threshold,
+                        n_workers=os.cpu_count() or 1, order=store_order)
+                else:
+                    algo = getRecommendationSim
+                    sim_matrix = calculateSimilarUsers(
+                        train, similarity=sim, sim_weighting=sim_weighting, sim_threshold=sim_threshold,
+                        n_workers=os.cpu_count() or 1, order=store_order)
+
+                top_n = get_all_top_n(train, sim_matrix, algo, top_N=10,
+                                      sim_threshold=sim_threshold, users=test)
+                n_items = len(transformPrefs(prefs))
+                metrics, metric_lists = ranking_metrics(top_n, test, k=10, n_items=n_items)
+                print('Ranking metrics: P@10 = %.5f, R@10 = %.5f, NDCG@10 = %.5f, MAP@10 = %.5f, coverage = %.5f, users: %d, using %s with sim_threshold >%0.1f and sim_weighting of %s'
+                      % (metrics['precision@10'], metrics['recall@10'], metrics['ndcg@10'], metrics['map@10'], metrics['coverage'], metrics['users'], sim_method, sim_threshold, str(sim_weighting)))
+                print()
+
+            else:
+                print(
+                    'Empty dictionary, run R(ead) OR Empty Sim Matrix, run Sim(ilarity matrix)!')
+
+        elif file_io == 'BATCH' or file_io == 'batch':
+            print()
+            algo = input('Enter algorithm: U(ser-based) or I(tem-based)')
+            if algo == 'I' or algo == 'i':
+                algo, sim_matrix = getRecommendedItems, itemsim
+            else:
+                algo, sim_matrix = getRecommendationSim, usersim
+
+            if len(prefs) > 0 and sim_matrix != {}:
+                summary = write_all_recs(prefs, sim_matrix, algo, 'batch_recs', sim_method,
+                                         n_workers=os.cpu_count() or 1, sim_weighting=sim_weighting)
+                print('Wrote top-10 recommendations for %d users in %d chunks (%d resumed) in %.2f secs to batch_recs/'
+                      % (summary['users'], summary['chunks'], summary['resumed'], summary['seconds']))
+                store = load_all_recs('batch_recs')
+                user = store['users'][0]
+                print('Lookup for user %s: %s' % (user, lookup_recs(store, user)))
+                print()
+
+            else:
+                print(
+                    'Empty dictionary, run R(ead) OR Empty Sim Matrix, run Sim(ilarity matrix)!')
+
+        elif file_io == 'ORDER' or file_io == 'order':
+            print()
+            if len(prefs) > 0:
+                order = input('Enter F(ile), D(egree) or R(CM) id order, or B(enchmark) them [F]\n')
+                if order in ('B', 'b'):
+                    print('Similarity build, batch scoring and LOO per id order (item-based, sim_pearson):')
+                    benchmark_id_order(prefs)
+                else:
+                    store_order = {'D': 'degree', 'd': 'degree', 'R': 'rcm', 'r': 'rcm'}.get(order, 'file')
+                    print('Similarity builds and MF training in this session now use the %s id order'
+                          % store_order)
+                print()
+
+            else:
+                print('Empty dictionary, R(ead) in some data!')
+
+        elif file_io == 'CHECK' or file_io == 'check':
+            print()
+            if len(prefs) > 0:
+                print('Optimized paths vs the functions they replace:')
+                results = run_checks(prefs)
+                print('%d of %d checks passed' % (sum(results.values()), len(results)))
+                print()
+
+            else:
+                print('Empty dictionary, R(ead) in some data!')
+
+        elif file_io == 'IMPLICIT' or file_io == 'implicit':
+            print()
+            if len(prefs) > 0:
+                threshold = input('Enter minimum rating that counts as an interaction [every rating]\n')
+                threshold = float(threshold) if threshold.replace('.', '', 1).isdigit() else None
+                sim = input('Enter J(accard) or C(osine) [J]\n')
+                sim = sim_cosine if sim in ('C', 'c') else sim_jaccard
+                # local weighting, sim_weighting stays that of the loaded sim matrices
+                weighting = input(
+                    'Enter similarity significance weighting n/(sim_weighting): 0 [None], 25, 50\n')
+                weighting = int(weighting) if weighting in ('25', '50') else 0
+                print('Implicit feedback item-item %s (sim_weighting %d):' % (sim.__name__, weighting))
+                benchmark_implicit(prefs, threshold, similarity=sim, sim_weighting=weighting)
+                print()
+
+            else:
+                print('Empty dictionary, R(ead) in some data!')
+
+        elif file_io == 'LATENT' or file_io == 'latent':
+            print()
+            if len(prefs) > 0:
+                rows = input('Enter U(ser) or I(tem) neighbors:')
+                rows = 'users' if rows in ('U', 'u') else 'items'
+                # local weighting, sim_weighting stays that of the loaded sim matrices
+                weighting = input(
+                    'Enter similarity significance weighting n/(sim_weighting): 0 [None], 25, 50\n')
+                weighting = int(weighting) if weighting in ('25', '50') else 0
+                print('Latent-space %s neighbors vs exact sim_pearson matrix (sim_weighting %d):'
+                      % (rows[0:-1], weighting))
+                benchmark_latent(prefs, rows, sim_weighting=weighting)
+                print()
+
+            else:
+                print('Empty dictionary, R(ead) in some data!')
+
+        elif file_io == 'MEM' or file_io == 'mem':
+            print()
+            if len(prefs) > 0:
+                budget = input('Enter memory budget in MB [none]\n')
+                # the budget only applies to this report, the previous one is restored after it
+                previous = dict(MEMORY_BUDGET)
+                try:
+                    policy = input('Enter F(ail fast) or D(egrade) when over budget [F]\n')
+                    set_memory_budget(float(budget) * 1e6, 'degrade' if policy in ('D', 'd') else 'fail')
+                except ValueError:
+                    set_memory_budget(None)
+                try:
+                    benchmark_memory(prefs)
+                except MemoryError as ex:
+                    print('Memory budget exceeded: %s' % ex)
+                finally:
+                    set_memory_budget(previous['bytes'], previous['policy'])
+                print()
+
+            else:
+                print('Empty dictionary, R(ead) in some data!')
+
+        elif file_io == 'MF' or file_io == 'mf':
+            print()
+            if len(prefs) > 0:
+                sub_cmd = input(
+                    'R(ead) model or WA(rite) ALS model or WS(rite) SGD model?\n')
+
+                try:
+                    if sub_cmd == 'R' or sub_cmd == 'r':
+                        # factors are memory-mapped, not read into memory
+                        mf_model = load_mf_model('save_mf_model')
+                        mf_method = mf_model.get('method', 'als')
+
+                    elif sub_cmd in ['WA', 'wa', 'WS', 'ws']:
+                        factors = input('Enter number of latent factors [10]\n')
+                        factors = int(factors) if factors.isdigit() else 10
+                        mf_method = 'sgd' if sub_cmd in ['WS', 'ws'] else 'als'
+                        mf_model = train_mf(prefs, factors=factors, method=mf_method,
+                                            iterations=30 if mf_method == 'sgd' else 15, order=store_order)
+                        mf_model['method'] = mf_method
+                        save_mf_model(mf_model, 'save_mf_model')
+
+                    else:
+                        print("MF sub-command %s is invalid, try again" % sub_cmd)
+                        continue
+
+                    print('%s model with %d factors, %d users, %d items'
+                          % (mf_method.upper(), mf_model['P'].shape[1],
+                             len(mf_model['users']), len(mf_model['items'])))
+
+                except Exception as ex:
+                    print('Error!!', ex, '\nNeed to W(rite) a model before you can R(ead) it!'
+                          ' Enter MF again and choose a Write command')
+                    print()
+
+            else:
+                print('Empty dictionary, R(ead) in some data!')
+
+        elif file_io == 'REPLAY' or file_io == 'replay':
+            print()
+            if len(prefs) > 0:
+                events = from_file_to_events(path, file_dir+datafile, file_dir+itemfile)
+                max_events = input('Enter number of events to replay [all]\n')
+                max_events = int(max_events) if max_events.isdigit() else None
+
+                print('Replaying "%s" in timestamp order (user-based CF, sim_pearson)' % datafile)
+                report = replay_ratings(events, max_events=max_events)
+                print('Replayed %d events in %.2f s: %.1f updates/s, query latency p50 = %.2f ms, p99 = %.2f ms, prequential MSE = %.5f, MAE = %.5f, RMSE = %.5f, coverage = %.2f %%'
+                      % (report['events'], report['seconds'], report['updates_per_sec'], report['query_p50_ms'], report['query_p99_ms'],
+                         report['mse'], report['mae'], report['rmse'], 100 * report['coverage']))
+                print()
+
+            else:
+                print('Empty dictionary, R(ead) in some data!')
+
+        elif file_io == 'LAZY' or file_io == 'lazy':
+            print()
+            if len(prefs) > 0:
+                t = time.time()
+                full = calculateSimilarUsers(prefs, similarity=sim_pearson, n_workers=os.cpu_count() or 1)
+                full_secs = time.time() - t
+
+                lazy = LazyNeighbors(prefs, similarity=sim_pearson, capacity=max(len(prefs) // 4, 1))
+                first = list(prefs)[0]
+                t = time.time()
+                getRecommendationSim(prefs, lazy, first)
+                first_secs = time.time() - t
+
+                # prefetch the users most likely to come back
+                try:
+                    active = predict_active_users(
+                        from_file_to_events(path, file_dir+datafile, file_dir+itemfile), lazy.capacity)
+                except ValueError:  # no timestamps, use the heaviest raters
+                    active = sorted(prefs, key=lambda user: len(prefs[user]), reverse=True)[0:lazy.capacity]
+                for future in lazy.prefetch(active):
+                    future.result()
+                same = len([user for user in active
+                            if getRecommendationSim(prefs, lazy, user) == getRecommendationSim(prefs, full, user)])
+                lazy.close()
+
+                print('Full user-user matrix: %.3f secs; lazy, first recommendation: %.3f secs'
+                      % (full_secs, first_secs))
+                print('Prefetched %d active users, %d/%d recommendations match the full matrix'
+                      % (len(active), same, len(active)))
+                print('Cache: %d hits, %d misses, %d prefetched, %d evictions'
+                      % (lazy.stats['hits'], lazy.stats['misses'], lazy.stats['prefetched'],
+                         lazy.stats['evictions']))
+                print()
+
+            else:
+                print('Empty dictionary, R(ead) in some data!')
+
+        elif file_io == 'SCREEN' or file_io == 'screen':
+            print()
+            if len(prefs) > 0:
+                target_width = input('Enter target confidence interval width [0.05]\n')
+                try:
+                    target_width = float(target_width)
+                except ValueError:
+                    target_width = 0.05
+                print('Sampled LOO screening, 95%% confidence intervals no wider than %s' % target_width)
+                screen_configurations(prefs, target_width=target_width)
+                print()
+
+            else:
+                print('Empty dictionary, R(ead) in some data!')
+
+        elif file_io == 'TS' or file_io == 'ts':
+            print()
+            if len(prefs) > 0 and (len(itemsim) > 0 or len(usersim) > 0):
+                algo = input('Enter U(ser) or I(tem) algo:')
+                if (algo == 'U' or algo == 'u') and len(usersim) > 0:
+                    print('Two-stage vs exact user-based recommendations:')
+                    benchmark_two_stage(prefs, usersim, algo=getRecommendationSim)
+                elif (algo == 'I' or algo == 'i') and len(itemsim) > 0:
+                    print('Two-stage vs exact item-based recommendations:')
+                    benchmark_two_stage(prefs, itemsim, algo=getRecommendedItems,
+                                        usersim=usersim if len(usersim) > 0 else None)
+                else:
+                    print('Invalid algo, or its similarity matrix is empty!')
+                print()
+
+            else:
+                print('Empty dictionary or sim matrices, R(ead) in some data and run Sim or Simu!')
+
+        elif file_io == 'SKETCH' or file_io == 'sketch':
+            print()
+            if len(prefs) > 0:
+                # the ratings are streamed once, in any order
+                events = [(0, user, item, prefs[user][item]) for user in prefs for item in prefs[user]]
+                for rows in ('items', 'users'):
+                    print('Sketched co-rating counts of %s pairs vs exact counts:' % rows[0:-1])
+                    sketch_error_report(prefs, sketch_co_ratings(events, rows=rows))
+                    print()
+
+            else:
+                print('Empty dictionary, R(ead) in some data!')
+
+        elif file_io == 'SHARD' or file_io == 'shard':
+            print()
+            if len(prefs) > 0 and (len(itemsim) > 0 or len(usersim) > 0):
+                n_workers = input('Enter number of shard worker processes [4]\n')
+                try:
+                    n_workers = max(int(n_workers), 1)
+                except ValueError:
+                    n_workers = 4
+                service = start_sharded_service(prefs, itemsim, usersim, n_workers)
+                try:
+                    for step in ('start', 'add'):
+                        if step == 'add':
+                            print('Added a worker, %d users moved' % add_shard_worker(service))
+                        for worker, stats in sorted(shard_stats(service).items()):
+                            print('Worker %d: %d users, %d ratings, %d neighbors'
+                                  % (worker, stats['users'], stats['ratings'], stats['neighbors']))
+                        for algo, sim_matrix, single in (('item', itemsim, getRecommendedItems),
+                                                         ('user', usersim, getRecommendationSim)):
+                            if len(sim_matrix) == 0:
+                                continue
+                            t = time.time()
+                            recs = sharded_recommendations(service, list(prefs), algo)
+                            elapsed = time.time() - t
+                            # same predictions as the single-process algorithm
+                            same = len([user for user in prefs
+                                        if [round(r, 9) for (r, item) in recs[user]] ==
+                                        [round(r, 9) for (r, item) in single(prefs, sim_matrix, user)[0:10]]])
+                            print('%s-based: %d users in %.3f secs, %d/%d match single-process'
+                                  % (algo, len(prefs), elapsed, same, len(prefs)))
+                finally:
+                    stop_sharded_service(service)
+                print()
+
+            else:
+                print('Empty dictionary or sim matrices, R(ead) in some data and run Sim or Simu!')
+
         elif file_io == 'Sim' or file_io == 'sim':
             print()
             if len(prefs) > 0:
@@ -1046,7 +7068,8 @@ def main():
                     print('ALERT: invalid option selected, defaulting to >0\n')
 
                 sub_cmd = input(
-                    'RD(ead) distance or RP(ead) pearson or WD(rite) distance or WP(rite) pearson?\n')
+                    'RD(ead) distance or RP(ead) pearson or WD(rite) distance or WP(rite) pearson?\n'
+                    '(or R/W followed by C(osine), AC (adjusted cosine), J(accard))\n')
 
                 try:
                     if sub_cmd == 'RD' or sub_cmd == 'rd':
@@ -1064,7 +7087,8 @@ def main():
                     elif sub_cmd == 'WD' or sub_cmd == 'wd':
                         # transpose the U-I matrix and calc item-item similarities matrix
                         itemsim = calculateSimilarItems(
-                            prefs, similarity=sim_distance, sim_weighting=sim_weighting, sim_threshold=sim_threshold)
+                            prefs, similarity=sim_distance, sim_weighting=sim_weighting, sim_threshold=sim_threshold,
+                            n_workers=os.cpu_count() or 1, order=store_order)
                         # Dump/save dictionary to a pickle file
                         pickle.dump(itemsim, open(
                             "save_itemsim_distance.p", "wb"))
@@ -1073,12 +7097,25 @@ def main():
                     elif sub_cmd == 'WP' or sub_cmd == 'wp':
                         # transpose the U-I matrix and calc item-item similarities matrix
                         itemsim = calculateSimilarItems(
-                            prefs, similarity=sim_pearson, sim_weighting=sim_weighting, sim_threshold=sim_threshold)
+                            prefs, similarity=sim_pearson, sim_weighting=sim_weighting, sim_threshold=sim_threshold,
+                            n_workers=os.cpu_count() or 1, order=store_order)
                         # Dump/save dictionary to a pickle file
                         pickle.dump(itemsim, open(
                             "save_itemsim_pearson.p", "wb"))
                         sim_method = 'sim_pearson'
 
+                    elif sub_cmd[0:1] in 'RrWw' and sub_cmd[1:].upper() in SIM_SUBCOMMANDS:
+                        # any other registered similarity method
+                        sim_method = SIM_SUBCOMMANDS[sub_cmd[1:].upper()]
+                        filename = "save_itemsim_%s.p" % sim_method[4:]
+                        if sub_cmd[0] in 'Rr':
+                            itemsim = pickle.load(open(filename, "rb"))
+                        else:
+                            itemsim = calculateSimilarItems(
+                                prefs, similarity=get_similarity(sim_method)['pair'], sim_weighting=sim_weighting,
+                                sim_threshold=sim_threshold, n_workers=os.cpu_count() or 1, order=store_order)
+                            pickle.dump(itemsim, open(filename, "wb"))
+
                     else:
                         print("Sim sub-command %s is invalid, try again" % sub_cmd)
                         continue
@@ -1132,7 +7169,8 @@ def main():
                     print('ALERT: invalid option selected, defaulting to >0\n')
 
                 sub_cmd = input(
-                    'RD(ead) distance or RP(ead) pearson or WD(rite) distance or WP(rite) pearson?\n')
+                    'RD(ead) distance or RP(ead) pearson or WD(rite) distance or WP(rite) pearson?\n'
+                    '(or R/W followed by C(osine), AC (adjusted cosine), J(accard))\n')
                 try:
                     if sub_cmd == 'RD' or sub_cmd == 'rd':
                         # Load the dictionary back from the pickle file.
@@ -1149,7 +7187,8 @@ def main():
                     elif sub_cmd == 'WD' or sub_cmd == 'wd':
                         # transpose the U-I matrix and calc user-user similarities matrix
                         usersim = calculateSimilarUsers(
-                            prefs, similarity=sim_distance, sim_weighting=sim_weighting, sim_threshold=sim_threshold)
+                            prefs, similarity=sim_distance, sim_weighting=sim_weighting, sim_threshold=sim_threshold,
+                            n_workers=os.cpu_count() or 1, order=store_order)
                         # Dump/save dictionary to a pickle file
                         pickle.dump(usersim, open(
                             "save_usersim_distance.p", "wb"))
@@ -1158,12 +7197,25 @@ def main():
                     elif sub_cmd == 'WP' or sub_cmd == 'wp':
                         # transpose the U-I matrix and calc user-user similarities matrix
                         usersim = calculateSimilarUsers(
-                            prefs, similarity=sim_pearson, sim_weighting=sim_weighting, sim_threshold=sim_threshold)
+                            prefs, similarity=sim_pearson, sim_weighting=sim_weighting, sim_threshold=sim_threshold,
+                            n_workers=os.cpu_count() or 1, order=store_order)
                         # Dump/save dictionary to a pickle file
                         pickle.dump(usersim, open(
                             "save_usersim_pearson.p", "wb"))
                         sim_method = 'sim_pearson'
 
+                    elif sub_cmd[0:1] in 'RrWw' and sub_cmd[1:].upper() in SIM_SUBCOMMANDS:
+                        # any other registered similarity method
+                        sim_method = SIM_SUBCOMMANDS[sub_cmd[1:].upper()]
+                        filename = "save_usersim_%s.p" % sim_method[4:]
+                        if sub_cmd[0] in 'Rr':
+                            usersim = pickle.load(open(filename, "rb"))
+                        else:
+                            usersim = calculateSimilarUsers(
+                                prefs, similarity=get_similarity(sim_method)['pair'], sim_weighting=sim_weighting,
+                                sim_threshold=sim_threshold, n_workers=os.cpu_count() or 1, order=store_order)
+                            pickle.dump(usersim, open(filename, "wb"))
+
                     else:
                         print("Sim sub-command %s is invalid, try again" % sub_cmd)
                         continue